@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+from compile_cache import compilerFingerprint
+from compile_cache import copyFile
+
+"""
+Action cache, enabled by pconfig.py --action_cache
+
+Archive, link and protoc commands in the Makefile and build.ninja are
+prefixed by ${ACTION_CACHE}, with their outputs and extra inputs:
+
+  $ python build_tools/blade3/action_cache.py -o x.a -- ar rcs x.a a.o b.o
+  $ python build_tools/blade3/action_cache.py -o a.pb.cc -o a.pb.h -i b.pb.h -- protoc ... a.proto
+
+The key of an action hashes its command line, the tool (path, size and
+mtime of the first word), and the content of its inputs, which are the
+files given by -i and all files on the command line except the outputs.
+If the key is found, the outputs are restored from the cache instead of
+running the command; otherwise an old archive is removed, as 'ar rcs'
+would keep its stale members, the command runs, and its outputs are stored.
+
+Each entry has a manifest of the sha1 of its files, they are checked
+before restoring, a broken entry is removed and the action runs again.
+Entries are written to a temporary dir and renamed, so the cache can be
+shared by many workspaces, i.e. on NFS:
+
+  $ export BLADE_ACTION_CACHE_DIR=/nfs/blade_cache/actions
+
+It's ~/.blade_cache/actions by default, capped to $BLADE_ACTION_CACHE_SIZE
+MB (10240 by default), least recently used entries are removed first.
+Hits and misses of the workspace are reported, and the cache is trimmed,
+at the end of 'make debug/release':
+
+  $ python build_tools/blade3/action_cache.py --stats
+"""
+
+cache_dir = os.environ.get("BLADE_ACTION_CACHE_DIR",
+                           os.path.expanduser("~/.blade_cache/actions"))
+cache_size = int(os.environ.get("BLADE_ACTION_CACHE_SIZE", "10240")) * 1024 * 1024
+
+# bump it when the layout of the cache changes
+cache_version = "2"
+
+# the cache may be shared, so hits and misses are counted in the workspace
+stats_file = ".build/action_cache_stats"
+
+manifest_name = "manifest"
+
+# the cache is trimmed to this fraction of its size, so it isn't trimmed every build
+trim_ratio = 0.9
+
+def fileHash(path):
+  h = hashlib.sha1()
+  f = open(path, "rb")
+  try:
+    while True:
+      block = f.read(1024 * 1024)
+      if not block:
+        break
+      h.update(block)
+  finally:
+    f.close()
+  return h.hexdigest()
+
+def parseArgs(args):
+  """ outputs, extra inputs and the command, or None if args are invalid """
+  outputs = []
+  inputs = []
+  i = 0
+  while i < len(args) and args[i] != "--":
+    if args[i] in ("-o", "-i") and i + 1 < len(args):
+      if args[i] == "-o":
+        outputs.append(args[i + 1])
+      else:
+        inputs.append(args[i + 1])
+      i = i + 2
+      continue
+    return None
+  command = args[i + 1:]
+  if len(outputs) == 0 or len(command) == 0:
+    return None
+  return outputs, inputs, command
+
+def actionKey(outputs, inputs, command):
+  h = hashlib.sha1()
+  try:
+    tool = compilerFingerprint(command[0])
+  except OSError:
+    tool = command[0]
+  h.update("%s\n%s\n" % (cache_version, tool))
+  h.update("\0".join(command))
+  h.update("\n%s\n" % "\0".join(outputs))
+  files = set(inputs)
+  for a in command:
+    if os.path.isfile(a):
+      files.add(a)
+  for path in sorted(files - set(outputs)):
+    h.update("%s %s\n" % (path, fileHash(path)))
+  return h.hexdigest()
+
+def entryPath(key):
+  return os.path.join(cache_dir, key[:2], key)
+
+def readManifest(entry):
+  # [(index, sha1, output)]
+  res = []
+  for line in file(os.path.join(entry, manifest_name)):
+    index, sha1, output = line.rstrip("\n").split(" ", 2)
+    res.append((index, sha1, output))
+  return res
+
+def restore(key, outputs):
+  entry = entryPath(key)
+  if not os.path.isdir(entry):
+    return "miss"
+  try:
+    manifest = readManifest(entry)
+    if sorted([a[2] for a in manifest]) != sorted(outputs):
+      raise ValueError("outputs changed")
+    for index, sha1, output in manifest:
+      if fileHash(os.path.join(entry, index)) != sha1:
+        raise ValueError("%s is broken" % output)
+  except (IOError, OSError, ValueError):
+    shutil.rmtree(entry, True)
+    return "broken"
+  try:
+    for index, sha1, output in manifest:
+      dir_name = os.path.dirname(output)
+      if dir_name != "" and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+      copyFile(os.path.join(entry, index), output)
+    # mtime of the manifest tells when it's used last
+    os.utime(os.path.join(entry, manifest_name), None)
+  except (IOError, OSError):
+    return "miss"
+  return "hit"
+
+def store(key, outputs):
+  entry = entryPath(key)
+  tmp = "%s.tmp%d" % (entry, os.getpid())
+  try:
+    os.makedirs(tmp)
+    manifest = open(os.path.join(tmp, manifest_name), "w")
+    for i, output in enumerate(outputs):
+      shutil.copyfile(output, os.path.join(tmp, str(i)))
+      manifest.write("%d %s %s\n" % (i, fileHash(output), output))
+    manifest.close()
+    # another workspace may have stored it at the same time
+    if not os.path.exists(entry):
+      os.rename(tmp, entry)
+  except (IOError, OSError):
+    pass
+  shutil.rmtree(tmp, True)
+
+def count(event):
+  # one line per action, appending a short line is atomic
+  try:
+    if not os.path.isdir(os.path.dirname(stats_file)):
+      os.makedirs(os.path.dirname(stats_file))
+    fd = os.open(stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fd, event + "\n")
+    os.close(fd)
+  except OSError:
+    pass
+
+def cachedRun(args):
+  parsed = parseArgs(args)
+  if parsed is None:
+    print >>sys.stderr, "usage: %s -o OUTPUT ... [-i INPUT ...] -- COMMAND" % sys.argv[0]
+    return -1
+  outputs, inputs, command = parsed
+  try:
+    key = actionKey(outputs, inputs, command)
+  except (IOError, OSError):
+    # a missing input, let the command report it
+    return subprocess.call(command)
+  event = restore(key, outputs)
+  count(event)
+  if event == "hit":
+    return 0
+  # the entry must hold only what the command makes from the inputs of the
+  # key, but 'ar rcs' adds to an existing archive, keeping stale members.
+  # other outputs are kept, under -j make may run a rule of several targets,
+  # such as protoc's x.pb.cc x.pb.h, once per target while compiles read them
+  for output in outputs:
+    if output.endswith(".a") and os.path.isfile(output):
+      os.remove(output)
+  res = subprocess.call(command)
+  if res == 0 and all([os.path.isfile(a) for a in outputs]):
+    store(key, outputs)
+  return res
+
+def trim():
+  """ remove least recently used entries until the cache fits, return its size """
+  entries = []
+  total = 0
+  for sub_dir in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, sub_dir)
+    if not os.path.isdir(path):
+      continue
+    for name in os.listdir(path):
+      entry = os.path.join(path, name)
+      if ".tmp" in name:
+        continue
+      try:
+        mtime = os.stat(os.path.join(entry, manifest_name)).st_mtime
+        size = sum([os.path.getsize(os.path.join(entry, a)) for a in os.listdir(entry)])
+      except OSError:
+        # being written or removed
+        continue
+      total = total + size
+      entries.append((mtime, entry, size))
+  if total <= cache_size:
+    return total
+  entries.sort()
+  for mtime, entry, size in entries:
+    if total <= cache_size * trim_ratio:
+      break
+    shutil.rmtree(entry, True)
+    total = total - size
+  return total
+
+def report():
+  """ print hits and misses since the last report, and trim the cache """
+  if not os.path.isdir(cache_dir):
+    return
+  try:
+    events = file(stats_file).read().split()
+    os.remove(stats_file)
+  except (IOError, OSError):
+    events = []
+  size = trim()
+  if len(events) > 0:
+    hits = events.count("hit")
+    print "action cache: %d hits, %d misses, %d broken entries, %.1f%% hit rate, " \
+        "%d of %d MB used" % (hits, events.count("miss"), events.count("broken"),
+                              100.0 * hits / len(events), size / (1024 * 1024),
+                              cache_size / (1024 * 1024))
+
+if __name__ == "__main__":
+  if len(sys.argv) == 2 and sys.argv[1] == "--stats":
+    report()
+    sys.exit(0)
+  sys.exit(cachedRun(sys.argv[1:]))
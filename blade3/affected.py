@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import optparse
+import os
+import re
+import sys
+
+import depdb
+import query
+from dirs import build_dir
+from dirs import settings_list
+
+"""
+Tests affected by a change, so that CI builds and runs only what it touches
+
+The changed files are given on the command line, or on stdin:
+
+  $ git diff --name-only origin/master | python build_tools/blade3/affected.py --make
+  $ make affected_test
+
+Files are mapped to the rules owning them by the graph of the last
+gen_makefile in .blade/deps.db, see depdb.py:
+  - a file in srcs of a rule belongs to it
+  - a header, or any file compiled into an object, belongs to the rule of
+    the object if it's listed in the .d file of the object under .build
+  - a BUILD file belongs to all rules of its package, so does a file under
+    a package which isn't found above, i.e. a header never compiled yet
+Then the rules depending on them are walked, and the cc_test and ss_test
+rules among them, in the packages of the Makefile, are affected. A file out
+of all packages, i.e. in build_tools, affects all tests, unless
+--ignore_unowned is given.
+
+The labels of the affected tests are printed. With --make, the affected_test
+target is written to .blade/affected_test.mk (included by the Makefile); it
+builds only the affected tests and runs them by ${TEST_RUNNER}.
+"""
+
+make_file = ".blade/affected_test.mk"
+
+# the same as cc.unity_dir, a bundle belongs to the rule in its name
+_unity_regex = re.compile(r"^\.blade/unity/(.+)/([^/]+)_unity_\d+\.cc$")
+
+test_types = ("cc_test", "ss_test")
+
+def packageOf(label):
+  # "//base/BUILD:base" => "base"
+  return label[2:].split(":", 1)[0][:-len("/BUILD")]
+
+def owningPackage(path, packageNames):
+  dir_name = os.path.dirname(path)
+  while dir_name != "":
+    if dir_name in packageNames:
+      return dir_name
+    dir_name = os.path.dirname(dir_name)
+  return None
+
+def readDepfile(path):
+  """ prerequisites of the first rule of a .d file, the source first """
+  try:
+    text = file(path).read().replace("\\\n", " ")
+  except IOError:
+    return []
+  line = text.split("\n", 1)[0]
+  if ":" not in line:
+    return []
+  return [os.path.normpath(a) for a in line.split(":", 1)[1].split()]
+
+def depfileOwners(src_owners, db):
+  """ file => ids of the rules of the objects whose .d files list it """
+  res = {}
+  for dir_name, dir_names, file_names in os.walk(build_dir):
+    for name in file_names:
+      if not name.endswith(".d"):
+        continue
+      prerequisites = readDepfile(os.path.join(dir_name, name))
+      if len(prerequisites) == 0:
+        continue
+      rules = src_owners.get(prerequisites[0])
+      if rules is None:
+        matcher = _unity_regex.match(prerequisites[0])
+        if matcher is None:
+          continue
+        i = db.find("//%s/BUILD:%s" % (matcher.group(1), matcher.group(2)))
+        if i is None:
+          continue
+        rules = set([i])
+      for a in prerequisites:
+        res.setdefault(a, set()).update(rules)
+  return res
+
+def changedRules(changed, db):
+  """ ids of the rules owning the changed files, and the files out of all packages """
+  src_owners = {}
+  package_rules = {}
+  for i in range(db.ruleCount()):
+    if db.kind(i) == "":
+      # a dep which isn't a rule
+      continue
+    package_rules.setdefault(packageOf(db.label(i)), set()).add(i)
+    for src in db.srcs(i):
+      src_owners.setdefault(os.path.normpath(src), set()).add(i)
+  depfile_owners = depfileOwners(src_owners, db)
+
+  res = set()
+  unowned = []
+  for path in changed:
+    path = os.path.normpath(path)
+    rules = src_owners.get(path, set()) | depfile_owners.get(path, set())
+    packageName = owningPackage(path, package_rules)
+    if os.path.basename(path) == "BUILD" and os.path.dirname(path) in package_rules:
+      rules = rules | package_rules[os.path.dirname(path)]
+    elif len(rules) == 0 and packageName is not None:
+      rules = package_rules[packageName]
+    if len(rules) == 0:
+      unowned.append(path)
+    res.update(rules)
+  return res, unowned
+
+def affectedTests(changed, ignore_unowned, db):
+  """ ids of the affected tests, in the order of their labels """
+  rules, unowned = changedRules(changed, db)
+  for path in unowned:
+    if ignore_unowned:
+      print >>sys.stderr, "%s is out of all packages, ignored" % path
+    else:
+      print >>sys.stderr, "%s is out of all packages, all tests are affected" % path
+  if len(unowned) > 0 and not ignore_unowned:
+    rules = range(db.ruleCount())
+  else:
+    rules = query.walk(db.rdeps, rules)
+  packages = set(db.packages())
+  return sorted([i for i in rules if db.kind(i) in test_types
+                 and "//%s/BUILD" % packageOf(db.label(i)) in packages])
+
+def targetPath(label, settings_name):
+  # such as ".build/debug/targets/base/base_test", as cc.CCBinary.makeTargetName()
+  return os.path.join(build_dir, settings_name, "targets", packageOf(label), label.split(":", 1)[1])
+
+def emitMake(f, tests, settings_name, db):
+  test_targets = [targetPath(db.label(i), settings_name) for i in tests
+                  if db.kind(i) == "cc_test"]
+  scripts = []
+  # binaries which scripts may run, in all settings as 'make ss_test'
+  binaries = set()
+  for i in tests:
+    if db.kind(i) != "ss_test":
+      continue
+    scripts.extend(db.srcs(i))
+    for a in query.walk(db.deps, [i]):
+      if db.kind(a) == "cc_binary":
+        binaries.update([targetPath(db.label(a), b) for b in settings_list])
+
+  print >>f, "# Do NOT modify this file. It's auto-generated by affected.py."
+  print >>f, ".PHONY: affected_test"
+  print >>f, "affected_test: %s" % " ".join(test_targets + sorted(binaries) + scripts)
+  if len(test_targets) + len(scripts) == 0:
+    print >>f, "\t@${PRINT_WARNING} 'No test is affected by the change'"
+  else:
+    print >>f, "\t@${TEST_RUNNER} --name affected_test %s -- ${UNIT_TEST_OPTIONS}" \
+        % " ".join(test_targets + scripts)
+
+def parseOptions(argv):
+  parser = optparse.OptionParser(usage="%prog [options] [CHANGED_FILE ...]")
+  parser.add_option("--make", action="store_true", default=False,
+                    help="write the affected_test target to %s" % make_file)
+  parser.add_option("--setting", default=settings_list[0],
+                    help="setting of the tests built by affected_test, %s by default"
+                    % settings_list[0])
+  parser.add_option("--ignore_unowned", action="store_true", default=False,
+                    help="ignore changed files out of all packages, "
+                    "instead of running all tests")
+  return parser.parse_args(argv[1:])
+
+def main(argv):
+  options, changed = parseOptions(argv)
+  if len(changed) == 0:
+    changed = sys.stdin.read().split()
+  if options.setting not in settings_list:
+    print >>sys.stderr, "unknown setting %s, it must be one of %s" \
+        % (options.setting, ", ".join(settings_list))
+    return -1
+  try:
+    db = depdb.DepDB()
+  except (IOError, ValueError), e:
+    print >>sys.stderr, e
+    return -1
+
+  tests = affectedTests(changed, options.ignore_unowned, db)
+  for i in tests:
+    print db.label(i)
+  if options.make:
+    p = file(make_file, "w")
+    emitMake(p, tests, options.setting, db)
+    p.close()
+    print >>sys.stderr, "%d tests are affected, run them by 'make affected_test'" % len(tests)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
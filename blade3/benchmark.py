@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import json
+import optparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Benchmark of Makefile generation on synthetic codebases
+
+It generates a codebase with BLADE_ROOT and N packages, then times each phase
+of pconfig.main in a separate process:
+  read_package   reading and evaluating BUILD files
+  expand_rules   expanding rule deps, not including reading the packages
+  closures       proto header closures
+  dump           dumping the loaded packages
+  emit_make      writing the Makefile, not including the side files
+  side_files     writing .blade/all_deps, deps.db, src_files, files_to_pub, exe_files
+Each scenario runs twice, "cold" without the build cache and "warm" with it.
+
+The report is written as json, with wall time of each phase, peak memory
+(max rss, in KB) after each phase, and the size of the outputs.
+
+Usage:
+  python build_tools/blade3/benchmark.py --output report.json
+  python build_tools/blade3/benchmark.py --scenario deep --packages 5000
+"""
+
+blade_dir = os.path.dirname(os.path.realpath(__file__))
+
+# name: (packages, rules per package, depth, fan-out, proto chain, glob srcs, proto fan-out)
+scenarios = {
+  "small": (200, 2, 5, 2, 0, False, 1),
+  "deep": (1000, 1, 200, 1, 0, False, 1),
+  "wide": (1000, 3, 5, 8, 0, False, 1),
+  "proto": (300, 2, 5, 2, 40, False, 1),
+  "glob": (500, 4, 10, 3, 0, True, 1),
+  # each proto_library depends on the previous three, the header closures
+  # were rebuilt over all paths of the chain before they were cached
+  "proto_deep": (50, 1, 1, 1, 22, False, 3),
+}
+default_scenarios = ["small", "deep", "wide", "proto", "glob", "proto_deep"]
+
+def writeFile(path, content):
+  dir_name = os.path.dirname(path)
+  if dir_name != "" and not os.path.exists(dir_name):
+    os.makedirs(dir_name)
+  f = file(path, "w")
+  f.write(content)
+  f.close()
+
+def generateCodebase(root, packages, rules, depth, fanout, proto_chain, glob_srcs,
+                     proto_fanout=1, files_per_rule=4, seed=1):
+  """
+   packages are spread over depth layers, rules of a package depend on
+   fanout random rules of packages in lower layers. if proto_chain > 0, there
+   is a chain of proto_library, each one depending on the previous
+   proto_fanout ones, and all rules of the lowest layer depend on its top.
+   return the BUILD files of all packages.
+  """
+  rand = random.Random(seed)
+  writeFile(os.path.join(root, "BLADE_ROOT"), "")
+  os.symlink(os.path.dirname(blade_dir), os.path.join(root, "build_tools"))
+
+  for i in range(proto_chain):
+    name = "bench/proto/p%03d" % i
+    deps = ["//bench/proto/p%03d/BUILD:msg" % j for j in range(max(i - proto_fanout, 0), i)]
+    writeFile(os.path.join(root, name, "msg.proto"), 'package bench;\n')
+    writeFile(os.path.join(root, name, "BUILD"),
+              'proto_library(name = "msg",\n'
+              '              srcs = ["msg.proto"],\n'
+              '              deps = %r,\n'
+              '             )\n' % deps)
+
+  layers = [[] for a in range(max(depth, 1))]
+  for i in range(packages):
+    layers[i * len(layers) / packages].append("bench/p%05d" % i)
+  layers = [layer for layer in layers if len(layer) > 0]
+
+  build_files = []
+  for layer_index, layer in enumerate(layers):
+    for name in layer:
+      build = []
+      for j in range(rules):
+        deps = [":lib%d" % (j - 1)] if j > 0 else []
+        if layer_index == 0:
+          if proto_chain > 0:
+            deps.append("//bench/proto/p%03d/BUILD:msg" % (proto_chain - 1))
+        else:
+          for k in range(fanout):
+            dep_layer = layers[rand.randrange(layer_index)]
+            deps.append("//%s/BUILD:lib%d" % (rand.choice(dep_layer), rand.randrange(rules)))
+        deps = sorted(set(deps))
+
+        srcs = []
+        for k in range(files_per_rule):
+          src = "lib%d/f%d.cc" % (j, k)
+          writeFile(os.path.join(root, name, src), "int f%d_%d() { return %d; }\n" % (j, k, k))
+          srcs.append(src)
+        writeFile(os.path.join(root, name, "lib%d/lib.h" % j), "int f%d_0();\n" % j)
+        if glob_srcs:
+          srcs = ["lib%d/*.cc" % j]
+
+        build.append('cc_library(name = "lib%d",\n'
+                     '           srcs = %r,\n'
+                     '           deps = %r,\n'
+                     '          )\n' % (j, srcs, deps))
+
+      writeFile(os.path.join(root, name, "lib_test.cc"), "int main() { return 0; }\n")
+      build.append('cc_test(name = "lib_test",\n'
+                   '        srcs = ["lib_test.cc"],\n'
+                   '        deps = [":lib%d"],\n'
+                   '        ldflags = [],\n'
+                   '       )\n' % (rules - 1))
+      writeFile(os.path.join(root, name, "BUILD"), "\n".join(build))
+      build_files.append(name + "/BUILD")
+  return build_files
+
+class PhaseTimer(object):
+  def __init__(self):
+    self.phases = []
+    self.nested = {}
+
+  def run(self, name, func, *args):
+    start = time.time()
+    res = func(*args)
+    self.phases.append({"phase": name,
+                        "seconds": time.time() - start,
+                        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    return res
+
+  def wrap(self, module, name):
+    # accumulate the time spent in module.name
+    func = getattr(module, name)
+    self.nested[name] = 0.0
+    def wrapper(*args, **kwargs):
+      start = time.time()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        self.nested[name] += time.time() - start
+    setattr(module, name, wrapper)
+
+def runPhases(root, build_files):
+  """ run in a child process, under the root of the codebase """
+  os.chdir(root)
+  sys.path.insert(0, blade_dir)
+  import build_cache
+  import package as p
+  import pconfig
+
+  timer = PhaseTimer()
+  timer.wrap(p.Package, "readPackage")
+  timer.wrap(p, "emitSideFiles")
+
+  stdout = sys.stdout
+  sys.stdout = file(os.devnull, "w")
+  try:
+    packages = timer.run("load", pconfig.loadPackages, build_files, os.getcwd())
+    timer.run("closures", pconfig.computeClosures)
+    timer.run("dump", lambda: [pkg.dump() for pkg in p.globalPackages.values()])
+    make_file = file("Makefile", "w")
+    timer.run("emit", p.emitMake, packages, make_file)
+    make_file.close()
+    build_cache.save()
+  finally:
+    sys.stdout = stdout
+
+  # split the phases timed around nested ones
+  phases = {}
+  for phase in timer.phases:
+    phases[phase["phase"]] = phase
+  read_time = timer.nested["readPackage"]
+  side_time = timer.nested["emitSideFiles"]
+  res = [
+    {"phase": "read_package", "seconds": read_time,
+     "max_rss_kb": phases["load"]["max_rss_kb"]},
+    {"phase": "expand_rules", "seconds": phases["load"]["seconds"] - read_time,
+     "max_rss_kb": phases["load"]["max_rss_kb"]},
+    phases["closures"],
+    phases["dump"],
+    {"phase": "emit_make", "seconds": phases["emit"]["seconds"] - side_time,
+     "max_rss_kb": phases["emit"]["max_rss_kb"]},
+    {"phase": "side_files", "seconds": side_time,
+     "max_rss_kb": phases["emit"]["max_rss_kb"]},
+  ]
+  rules = sum([len(pkg.ruleList) for pkg in p.globalPackages.values()])
+  return {
+    "phases": res,
+    "total_seconds": sum([a["seconds"] for a in res]),
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "packages": len(p.globalPackages),
+    "rules": rules,
+    "makefile_bytes": os.path.getsize("Makefile"),
+  }
+
+def runScenario(name, config, keep):
+  root = tempfile.mkdtemp(prefix="blade_bench_%s_" % name)
+  try:
+    packages, rules, depth, fanout, proto_chain, glob_srcs, proto_fanout = config
+    build_files = generateCodebase(root, packages, rules, depth, fanout,
+                                   proto_chain, glob_srcs, proto_fanout)
+    result = {
+      "scenario": name,
+      "config": {"packages": packages, "rules_per_package": rules, "depth": depth,
+                 "fanout": fanout, "proto_chain": proto_chain, "glob_srcs": glob_srcs,
+                 "proto_fanout": proto_fanout},
+      "runs": {},
+    }
+    list_file = os.path.join(root, ".bench_build_files")
+    writeFile(list_file, "\n".join(build_files))
+    for run in ["cold", "warm"]:
+      child = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                                "--run_phases", root],
+                               stdout=subprocess.PIPE)
+      out = child.communicate()[0]
+      if child.returncode != 0:
+        print >>sys.stderr, "scenario %s failed in %s run" % (name, run)
+        sys.exit(-1)
+      result["runs"][run] = json.loads(out)
+    return result
+  finally:
+    if keep:
+      print >>sys.stderr, "codebase of scenario %s is kept at %s" % (name, root)
+    else:
+      shutil.rmtree(root)
+
+def gitRevision():
+  try:
+    git = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd=blade_dir,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return git.communicate()[0].strip()
+  except OSError:
+    return ""
+
+def main(argv):
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("--scenario", action="append", default=[],
+                    help="one of %s, can be repeated, all by default" % ", ".join(default_scenarios))
+  parser.add_option("--packages", type="int", help="override number of packages")
+  parser.add_option("--rules", type="int", help="override rules per package")
+  parser.add_option("--depth", type="int", help="override dependency depth")
+  parser.add_option("--fanout", type="int", help="override dependency fan-out")
+  parser.add_option("--proto_chain", type="int", help="override proto_library chain length")
+  parser.add_option("--glob_srcs", action="store_true", default=None,
+                    help="use glob patterns in srcs")
+  parser.add_option("--proto_fanout", type="int",
+                    help="override number of previous proto_library each one depends on")
+  parser.add_option("--output", help="write the json report to this file, instead of stdout")
+  parser.add_option("--keep", action="store_true", default=False,
+                    help="keep the generated codebases")
+  parser.add_option("--run_phases", help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args(argv[1:])
+
+  if options.run_phases:
+    build_files = file(os.path.join(options.run_phases, ".bench_build_files")).read().split()
+    print json.dumps(runPhases(options.run_phases, build_files))
+    return
+
+  names = options.scenario or default_scenarios
+  results = []
+  for name in names:
+    if name not in scenarios:
+      print >>sys.stderr, "unknown scenario: %s" % name
+      sys.exit(-1)
+    config = list(scenarios[name])
+    for i, key in enumerate(["packages", "rules", "depth", "fanout", "proto_chain", "glob_srcs",
+                              "proto_fanout"]):
+      if getattr(options, key) is not None:
+        config[i] = getattr(options, key)
+    print >>sys.stderr, "running scenario %s: %s" % (name, config)
+    results.append(runScenario(name, config, options.keep))
+
+  report = {
+    "revision": gitRevision(),
+    "python": sys.version.split()[0],
+    "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "scenarios": results,
+  }
+  content = json.dumps(report, indent=2, sort_keys=True)
+  if options.output:
+    writeFile(options.output, content + "\n")
+  else:
+    print content
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import cPickle
+import glob
+import hashlib
+import marshal
+import os
+import sys
+
+import dir_index
+import profiler
+
+"""
+Persistent cache of evaluated BUILD files, stored in .blade/build_cache
+
+For each package it keeps:
+  - sha1 of the BUILD file content
+  - the compiled BUILD code object
+  - the rule calls made by the BUILD file, i.e. build names and arguments
+  - the expanded glob patterns of srcs/excludes, and the mtime of every
+    directory read by them
+
+If both the content hash and the directory mtimes match, the package is
+re-created by replaying the rule calls, without executing the BUILD file
+or globbing. If only the content hash matches, the cached code object is
+executed. Otherwise the BUILD file is compiled and executed as before.
+"""
+
+cache_file = ".blade/build_cache"
+
+# bump it when the layout of cache entries changes
+cache_version = 1
+
+_entries = None
+_dirty = False
+
+def _cacheTag():
+  # code objects are only valid for the same python version
+  return (cache_version, sys.version)
+
+def load():
+  global _entries
+  if _entries is not None:
+    return _entries
+  _entries = {}
+  try:
+    p = file(cache_file, "rb")
+    try:
+      tag, entries = cPickle.load(p)
+    finally:
+      p.close()
+    if tag == _cacheTag():
+      _entries = entries
+  except Exception:
+    # no cache or a broken one, start from scratch
+    pass
+  return _entries
+
+def contentHash(content):
+  return hashlib.sha1(content).hexdigest()
+
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+def _globDirs(pattern):
+  """ directories whose listing decides the result of glob.glob(pattern) """
+  dir_name = os.path.dirname(pattern)
+  if not glob.has_magic(dir_name):
+    return [dir_name]
+  # the deepest dir without wildcards, and every dir matching the wildcards
+  parts = dir_name.split("/")
+  prefix = []
+  for a in parts:
+    if glob.has_magic(a): break
+    prefix.append(a)
+  return ["/".join(prefix)] + dir_index.glob(dir_name)
+
+def globFingerprint(patterns):
+  dirs = {}
+  for pattern in patterns:
+    for d in _globDirs(pattern):
+      if d not in dirs:
+        dirs[d] = _mtime(d if d != "" else ".")
+  return dirs
+
+def fingerprintValid(dirs):
+  for d in dirs:
+    if _mtime(d if d != "" else ".") != dirs[d]:
+      return False
+  return True
+
+def lookup(packageName, content_hash):
+  """
+   return (code, entry):
+     code is the cached code object of the BUILD content, or None
+     entry is the cached evaluation of the package, or None if it's stale
+  """
+  entry = load().get(packageName)
+  if entry is None or entry["hash"] != content_hash:
+    return None, None
+  try:
+    code = marshal.loads(entry["code"])
+  except Exception:
+    return None, None
+  if entry["calls"] is None or not fingerprintValid(entry["dirs"]):
+    return code, None
+  return code, entry
+
+def entry(packageName):
+  return load().get(packageName)
+
+def put(packageName, entry):
+  global _dirty
+  entries = load()
+  if entries.get(packageName) != entry:
+    entries[packageName] = entry
+    _dirty = True
+
+def store(pkg, code):
+  """
+   remember the evaluation of pkg. rule calls with arguments that can't
+   be pickled are not cached, only the code object is kept for them.
+  """
+  global _dirty
+  entry = {
+    "hash": pkg.buildHash,
+    "code": marshal.dumps(code),
+    "calls": pkg.ruleCalls,
+    "globs": pkg.Glob,
+    "dirs": globFingerprint(pkg.Glob.keys()),
+  }
+  try:
+    for buildName, kwargs in entry["calls"]:
+      if kwargs is None: raise ValueError("arguments can't be copied")
+    cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL)
+  except Exception:
+    entry["calls"] = None
+    entry["globs"] = {}
+    entry["dirs"] = {}
+  load()[pkg.packageName] = entry
+  _dirty = True
+
+def save():
+  global _dirty
+  if not _dirty:
+    return
+  cache_dir = os.path.dirname(cache_file)
+  if not os.path.exists(cache_dir):
+    os.mkdir(cache_dir)
+  # write to a temp file first, a broken cache must never be read
+  profiler.output(cache_file)
+  tmp_file = cache_file + ".tmp"
+  p = file(tmp_file, "wb")
+  cPickle.dump((_cacheTag(), _entries), p, cPickle.HIGHEST_PROTOCOL)
+  p.close()
+  os.rename(tmp_file, cache_file)
+  _dirty = False
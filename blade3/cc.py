@@ -3,13 +3,15 @@
 
 __author__ = 'liuyong@agora.io(Yong Liu)'
 
-import subprocess
 import sys
 import os
 
+import ninja
 import package
+import profiler
+import recipe
 import rule
-import glob
+import stamp
 from dirs import build_dir
 from dirs import settings_list
 
@@ -20,6 +22,83 @@ It deals with cc_library, cc_binary, cc_lib, cc_test
 emitted_target_names = set()
 emitted_pub_packages = set()
 
+# emit rules of deps while emitting a rule
+emit_deps_make = True
+
+# link libraries of binaries inside -Wl,--start-group and -Wl,--end-group,
+# instead of ordering them, see pconfig.py --link_group
+link_group = False
+
+# prefix compile commands with ${COMPILE_CACHE}, see compile_cache.py
+compile_cache = False
+
+# run archive, link and protoc commands through ${ACTION_CACHE}, see action_cache.py
+action_cache = False
+
+# default number of sources in a unity bundle, 0 for no unity build,
+# see pconfig.py --unity and CCLibrary.compileUnits()
+unity_size = 0
+
+# build libraries of the debug setting as shared libraries, and link binaries
+# of it against them, see pconfig.py --shared_debug
+shared_debug = False
+shared_lib_dir = "shared_libs"
+
+def isShared(settings_name):
+  return shared_debug and settings_name == "debug"
+
+def rpath(settings_name, target_dir):
+  # shared libraries are found relative to the binary, wherever the tree is
+  if not isShared(settings_name):
+    return ""
+  shared_dir = os.path.join(build_dir, settings_name, shared_lib_dir)
+  return "-Wl,-rpath,'$$ORIGIN/%s'" % os.path.relpath(shared_dir, target_dir)
+
+# link the bundled cc_test rules of a package into one runner per setting,
+# see pconfig.py --bundle_tests and TestBundle
+bundle_tests = False
+bundled_test_dir = "bundled_tests"
+
+# unity bundles are kept out of build_dir as the version stamp, so that
+# they survive 'make clean', they are only written at gen_makefile time
+unity_dir = ".blade/unity"
+
+# deps waiting to be emitted by the running emitDepsMake(), and the rule
+# it's emitting, see CCLibrary.emitDepsMake()
+_emit_stack = None
+_emit_current = None
+
+def writeUnitySource(path, members):
+  """ write a unity bundle, keep it untouched if its members aren't changed """
+  content = "// Do NOT modify this file. It's auto-generated by gen_makefile.\n"
+  for member in members:
+    content += '#include "%s"\n' % member
+  profiler.output(path)
+  try:
+    if file(path).read() == content:
+      return
+  except IOError:
+    pass
+
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  p = file(path, "w")
+  p.write(content)
+  p.close()
+
+def actionCache(outputs, inputs=[]):
+  """ prefix of a command, to run it through the action cache if it's enabled """
+  if not action_cache:
+    return ""
+  args = ["-o %s" % a for a in outputs] + ["-i %s" % a for a in inputs]
+  return "${ACTION_CACHE} %s -- " % " ".join(args)
+
+def actionCacheVariables(outputs, inputs=[]):
+  # $launcher of ninja rules ar and protoc
+  if not action_cache:
+    return []
+  return [("launcher", actionCache(outputs, inputs))]
+
 def simplifyDepList(dep_list):
   """去除 DepList 中的重复项.
      由于 gnu linker 要求只能前面的项依赖后面的项
@@ -35,6 +114,91 @@ def simplifyDepList(dep_list):
   res.reverse()
   return res
 
+def visitDepsFirst(rules, is_done, visit):
+  """
+   call visit(rule) for rules and all rules they depend on, in topological
+   order (deps first), skipping rules for which is_done(rule) is true.
+   it's iterative, so deep dependency chains don't hit the recursion limit.
+  """
+  stack = [(r, False) for r in reversed(rules)]
+  while stack:
+    r, deps_done = stack.pop()
+    if is_done(r):
+      continue
+    if deps_done:
+      visit(r)
+      continue
+    stack.append((r, True))
+    for dep in reversed(r.depRulesList):
+      if not is_done(dep):
+        stack.append((dep, False))
+
+def resolveLinkOrder(rules, own_items):
+  """
+   items returned by own_items(r) for rules and all rules they depend on,
+   in GNU ld order, i.e. a library comes before the libraries it depends on.
+
+   the order is the same as concatenating the lists of rules recursively,
+   own items first, and keeping the last occurrence of each item with
+   simplifyDepList(). That list reversed is the post-order of a depth first
+   walk which visits deps in reverse order, with the first occurrence of
+   each item kept, so it's built in one pass over the closure.
+   rules which don't export their deps to the linker add nothing.
+  """
+  res = []
+  seen = set()
+  visited = set()
+  # popped from the end, so the last rule is walked first
+  stack = [(r, False) for r in rules]
+  while stack:
+    r, deps_done = stack.pop()
+    if deps_done:
+      for item in reversed(own_items(r)):
+        if item not in seen:
+          seen.add(item)
+          res.append(item)
+      continue
+    if r in visited:
+      continue
+    visited.add(r)
+    if not r.exports_dep_libs:
+      continue
+    stack.append((r, True))
+    for dep in r.depRulesList:
+      if dep not in visited:
+        stack.append((dep, False))
+  res.reverse()
+  return res
+
+def collectLibs(rules, own_items):
+  """
+   the same items as resolveLinkOrder(), in the order they are found,
+   for linking inside --start-group/--end-group where order doesn't matter
+  """
+  res = []
+  seen = set()
+  visited = set()
+  stack = list(reversed(rules))
+  while stack:
+    r = stack.pop()
+    if r in visited:
+      continue
+    visited.add(r)
+    if not r.exports_dep_libs:
+      continue
+    for item in own_items(r):
+      if item not in seen:
+        seen.add(item)
+        res.append(item)
+    stack.extend(reversed(r.depRulesList))
+  return res
+
+def computePBHeaderClosures(rules):
+  """ build the generated proto headers needed by rules and their deps """
+  visitDepsFirst(rules,
+                 lambda r: r.pbHeaderPathSet is not None,
+                 lambda r: r.buildPBHeaderClosure())
+
 class CCLibrary(rule.Rule):
   """
    create a cpp library with libname.a
@@ -45,10 +209,20 @@ class CCLibrary(rule.Rule):
               cflags = ["", ""],
               cxxflags = ["", ""],
               exclude = ["", ""],
+              unity = 0,
+              unity_excludes = ["", ""],
+              pch = "",
              )
+   unity = N compiles the .cc sources in bundles of N, except the ones in
+   unity_excludes, i.e. sources with conflicting static names or macros.
+   pch = "foo_pch.h" precompiles the header once per setting, and forces it
+   to be included by the C++ sources, see pchStub().
   """
   buildName = "cc_library"
 
+  # False if the rule exports neither itself nor its deps to the linker
+  exports_dep_libs = True
+
   def __init__(self, **kwargs):
     if "name" not in kwargs:
       print >> sys.stderr, "Must have a 'name' argument, see %s/BUILD " \
@@ -70,6 +244,11 @@ class CCLibrary(rule.Rule):
     else:
       self.depsList = []
     self.depRulesList = []
+    # (list name, settings) => libraries, see linkOrder()
+    self.linkOrders = {}
+    self.pbHeaderPathSet = None
+    self.pbHeaderPaths = None
+    self.protoTargets = None
     self.package.addRule(self)
     self.checkArguments("deps", self.depsList)
 
@@ -98,14 +277,6 @@ class CCLibrary(rule.Rule):
       self.cxxflags = kwargs["cxxflags"]
     else:
       self.cxxflags = []
-
-    git = subprocess.Popen(["git", "describe", "--tags", "--always"],
-                           cwd="media_server_balancer", stdout=subprocess.PIPE)
-
-    version = git.stdout.read().strip()
-
-    self.cxxflags.append('-DGIT_DESC=\\\"%s\\"' %version)
-
     self.checkArguments("cxxflags", self.cxxflags)
 
     # TODO(liuyong): 这个检查没有生效, 因为 self.buildName 的值不对
@@ -128,6 +299,28 @@ class CCLibrary(rule.Rule):
     for flag in self.cflags + self.cxxflags:
       self.compile_flags += "%s " % flag
 
+    self.unity = unity_size
+    if "unity" in kwargs:
+      self.unity = kwargs["unity"]
+      if type(self.unity) != type(0) or self.unity < 0:
+        print "The parameter 'unity' of //%s/BUILD:%s must be a number of sources" \
+            % (self.package.packageName, self.ruleName)
+        sys.exit(-1)
+    self.unity_excludes = []
+    if "unity_excludes" in kwargs:
+      self.unity_excludes = kwargs["unity_excludes"]
+    self.checkArguments("unity_excludes", self.unity_excludes)
+    self.unity_excludes = self.expandFileList(self.unity_excludes, True)
+    self.units = None
+
+    self.pch = None
+    if "pch" in kwargs:
+      if type(kwargs["pch"]) != type(""):
+        print "The parameter 'pch' of //%s/BUILD:%s must be a header" \
+            % (self.package.packageName, self.ruleName)
+        sys.exit(-1)
+      self.pch = self.expandFileList([kwargs["pch"]], False)[0]
+
   def checkBaseName(self, src_list):
     c_or_cc = {}
     for f in src_list:
@@ -178,13 +371,15 @@ class CCLibrary(rule.Rule):
     res = []
     for f in file_list:
       fullPath = os.path.join(self.package.packageName, f)
-      matched = glob.glob(fullPath)
+      matched = self.package.glob(fullPath)
       if not allow_not_found and len(matched) == 0:
         print "Source file '%s' of '//%s/BUILD:%s' doesn't exists" \
             %(f, self.package.packageName, self.ruleName)
         sys.exit(-1)
 
-      res += [os.path.relpath(a, self.package.packageName) for a \
+      prefix = self.package.packageName + "/"
+      res += [(a[len(prefix):] if a.startswith(prefix) \
+               else os.path.relpath(a, self.package.packageName)) for a \
               in matched]
     return res
 
@@ -227,8 +422,43 @@ class CCLibrary(rule.Rule):
     return os.path.join(self.targetRootDir(settings_name), self.package.packageName)
 
   def libraryPath(self, settings_name):
+    if isShared(settings_name):
+      return self.sharedLibraryPath(settings_name)
     return os.path.join(self.targetDir(settings_name), self.libraryName())
 
+  def sharedLibraryPath(self, settings_name):
+    # all in one dir with names unique in the codebase, the dir is the rpath of binaries
+    return os.path.join(build_dir, settings_name, shared_lib_dir, "lib%s_%s.so"
+                        % (self.package.packageName.replace("/", "_"), self.ruleName.lower()))
+
+  def archiveCommand(self, settings_name):
+    # deps of a shared library are left undefined, binaries link them all
+    if isShared(settings_name):
+      return "${%s_CXX} -shared -Wl,-soname,%s -o %s %s" \
+          % (settings_name.upper(), os.path.basename(self.makeTargetName(settings_name)),
+             self.makeTargetName(settings_name), self.objectPathList(settings_name))
+    return "${AR} %s %s" % (self.makeTargetName(settings_name),
+                            self.objectPathList(settings_name))
+
+  def emitArchiveMake(self, f, settings_name):
+    target_dir = os.path.dirname(self.makeTargetName(settings_name))
+    recipe.action(f, "_____link [%s]" % self.makeTargetName(settings_name))
+    print >>f, "\t%s%s" % (actionCache([self.makeTargetName(settings_name)]),
+                           self.archiveCommand(settings_name))
+    print >>f, "\n"
+    recipe.outputDirs(f, [self.makeTargetName(settings_name)], [target_dir])
+
+  def emitArchiveNinja(self, f, settings_name):
+    if isShared(settings_name):
+      ninja.build(f, [self.makeTargetName(settings_name)], "link",
+                  self.objectPathList(settings_name).split(),
+                  variables=[("cmd", actionCache([self.makeTargetName(settings_name)])
+                              + self.archiveCommand(settings_name))])
+      return
+    ninja.build(f, [self.makeTargetName(settings_name)], "ar",
+                self.objectPathList(settings_name).split(),
+                variables=actionCacheVariables([self.makeTargetName(settings_name)]))
+
   def makeTargetName(self, settings_name):
     # the make rule target of this build rule
     return self.libraryPath(settings_name)
@@ -246,12 +476,31 @@ class CCLibrary(rule.Rule):
     # the make rule target of this build rule
     return self.pubLibraryPath(settings_name)
 
-  def exportLibNameList(self):
+  def ownLibNameList(self):
     # such as ["base"] for libbase.a
-    res = [self.ruleName]
-    for dep in self.depRulesList:
-      res = res + dep.exportLibNameList()
-    return simplifyDepList(res)
+    return [self.ruleName]
+
+  def ownLibPathList(self, settings_name):
+    # such as ["build/base/libbase.a"] for base rule on package base
+    if self.package.isPubOnly:
+      return [self.pubLibraryPath(settings_name)]
+    return [self.libraryPath(settings_name)]
+
+  def ownLibDirList(self, settings_name):
+    # such as ["build/base"] or ["build/debug"]
+    return [os.path.join(build_dir, settings_name, "targets", self.package.packageName)]
+
+  def linkOrder(self, name, settings_name, rules, own_items):
+    key = (name, settings_name)
+    if key not in self.linkOrders:
+      self.linkOrders[key] = resolveLinkOrder(rules, own_items)
+    return self.linkOrders[key]
+
+  # NOTE: lists below are cached, callers must not modify them
+  def exportLibNameList(self):
+    # lib names don't depend on settings, any one of them will do
+    return self.linkOrder("names", settings_list[0], [self],
+                          lambda r: r.ownLibNameList())
 
   def depPackageNames(self):
     res = set()
@@ -259,10 +508,11 @@ class CCLibrary(rule.Rule):
       res.add(dep.package.packageName)
     return " ".join(res)
 
-  def depPBHeaderPathSet(self):
+  def buildPBHeaderClosure(self):
+    # closures of all deps must have been built
     res = set()
     for dep in self.depRulesList:
-      res = res | dep.depPBHeaderPathSet()
+      res = res | dep.pbHeaderPathSet
       if dep.is_proto:
         res = res | dep.genHeaderPathSet()
       # if dep.is_proto:
@@ -270,31 +520,34 @@ class CCLibrary(rule.Rule):
       #   res = res | dep.depPBHeaderPathSet()
       # else:
       #   res = res | dep.depPBHeaderPathSet()
-    return res
+    self.pbHeaderPathSet = res
+    self.pbHeaderPaths = " ".join(res)
+
+  def depPBHeaderPathSet(self):
+    # cached, callers must not modify it
+    if self.pbHeaderPathSet is None:
+      computePBHeaderClosures([self])
+    return self.pbHeaderPathSet
+
+  def depPBHeaderPaths(self):
+    # the set above joined as make prerequisites
+    if self.pbHeaderPaths is None:
+      computePBHeaderClosures([self])
+    return self.pbHeaderPaths
 
   def exportLibPathList(self, settings_name):
-    # such as ["build/base/libbase.a"] for base rule on package base
-    if self.package.isPubOnly:
-      res = [self.pubLibraryPath(settings_name)]
-    else:
-      res = [self.libraryPath(settings_name)]
-    for dep in self.depRulesList:
-      res = res + dep.exportLibPathList(settings_name)
-    return simplifyDepList(res)
+    # own library followed by libraries of all deps, in linking order
+    return self.linkOrder("paths", settings_name, [self],
+                          lambda r: r.ownLibPathList(settings_name))
 
   def depLibPathList(self, settings_name):
-    # such as ["build/base/libbase.a"] for base rule on package base
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibPathList(settings_name)
-    return simplifyDepList(res)
+    # libraries of all deps, in linking order
+    return self.linkOrder("dep_paths", settings_name, self.depRulesList,
+                          lambda r: r.ownLibPathList(settings_name))
 
   def exportLibDirList(self, settings_name):
-    # such as ["build/base"] or ["build/debug"]
-    res = [os.path.join(build_dir, settings_name, "targets", self.package.packageName)]
-    for dep in self.depRulesList:
-      res = res + dep.exportLibDirList(settings_name)
-    return simplifyDepList(res)
+    return self.linkOrder("dirs", settings_name, [self],
+                          lambda r: r.ownLibDirList(settings_name))
 
   def objectRoot(self, settings_name):
     # such as "bulid/base/objs"
@@ -316,11 +569,36 @@ class CCLibrary(rule.Rule):
   def objectPathList(self, settings_name):
     # such as ["build/base/objs/base/t.o", "build/base/objs/base/s.o"]
     pathList = ""
-    for src in self.srcsList:
-      obj = os.path.splitext(src)[0] + ".o"
+    for src, obj, members in self.compileUnits():
       pathList = "%s %s" % (pathList, self.objectPath(obj, settings_name))
     return pathList
 
+  def compileUnits(self):
+    """
+     [(source, object name, member sources)] to compile. without unity, each
+     source is compiled alone. with unity = N, the .cc sources are included
+     by bundles of N, the bundles are written here if their members change.
+    """
+    if self.units is not None:
+      return self.units
+    self.units = []
+    members = []
+    for src in self.srcsList:
+      if self.unity > 1 and os.path.splitext(src)[1] in (".cc", ".cpp") \
+          and src not in self.unity_excludes:
+        members.append(self.srcPath(src))
+      else:
+        self.units.append((self.srcPath(src), os.path.splitext(src)[0] + ".o", []))
+    # sorted, so that a new source only moves the bundles after it
+    members.sort()
+    for i in range(0, len(members), max(self.unity, 1)):
+      bundle = members[i:i + self.unity]
+      src = os.path.join(unity_dir, self.package.packageName,
+                         "%s_unity_%d.cc" % (self.ruleName, i / self.unity))
+      writeUnitySource(src, bundle)
+      self.units.append((src, "%s_unity_%d.o" % (self.ruleName, i / self.unity), bundle))
+    return self.units
+
   def srcPath(self, fileName):
     # such as "base/t.cc"
     return os.path.join(self.package.packageName, fileName)
@@ -342,28 +620,85 @@ class CCLibrary(rule.Rule):
       res = res + " %s" % " ".join(sorted(set(self.cxxflags)))
 
     # res += " ${WARN_AS_ERROR}"
+    if compile_cache:
+      res = "${COMPILE_CACHE} " + res
     return res
 
   def protoTarget(self):
-    res = ""
-    for dep in self.depRulesList:
-      if dep.is_proto == 1:
-        res += "%s " % dep.makeProtoTarget()
-    return res
+    if self.protoTargets is None:
+      res = ""
+      for dep in self.depRulesList:
+        if dep.is_proto == 1:
+          res += "%s " % dep.makeProtoTarget()
+      self.protoTargets = res
+    return self.protoTargets
+
+  def pchStub(self, settings_name):
+    """
+     such as ".build/debug/pch/base/rule/foo_pch.h", it includes the pch
+     header. sources are compiled with -include of it, gcc uses the .gch next
+     to it if the .gch is valid, and falls back to the stub otherwise
+    """
+    return os.path.join(build_dir, settings_name, "pch", self.package.packageName,
+                        self.ruleName, os.path.basename(self.pch))
+
+  def pchPath(self, settings_name):
+    return self.pchStub(settings_name) + ".gch"
+
+  def pchDeps(self, src, settings_name):
+    # the precompiled header is C++, .c sources don't use it
+    if self.pch is None or src.endswith(".c"):
+      return []
+    return [self.pchPath(settings_name)]
+
+  def pchFlags(self, src, settings_name):
+    if len(self.pchDeps(src, settings_name)) == 0:
+      return ""
+    return " -Winvalid-pch -include %s" % self.pchStub(settings_name)
+
+  def pchStubCommand(self, settings_name):
+    # the stub has a rule of its own, it's written once, not before every precompile
+    return "echo '#include \"%s\"' > %s" % (self.srcPath(self.pch), self.pchStub(settings_name))
+
+  def pchCommand(self, settings_name):
+    # the same flags as the sources, gcc refuses the .gch otherwise
+    return "%s -x c++-header" % self.compileTool(self.pch, settings_name)
+
+  def emitPchMake(self, f):
+    if self.pch is None:
+      return
+    for settings_name in settings_list:
+      stub = self.pchStub(settings_name)
+      pch_dir = os.path.dirname(stub)
+      print >>f, "%s:" % stub
+      print >>f, "\t%s" % self.pchStubCommand(settings_name)
+      print >>f, "\n"
+      recipe.outputDirs(f, [stub], [pch_dir])
+      print >>f, "%s: %s %s %s" % (self.pchPath(settings_name), self.protoTarget(),
+                                   self.srcPath(self.pch), stub)
+      recipe.action(f, "_____precompile %s %s" % (settings_name, self.srcPath(self.pch)))
+      print >>f, "\t%s -MF %s.d -o %s -c %s" % (self.pchCommand(settings_name),
+                                                self.pchPath(settings_name),
+                                                self.pchPath(settings_name), stub)
+      print >>f, "\n"
+      print >>f, "-include %s.d" % self.pchPath(settings_name)
+      print >>f, "\n"
 
   def emitSrcMake(self, f):
-    for src in self.srcsList:
+    self.emitPchMake(f)
+    for src, obj, members in self.compileUnits():
       for settings_name in settings_list:
-        obj = os.path.splitext(src)[0] + ".o"
-        depfile = os.path.splitext(src)[0] + ".d"
+        depfile = os.path.splitext(obj)[0] + ".d"
         obj_dir = os.path.dirname(self.objectPath(obj, settings_name))
-        print >>f, "%s: %s %s" % (self.objectPath(obj, settings_name), self.protoTarget(), self.srcPath(src))
-        print >>f, '\t@${PRINT} "_____compile %s %s"' % (settings_name, self.srcPath(src))
-        print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (obj_dir, obj_dir)
-        print >>f, "\t%s -o %s -c %s" % (self.compileTool(src, settings_name),
-                                         self.objectPath(obj, settings_name),
-                                         self.srcPath(src))
+        print >>f, "%s: %s %s" % (self.objectPath(obj, settings_name), self.protoTarget(),
+                                  " ".join([src] + members + self.pchDeps(src, settings_name)))
+        recipe.action(f, "_____compile %s %s" % (settings_name, src))
+        print >>f, "\t%s%s -o %s -c %s" % (self.compileTool(src, settings_name),
+                                           self.pchFlags(src, settings_name),
+                                           self.objectPath(obj, settings_name),
+                                           src)
         print >>f, "\n"
+        recipe.outputDirs(f, [self.objectPath(obj, settings_name)], [obj_dir])
         print >>f, "-include %s" % self.objectPath(depfile, settings_name)
         print >>f, "\n"
 
@@ -374,28 +709,34 @@ class CCLibrary(rule.Rule):
     if self.is_proto: return
     if self.is_data: return
 
+    # the object compiling each source, its bundle's with unity
+    unit_objs = {}
+    for unit_src, obj, members in self.compileUnits():
+      for member in members or [unit_src]:
+        unit_objs[member] = obj
+
     all_static_check_result = []
     static_check_root_dir = build_dir + "/static_check"
     for src in self.srcsList:
       # for static check
       check_result_file = static_check_root_dir + "/" + self.srcPath(src)
       static_check_dir = os.path.dirname(check_result_file)
-      obj = os.path.splitext(src)[0] + ".o"
+      obj = unit_objs[self.srcPath(src)]
       print >>f, "%s: %s" % (check_result_file, self.objectPath(obj, settings_list[0]))
-      print >>f, '\t@${PRINT} "_____static_check %s"' % self.srcPath(src)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (static_check_dir, static_check_dir)
+      recipe.action(f, "_____static_check %s" % self.srcPath(src))
       print >>f, "\t${STATIC_CHECKER} %s" % (self.srcPath(src))
       print >>f, "\t@touch %s" % check_result_file
       print >>f, "\n"
+      recipe.outputDirs(f, [check_result_file], [static_check_dir])
       all_static_check_result.append(check_result_file)
 
     # all static checking
     check_result_file = self.staticCheckTarget()
     static_check_dir = os.path.dirname(check_result_file)
     print >>f, "%s: %s" % (check_result_file, " ".join(all_static_check_result))
-    print >>f, "\t@if [ ! -x %s ]; then mkdir -p %s; fi" % (static_check_dir, static_check_dir)
     print >>f, "\t@touch %s" % check_result_file
     print >>f, "\n"
+    recipe.outputDirs(f, [check_result_file], [static_check_dir])
 
   def emitSelfMake(self, f):
     self.emitSrcMake(f)
@@ -403,13 +744,9 @@ class CCLibrary(rule.Rule):
     for settings_name in settings_list:
       print >>f, "%s: %s %s %s" % (self.makeTargetName(settings_name),
                                 self.depPackageNames(),
-                                " ".join(self.depPBHeaderPathSet()),
+                                self.depPBHeaderPaths(),
                                 self.objectPathList(settings_name))
-      print >>f, '\t@${PRINT} "_____link [%s]"' % self.makeTargetName(settings_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" \
-          % (self.targetDir(settings_name), self.targetDir(settings_name))
-      print >>f, "\t${AR} %s %s" % (self.makeTargetName(settings_name), self.objectPathList(settings_name))
-      print >>f, "\n"
+      self.emitArchiveMake(f, settings_name)
 
   def getDepLayoutFiles(self, setting):
     targets = []
@@ -424,25 +761,44 @@ class CCLibrary(rule.Rule):
       pubDir = "pub/src/" + packageDir
       parentDir = os.path.abspath(os.path.dirname(packageDir))
       print >>f, "%s: %s" % (packageDir, pubDir)
-      print >>f, '\t@${PRINT} "_____symbolic link [%s]"' % packageDir
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (parentDir, parentDir)
+      recipe.action(f, "_____symbolic link [%s]" % packageDir)
       print >>f, "\tln -f -s -t %s %s" % (parentDir, os.path.relpath(pubDir, parentDir))
       print >>f, "\n"
+      recipe.outputDirs(f, [packageDir], [parentDir])
 
     for settings_name in settings_list:
       print >>f, "%s: %s %s" % (self.makeTargetName(settings_name), packageDir,
                                 self.pubMakeTargetName(settings_name))
-      print >>f, '\t@${PRINT} "_____symbolic link [%s]"' % self.makeTargetName(settings_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (self.targetDir(settings_name),
-                                                             self.targetDir(settings_name))
+      recipe.action(f, "_____symbolic link [%s]" % self.makeTargetName(settings_name))
       print >>f, "\tln -f -s -t %s %s" % (self.targetDir(settings_name),
                                           os.path.relpath(self.pubMakeTargetName(settings_name),
                                                           self.targetDir(settings_name)))
       print >>f, "\n"
+      recipe.outputDirs(f, [self.makeTargetName(settings_name)], [self.targetDir(settings_name)])
+
+  def emitDepsMake(self, f):
+    """
+     emit rules of deps, depth first in the order of deps. it's called at
+     the end of emitMake(), so deps of a rule emitted by the loop below are
+     pushed to its stack instead of recursing, long dependency chains don't
+     hit the recursion limit.
+    """
+    global _emit_stack, _emit_current
+    # in incremental mode, each rule is emitted to the fragment of its own package
+    if not emit_deps_make:
+      return
+    if _emit_stack is not None and _emit_current is self:
+      _emit_stack.extend(reversed(self.depRulesList))
+      return
 
-  def emitDependencies(self, f):
-    for dep in self.depRulesList:
-      dep.emitDependencies(f)
+    saved = (_emit_stack, _emit_current)
+    _emit_stack = list(reversed(self.depRulesList))
+    try:
+      while len(_emit_stack) > 0:
+        _emit_current = _emit_stack.pop()
+        _emit_current.emitMake(f)
+    finally:
+      _emit_stack, _emit_current = saved
 
   def emitMake(self, f):
     self.checkSrcs()
@@ -457,10 +813,54 @@ class CCLibrary(rule.Rule):
     else:
       self.emitSelfMake(f)
 
+    self.emitDepsMake(f)
+
+  def ninjaOrderOnly(self):
+    # generated proto headers and pub package dirs must exist before compiling
+    res = sorted(self.depPBHeaderPathSet())
     for dep in self.depRulesList:
-      dep.emitMake(f)
+      if dep.package.isPubOnly and dep.package.packageName not in res:
+        res.append(dep.package.packageName)
+    return res
+
+  def emitSrcNinja(self, f):
+    order_only = self.ninjaOrderOnly()
+    if self.pch is not None:
+      for settings_name in settings_list:
+        ninja.build(f, [self.pchStub(settings_name)], "gen_rule", [],
+                    variables=[("cmd", self.pchStubCommand(settings_name))])
+        ninja.build(f, [self.pchPath(settings_name)], "pch", [self.pchStub(settings_name)],
+                    implicit=[self.srcPath(self.pch)], order_only=order_only,
+                    variables=[("cmd", self.pchCommand(settings_name)),
+                               ("header", self.srcPath(self.pch))])
+    for src, obj, members in self.compileUnits():
+      for settings_name in settings_list:
+        ninja.build(f, [self.objectPath(obj, settings_name)], "cc", [src],
+                    implicit=members + self.pchDeps(src, settings_name), order_only=order_only,
+                    variables=[("cmd", self.compileTool(src, settings_name)
+                                + self.pchFlags(src, settings_name))])
+
+  def emitSelfNinja(self, f):
+    self.emitSrcNinja(f)
+    for settings_name in settings_list:
+      self.emitArchiveNinja(f, settings_name)
 
-    self.emitDependencies(f)
+  def emitPubNinja(self, f):
+    ninja.emitPubPackageDir(f, self.package.packageName)
+    for settings_name in settings_list:
+      ninja.build(f, [self.makeTargetName(settings_name)], "symlink",
+                  [self.pubMakeTargetName(settings_name)],
+                  implicit=[self.package.packageName],
+                  variables=[("dir", self.targetDir(settings_name)),
+                             ("target", os.path.relpath(self.pubMakeTargetName(settings_name),
+                                                        self.targetDir(settings_name)))])
+
+  def emitNinja(self, f):
+    self.checkSrcs()
+    if self.package.isPubOnly:
+      self.emitPubNinja(f)
+    else:
+      self.emitSelfNinja(f)
 
 class CCBinary(CCLibrary):
   """
@@ -503,23 +903,39 @@ class CCBinary(CCLibrary):
     # such as "build/base/base_bin"
     return os.path.join(build_dir, settings_name, "targets", self.package.packageName, self.ruleName)
 
-  def exportLibNameList(self):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibNameList()
-    return simplifyDepList(res)
-
-  def exportLibPathList(self, settings_name):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibPathList(settings_name)
-    return simplifyDepList(res)
-
-  def exportLibDirList(self, settings_name):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibDirList(settings_name)
-    return simplifyDepList(res)
+  def ownLibNameList(self):
+    return []
+
+  def ownLibPathList(self, settings_name):
+    return []
+
+  def ownLibDirList(self, settings_name):
+    return []
+
+  def linkLibPathList(self, settings_name):
+    # libraries to link, in any order if they are linked as a group
+    if not link_group:
+      return self.exportLibPathList(settings_name)
+    key = ("group", settings_name)
+    if key not in self.linkOrders:
+      self.linkOrders[key] = collectLibs([self], lambda r: r.ownLibPathList(settings_name))
+    return self.linkOrders[key]
+
+  def linkLibraries(self, settings_name):
+    libs = " ".join(self.linkLibPathList(settings_name))
+    if link_group and len(libs) > 0:
+      return "-Wl,--start-group %s -Wl,--end-group" % libs
+    return libs
+
+  def linkCommand(self, settings_name):
+    return "%s${%s_CXX} %s %s %s %s ${%s_LDFLAGS} %s %s -o %s" \
+        % (actionCache([self.makeTargetName(settings_name)]),
+           settings_name.upper(), self.objectPathList(settings_name),
+           stamp.stampObjectPath(settings_name),
+           self.linkLibraries(settings_name),
+           self.getLinkerFlags(), settings_name.upper(),
+           rpath(settings_name, self.targetDir(settings_name)), "",
+           self.makeTargetName(settings_name))
 
   def emitSrcMake(self, f):
     CCLibrary.emitSrcMake(self, f)
@@ -549,25 +965,32 @@ class CCBinary(CCLibrary):
 
     for settings_name in settings_list:
       # meta_obj = ".build/%s/meta_objs/%s/%s.o" % (settings_name, self.package.packageName, self.ruleName)
-      print >>f, "%s: %s %s %s %s" % (self.makeTargetName(settings_name),
-                                         self.depPackageNames(),
-                                         " ".join(self.depPBHeaderPathSet()),
-                                         self.objectPathList(settings_name),
-                                         " ".join(self.exportLibPathList(settings_name)))
-      print >>f, '\t@${PRINT} "_____link [%s]"' % self.makeTargetName(settings_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" \
-          % (self.targetDir(settings_name), self.targetDir(settings_name))
-      print >>f, "\t${%s_CXX} %s %s %s ${%s_LDFLAGS} %s %s -o %s" \
-          % (settings_name.upper(), self.objectPathList(settings_name),
-             " ".join(self.exportLibPathList(settings_name)),
-             self.getLinkerFlags(), settings_name.upper(),
-             "", "", self.makeTargetName(settings_name))
+      # a changed shared library doesn't relink binaries, they only need it to exist
+      print >>f, "%s: %s %s %s %s %s%s" % (self.makeTargetName(settings_name),
+                                           self.depPackageNames(),
+                                           self.depPBHeaderPaths(),
+                                           self.objectPathList(settings_name),
+                                           stamp.stampObjectPath(settings_name),
+                                           "| " if isShared(settings_name) else "",
+                                           " ".join(self.linkLibPathList(settings_name)))
+      recipe.action(f, "_____link [%s]" % self.makeTargetName(settings_name))
+      print >>f, "\t%s" % self.linkCommand(settings_name)
       print >>f, "\n"
+      recipe.outputDirs(f, [self.makeTargetName(settings_name)], [self.targetDir(settings_name)])
 
-    for dep in self.depRulesList:
-      dep.emitMake(f)
+    self.emitDepsMake(f)
 
-    self.emitDependencies(f)
+  def emitNinja(self, f):
+    self.emitSrcNinja(f)
+    for settings_name in settings_list:
+      inputs = self.objectPathList(settings_name).split() + [stamp.stampObjectPath(settings_name)]
+      libs = self.linkLibPathList(settings_name)
+      if isShared(settings_name):
+        ninja.build(f, [self.makeTargetName(settings_name)], "link", inputs, order_only=libs,
+                    variables=[("cmd", self.linkCommand(settings_name))])
+      else:
+        ninja.build(f, [self.makeTargetName(settings_name)], "link", inputs + libs,
+                    variables=[("cmd", self.linkCommand(settings_name))])
 
 class CCJNILibrary(CCLibrary):
   """
@@ -634,19 +1057,38 @@ class CCTest(CCBinary):
    cc_test(name = "",
            srcs = ["", ""],
            deps = ["", ""],
+           bundle = True,
           )
+   bundle = False keeps the test out of the runner of its package, i.e. a
+   test with a main() of its own or static state conflicting with other
+   tests, see pconfig.py --bundle_tests and TestBundle.
   '''
   buildName = "cc_test"
 
   def __init__(self, **kwargs):
     CCBinary.__init__(self, **kwargs)
     self.is_unittest = 1
+
+    self.bundle = True
+    if "bundle" in kwargs:
+      self.bundle = kwargs["bundle"]
+      if type(self.bundle) != type(True):
+        print "The parameter 'bundle' of //%s/BUILD:%s must be True or False" \
+            % (self.package.packageName, self.ruleName)
+        sys.exit(-1)
+
     for flags in self.ldflags:
       if flags == "-lgtest":
         return
 
     self.ldflags.append("-lgtest")
 
+  def getLinkerFlags(self):
+    # without a main() of its own, a bundled test links alone as in its runner
+    if bundle_tests and self.bundle:
+      return "-lgtest_main " + CCBinary.getLinkerFlags(self)
+    return CCBinary.getLinkerFlags(self)
+
   def dump(self):
     print "\ttest: ", self.ruleName
     for src in self.srcsList:
@@ -655,6 +1097,116 @@ class CCTest(CCBinary):
       print "\t\tdeps on: //%s/BUILD:%s" % (rule.package.packageName, rule.ruleName)
 
 
+def bundleTests(rules):
+  """ a TestBundle of each package with more than one bundled cc_test in rules """
+  tests = {}
+  packageNames = []
+  for r in rules:
+    if r.is_unittest != 1 or not getattr(r, "bundle", False):
+      continue
+    if r.package.packageName not in tests:
+      tests[r.package.packageName] = []
+      packageNames.append(r.package.packageName)
+    if r not in tests[r.package.packageName]:
+      tests[r.package.packageName].append(r)
+  return [TestBundle(a, tests[a]) for a in packageNames if len(tests[a]) > 1]
+
+class TestBundle(object):
+  """
+   the bundled cc_test rules of a package linked into one runner per
+   setting, so that the dependency closure they share is linked once
+   instead of once per test. main() comes from gtest_main, the objects of
+   the tests register their cases with gtest. test_bundle.py runs it and
+   reports the results of each rule.
+  """
+  def __init__(self, packageName, tests):
+    self.packageName = packageName
+    self.tests = tests
+    self.linkOrders = {}
+
+  def makeTargetName(self, settings_name):
+    # such as ".build/debug/bundled_tests/base/runner"
+    return os.path.join(build_dir, settings_name, bundled_test_dir, self.packageName, "runner")
+
+  def targetDir(self, settings_name):
+    return os.path.dirname(self.makeTargetName(settings_name))
+
+  def objectPathList(self, settings_name):
+    return " ".join([r.objectPathList(settings_name).strip() for r in self.tests])
+
+  def depPackageNames(self):
+    return " ".join(simplifyDepList(" ".join([r.depPackageNames() for r in self.tests]).split()))
+
+  def depPBHeaderPaths(self):
+    return " ".join(simplifyDepList(" ".join([r.depPBHeaderPaths() for r in self.tests]).split()))
+
+  def linkLibPathList(self, settings_name):
+    # libraries of all tests, as if they were deps of one binary
+    key = (link_group, settings_name)
+    if key not in self.linkOrders:
+      if link_group:
+        self.linkOrders[key] = collectLibs(self.tests, lambda r: r.ownLibPathList(settings_name))
+      else:
+        self.linkOrders[key] = resolveLinkOrder(self.tests, lambda r: r.ownLibPathList(settings_name))
+    return self.linkOrders[key]
+
+  def linkLibraries(self, settings_name):
+    libs = " ".join(self.linkLibPathList(settings_name))
+    if link_group and len(libs) > 0:
+      return "-Wl,--start-group %s -Wl,--end-group" % libs
+    return libs
+
+  def getLinkerFlags(self):
+    # gtest_main before gtest, which it depends on
+    ldflags = ["-lgtest_main"]
+    for r in self.tests:
+      ldflags.extend(r.ldflags)
+    return " ".join(simplifyDepList(ldflags)) + " "
+
+  def linkCommand(self, settings_name):
+    return "%s${%s_CXX} %s %s %s %s ${%s_LDFLAGS} %s %s -o %s" \
+        % (actionCache([self.makeTargetName(settings_name)]),
+           settings_name.upper(), self.objectPathList(settings_name),
+           stamp.stampObjectPath(settings_name),
+           self.linkLibraries(settings_name),
+           self.getLinkerFlags(), settings_name.upper(),
+           rpath(settings_name, self.targetDir(settings_name)), "",
+           self.makeTargetName(settings_name))
+
+  def runCommand(self, settings_name):
+    # the rule of each source, to report the results per rule
+    rules = ["//%s/BUILD:%s=%s" % (r.package.packageName, r.ruleName,
+                                   ",".join([r.srcPath(a) for a in r.srcsList]))
+             for r in self.tests]
+    return "${TEST_BUNDLE} %s %s --" % (self.makeTargetName(settings_name), " ".join(rules))
+
+  def emitMake(self, f):
+    # objects of the tests are emitted by the tests themselves
+    for settings_name in settings_list:
+      print >>f, "%s: %s %s %s %s %s%s" % (self.makeTargetName(settings_name),
+                                           self.depPackageNames(),
+                                           self.depPBHeaderPaths(),
+                                           self.objectPathList(settings_name),
+                                           stamp.stampObjectPath(settings_name),
+                                           "| " if isShared(settings_name) else "",
+                                           " ".join(self.linkLibPathList(settings_name)))
+      recipe.action(f, "_____link [%s]" % self.makeTargetName(settings_name))
+      print >>f, "\t%s" % self.linkCommand(settings_name)
+      print >>f, "\n"
+      recipe.outputDirs(f, [self.makeTargetName(settings_name)], [self.targetDir(settings_name)])
+
+  def emitNinja(self, f):
+    for settings_name in settings_list:
+      inputs = self.objectPathList(settings_name).split() + [stamp.stampObjectPath(settings_name)]
+      libs = self.linkLibPathList(settings_name)
+      if isShared(settings_name):
+        ninja.build(f, [self.makeTargetName(settings_name)], "link", inputs, order_only=libs,
+                    variables=[("cmd", self.linkCommand(settings_name))])
+      else:
+        ninja.build(f, [self.makeTargetName(settings_name)], "link", inputs + libs,
+                    variables=[("cmd", self.linkCommand(settings_name))])
+
+
 class CCPyExt(CCLibrary):
   """
    cc_pyext(name = "",
@@ -698,23 +1250,14 @@ class CCPyExt(CCLibrary):
     # such as "build/base/base_bin"
     return os.path.join(build_dir, settings_name, "targets", self.package.packageName, self.ruleName + ".so")
 
-  def exportLibNameList(self):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibNameList()
-    return simplifyDepList(res)
+  def ownLibNameList(self):
+    return []
 
-  def exportLibPathList(self, settings_name):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibPathList(settings_name)
-    return simplifyDepList(res)
+  def ownLibPathList(self, settings_name):
+    return []
 
-  def exportLibDirList(self, settings_name):
-    res = []
-    for dep in self.depRulesList:
-      res = res + dep.exportLibDirList(settings_name)
-    return simplifyDepList(res)
+  def ownLibDirList(self, settings_name):
+    return []
 
   def emitSrcMake(self, f):
     CCLibrary.emitSrcMake(self, f)
@@ -727,10 +1270,10 @@ class CCPyExt(CCLibrary):
       dep_file = ".build/%s/meta_objs/%s/%s.d" % (settings_name, self.package.packageName, self.ruleName)
       obj_dir = os.path.dirname(obj)
       print >>f, "%s: %s" % (obj, src)
-      print >>f, '\t@${PRINT} "_____compile %s %s"' % (settings_name, src)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (obj_dir, obj_dir)
+      recipe.action(f, "_____compile %s %s" % (settings_name, src))
       print >>f, "\t%s -o %s -c %s" % (self.compileTool(src, settings_name), obj, src)
       print >>f, "\n"
+      recipe.outputDirs(f, [obj], [obj_dir])
       print >>f, "-include %s" % dep_file
       print >>f, "\n"
 
@@ -746,7 +1289,7 @@ class CCPyExt(CCLibrary):
     #   meta_obj = ".build/%s/meta_objs/%s/%s.o" % (settings_name, self.package.packageName, self.ruleName)
     #   print >>f, "%s: %s %s %s %s %s" % (self.makeTargetName(settings_name),
     #                                   self.depPackageNames(),
-    #                                   " ".join(self.depPBHeaderPathSet()),
+    #                                   self.depPBHeaderPaths(),
     #                                   self.objectPathList(settings_name),
     #                                   meta_obj,
     #                                   " ".join(self.exportLibPathList(settings_name)))
@@ -766,7 +1309,7 @@ class CCPyExt(CCLibrary):
     #   base_name = self.makeTargetName(setting)
     #   print >>f, "%s: %s %s %s %s" % (base_name,
     #                                      self.depPackageNames(),
-    #                                      " ".join(self.depPBHeaderPathSet()),
+    #                                      self.depPBHeaderPaths(),
     #                                      self.objectPathList(setting),
     #                                      " ".join(self.exportLibPathList(setting)))
     #   print >>f, '\t@${PRINT} "_____merging the layouts [%s]"' %(base_name)
@@ -789,8 +1332,8 @@ class CCPyExt(CCLibrary):
     #       base_name + ".dot",
     #       base_name + ".png")
 
-    for dep in self.depRulesList:
-      dep.emitMake(f)
-
-    self.emitDependencies(f)
+    self.emitDepsMake(f)
 
+  def emitNinja(self, f):
+    # not linked, as in emitMake()
+    self.emitSrcNinja(f)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+# package before cc, as pconfig.py imports them
+import package
+import cc
+import benchmark
+import pconfig
+
+"""
+Tests of cc.py
+
+cc.resolveLinkOrder() and cc.collectLibs() are compared on random DAGs
+with the definition they replaced: the lists of rules concatenated
+recursively, own items first, then simplified by cc.simplifyDepList().
+The proto header closures are checked to be built once per rule on a deep
+proto_library chain, the proto_deep scenario of benchmark.py. Run it by:
+
+  $ python build_tools/blade3/cc_test.py
+"""
+
+class FakeRule(object):
+  def __init__(self, name, items, exports_dep_libs):
+    self.name = name
+    self.items = items
+    self.exports_dep_libs = exports_dep_libs
+    self.depRulesList = []
+
+  def __repr__(self):
+    return self.name
+
+def concatenated(rules):
+  # the recursive definition, exponential on diamonds, fine on small graphs
+  res = []
+  for r in rules:
+    if r.exports_dep_libs:
+      res.extend(r.items)
+      res.extend(concatenated(r.depRulesList))
+  return res
+
+def randomDag(rnd, size):
+  """ rules of a random DAG, deps only point to rules created before """
+  items = ["lib%d" % i for i in range(size)]
+  rules = []
+  for i in range(size):
+    # some items are shared by rules, as a library listed by two rules
+    own = rnd.sample(items, rnd.randint(0, min(size, 2)))
+    r = FakeRule("r%d" % i, own, rnd.random() > 0.2)
+    if i > 0:
+      r.depRulesList = rnd.sample(rules, rnd.randint(0, min(i, 3)))
+    rules.append(r)
+  return rules
+
+class LinkOrderTest(unittest.TestCase):
+  def testResolveLinkOrder(self):
+    rnd = random.Random(20161018)
+    for n in range(3000):
+      rules = randomDag(rnd, rnd.randint(1, 12))
+      roots = rnd.sample(rules, rnd.randint(1, min(len(rules), 3)))
+      expected = cc.simplifyDepList(concatenated(roots))
+      self.assertEqual(expected, cc.resolveLinkOrder(roots, lambda r: r.items),
+                       "roots %s of dag %d" % (roots, n))
+
+  def testCollectLibs(self):
+    # the same items, in any order
+    rnd = random.Random(20161019)
+    for n in range(1000):
+      rules = randomDag(rnd, rnd.randint(1, 12))
+      roots = rnd.sample(rules, rnd.randint(1, min(len(rules), 3)))
+      expected = cc.simplifyDepList(concatenated(roots))
+      res = cc.collectLibs(roots, lambda r: r.items)
+      self.assertEqual(len(res), len(set(res)))
+      self.assertEqual(sorted(expected), sorted(res), "roots %s of dag %d" % (roots, n))
+
+  def testDeepChain(self):
+    # iterative, a long chain doesn't hit the recursion limit
+    rules = [FakeRule("r0", ["lib0"], True)]
+    for i in range(1, 5000):
+      r = FakeRule("r%d" % i, ["lib%d" % i], True)
+      r.depRulesList = [rules[-1]]
+      rules.append(r)
+    self.assertEqual(["lib%d" % i for i in reversed(range(5000))],
+                     cc.resolveLinkOrder([rules[-1]], lambda r: r.items))
+
+class ProtoClosureTest(unittest.TestCase):
+  chain = 22
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.root = tempfile.mkdtemp(prefix="cc_test_")
+    # each proto_library depends on the previous three, so there are
+    # exponentially many paths from the top of the chain to its bottom
+    self.build_files = benchmark.generateCodebase(self.root, 2, 1, 1, 1, self.chain,
+                                                  False, proto_fanout=3)
+    os.chdir(self.root)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.root)
+    package.globalPackages.clear()
+
+  def testClosureBuiltOncePerRule(self):
+    built = {}
+    build = cc.CCLibrary.buildPBHeaderClosure
+    def counted(r):
+      built[r.fullRuleName()] = built.get(r.fullRuleName(), 0) + 1
+      build(r)
+    cc.CCLibrary.buildPBHeaderClosure = counted
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      packages = pconfig.loadPackages(self.build_files, self.root)
+      pconfig.computeClosures()
+      package.emitMake(packages, StringIO.StringIO())
+    finally:
+      sys.stdout = stdout
+      cc.CCLibrary.buildPBHeaderClosure = build
+
+    rules = [r for pkg in package.globalPackages.values() for r in pkg.ruleList]
+    self.assertEqual(sorted([r.fullRuleName() for r in rules]), sorted(built.keys()))
+    self.assertEqual([1], sorted(set(built.values())))
+    lib = package.globalPackages["bench/p00000"].getRule("lib0")
+    self.assertEqual(self.chain, len(lib.depPBHeaderPathSet()))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+"""
+Compile cache, enabled by pconfig.py --compile_cache
+
+Compile commands in the Makefile and build.ninja are prefixed by
+${COMPILE_CACHE}, which runs this script with the compiler command line:
+
+  $ python build_tools/blade3/compile_cache.py g++ ... -o x.o -c x.cc
+
+The object and its .d file are looked up by a key of the preprocessed
+source, the whole command line, and the path, size and mtime of the
+compiler. On a hit they are copied from the cache instead of compiling,
+so a 'make clean', a branch switch or a new checkout doesn't recompile
+what's been compiled before.
+
+The cache is in $BLADE_COMPILE_CACHE_DIR (~/.blade_cache/compile by
+default), it's capped to $BLADE_COMPILE_CACHE_SIZE MB (5120 by default),
+least recently used objects are removed first. Hits and misses of the
+workspace are reported, and the cache is trimmed, at the end of
+'make debug/release':
+
+  $ python build_tools/blade3/compile_cache.py --stats
+"""
+
+cache_dir = os.environ.get("BLADE_COMPILE_CACHE_DIR",
+                           os.path.expanduser("~/.blade_cache/compile"))
+cache_size = int(os.environ.get("BLADE_COMPILE_CACHE_SIZE", "5120")) * 1024 * 1024
+
+# bump it when the layout of the cache changes
+cache_version = "1"
+
+# the cache is shared by all workspaces of the user, so hits and misses are
+# counted in the workspace
+stats_file = ".build/compile_cache_stats"
+
+# the cache is trimmed to this fraction of its size, so it isn't trimmed every build
+trim_ratio = 0.9
+
+def compilerFingerprint(compiler):
+  path = compiler
+  if os.sep not in compiler:
+    for dir_name in os.environ.get("PATH", "").split(os.pathsep):
+      if os.access(os.path.join(dir_name, compiler), os.X_OK):
+        path = os.path.join(dir_name, compiler)
+        break
+  path = os.path.realpath(path)
+  st = os.stat(path)
+  return "%s %d %d" % (path, st.st_size, int(st.st_mtime))
+
+def parseArgs(args):
+  """ output, depfile, and the args to preprocess, or None if not cacheable """
+  output = None
+  depfile = None
+  make_deps = False
+  preprocess = []
+  i = 0
+  while i < len(args):
+    a = args[i]
+    if a in ("-o", "-MF") and i + 1 < len(args):
+      if a == "-o":
+        output = args[i + 1]
+      else:
+        depfile = args[i + 1]
+      i = i + 2
+      continue
+    if a in ("-MMD", "-MD"):
+      make_deps = True
+    elif a in ("-MP", "-c"):
+      pass
+    elif a == "-":
+      return None
+    else:
+      preprocess.append(a)
+    i = i + 1
+  if output is None or "-c" not in args:
+    return None
+  if make_deps and depfile is None:
+    # where gcc writes it without -MF
+    depfile = os.path.splitext(output)[0] + ".d"
+  if not make_deps:
+    depfile = None
+  return output, depfile, preprocess + ["-E"]
+
+def cacheKey(argv, preprocess_args):
+  p = subprocess.Popen(preprocess_args, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+  source = p.communicate()[0]
+  if p.returncode != 0:
+    return None
+  h = hashlib.sha1()
+  h.update("%s\n%s\n" % (cache_version, compilerFingerprint(argv[0])))
+  h.update("\0".join(argv))
+  h.update("\n")
+  h.update(source)
+  return h.hexdigest()
+
+def entryPath(key):
+  return os.path.join(cache_dir, key[:2], key)
+
+def copyFile(src, dst):
+  # to a temporary file first, so a broken copy is never left at dst
+  tmp = "%s.tmp%d" % (dst, os.getpid())
+  shutil.copyfile(src, tmp)
+  os.rename(tmp, dst)
+
+def restore(key, output, depfile):
+  entry = entryPath(key)
+  if not os.path.isfile(entry + ".o"):
+    return False
+  if depfile is not None and not os.path.isfile(entry + ".d"):
+    return False
+  try:
+    if depfile is not None:
+      copyFile(entry + ".d", depfile)
+    copyFile(entry + ".o", output)
+    # mtime of the object tells when it's used last
+    os.utime(entry + ".o", None)
+  except (IOError, OSError):
+    return False
+  return True
+
+def store(key, output, depfile):
+  entry = entryPath(key)
+  try:
+    if not os.path.isdir(os.path.dirname(entry)):
+      os.makedirs(os.path.dirname(entry))
+    # the object last, its presence means the entry is complete
+    if depfile is not None:
+      copyFile(depfile, entry + ".d")
+    copyFile(output, entry + ".o")
+  except (IOError, OSError):
+    pass
+
+def count(event):
+  # one line per compile, appending a short line is atomic
+  try:
+    if not os.path.isdir(os.path.dirname(stats_file)):
+      os.makedirs(os.path.dirname(stats_file))
+    fd = os.open(stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fd, event + "\n")
+    os.close(fd)
+  except OSError:
+    pass
+
+def cachedCompile(argv):
+  parsed = parseArgs(argv)
+  if parsed is None:
+    return subprocess.call(argv)
+  output, depfile, preprocess_args = parsed
+  key = cacheKey(argv, preprocess_args)
+  if key is None:
+    # let the compiler report the error
+    return subprocess.call(argv)
+  if restore(key, output, depfile):
+    count("hit")
+    return 0
+  count("miss")
+  res = subprocess.call(argv)
+  if res == 0:
+    store(key, output, depfile)
+  return res
+
+def trim():
+  """ remove least recently used objects until the cache fits, return its size """
+  entries = []
+  total = 0
+  for sub_dir in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, sub_dir)
+    if not os.path.isdir(path):
+      continue
+    for name in os.listdir(path):
+      full_path = os.path.join(path, name)
+      try:
+        st = os.stat(full_path)
+      except OSError:
+        continue
+      total = total + st.st_size
+      if name.endswith(".o"):
+        d_size = 0
+        if os.path.isfile(full_path[:-2] + ".d"):
+          d_size = os.path.getsize(full_path[:-2] + ".d")
+        entries.append((st.st_mtime, full_path, st.st_size + d_size))
+  if total <= cache_size:
+    return total
+  entries.sort()
+  for mtime, path, size in entries:
+    if total <= cache_size * trim_ratio:
+      break
+    for a in (path, path[:-2] + ".d"):
+      if os.path.exists(a):
+        os.remove(a)
+    total = total - size
+  return total
+
+def report():
+  """ print hits and misses since the last report, and trim the cache """
+  if not os.path.isdir(cache_dir):
+    return
+  hits, misses = 0, 0
+  try:
+    events = file(stats_file).read().split()
+    os.remove(stats_file)
+  except (IOError, OSError):
+    events = []
+  for event in events:
+    if event == "hit":
+      hits = hits + 1
+    elif event == "miss":
+      misses = misses + 1
+  size = trim()
+  if hits + misses > 0:
+    print "compile cache: %d hits, %d misses, %.1f%% hit rate, %d of %d MB used" \
+        % (hits, misses, 100.0 * hits / (hits + misses), size / (1024 * 1024),
+           cache_size / (1024 * 1024))
+
+if __name__ == "__main__":
+  if len(sys.argv) == 2 and sys.argv[1] == "--stats":
+    report()
+    sys.exit(0)
+  if len(sys.argv) < 2:
+    print >>sys.stderr, "usage: %s COMPILER ARGS... | --stats" % sys.argv[0]
+    sys.exit(-1)
+  sys.exit(cachedCompile(sys.argv[1:]))
@@ -21,20 +21,14 @@ class CCData(cc.CCLibrary):
   """
   buildName = "cc_data"
 
+  # neither the files nor the deps are linked
+  exports_dep_libs = False
+
   def __init__(self, **kwargs):
     cc.CCLibrary.__init__(self, **kwargs)
     self.is_library = 0 
     self.is_data = 1 
 
-  def exportLibPathList(self, settings_name):
-    return []
-
-  def exportLibDirList(self, settings_name):
-    return []
-
-  def exportLibNameList(self):
-    return []
-
   def dump(self):
     print "\tdata: ", self.ruleName
     for f in self.srcsList:
@@ -48,3 +42,6 @@ class CCData(cc.CCLibrary):
     for setting in settings:
       print >>f, "%s: \n\n" %(self.makeTargetName(setting))
 
+  def emitNinja(self, f):
+    # nothing is built, the empty make rules are only for prerequisites
+    pass
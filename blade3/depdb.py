@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import array
+import mmap
+import os
+import struct
+import sys
+
+"""
+Dependency database, .blade/deps.db
+
+gen_makefile writes the graph of all loaded rules to it, for query.py,
+affected.py and regen_makefile.py. .blade/all_deps is still written in the
+old format, as python literals, for other scripts.
+
+Rules are numbered by their sorted labels; labels, types and sources are
+interned in a string table, and the deps, reverse deps and sources of the
+rules are CSR arrays, i.e. the items of rule i are items[offsets[i]:offsets[i + 1]].
+All numbers are little endian uint32:
+
+  header    magic, version, then (offset, count) of each section
+  strings   offsets (count + 1) into the utf-8 blob that follows them
+  labels    string id of each rule
+  kinds     string id of the type of each rule
+  deps      offsets (count + 1), then rule ids
+  rdeps     the same
+  srcs      offsets (count + 1), then string ids
+  packages  string ids of the BUILD files given to gen_makefile, such as //base/BUILD
+
+A reader maps the file, and copies a section into an array only when it's
+first used; strings are decoded one by one, so finding a label by bisection
+decodes only a few of them.
+"""
+
+db_file = ".blade/deps.db"
+
+# written by gen_makefile in the old format, and by older gen_makefiles only
+legacy_file = ".blade/all_deps"
+
+magic = "BLADEDB\0"
+
+# bump it when the layout changes
+db_version = 1
+
+sections = ["strings", "labels", "kinds", "deps", "rdeps", "srcs", "packages"]
+
+_header = struct.Struct("<8sI" + "II" * len(sections))
+
+def _uint32Array(items=[]):
+  res = array.array("I", items)
+  if res.itemsize != 4:
+    res = array.array("L", items)
+  return res
+
+def _toBytes(items):
+  res = _uint32Array(items)
+  if sys.byteorder != "little":
+    res.byteswap()
+  return res.tostring()
+
+def _csr(lists):
+  """ offsets and items of lists, as one uint32 section """
+  offsets = [0]
+  items = []
+  for a in lists:
+    items.extend(a)
+    offsets.append(len(items))
+  return offsets + items
+
+def write(path, packages, rules):
+  """
+   packages are the labels of BUILD files, rules are (label, type, deps,
+   srcs). deps which aren't rules are added with an empty type.
+  """
+  labels = sorted(set([a[0] for a in rules] + [b for a in rules for b in a[2]]))
+  ids = dict([(label, i) for i, label in enumerate(labels)])
+
+  strings = []
+  string_ids = {}
+  def intern(s):
+    if s not in string_ids:
+      string_ids[s] = len(strings)
+      strings.append(s)
+    return string_ids[s]
+
+  label_ids = [intern(a) for a in labels]
+  kinds = [intern("")] * len(labels)
+  deps = [[] for a in labels]
+  srcs = [[] for a in labels]
+  for label, kind, dep_labels, src_paths in rules:
+    i = ids[label]
+    kinds[i] = intern(kind)
+    deps[i] = sorted(set([ids[a] for a in dep_labels]))
+    srcs[i] = [intern(a) for a in src_paths]
+  rdeps = [[] for a in labels]
+  for i in range(len(labels)):
+    for dep in deps[i]:
+      rdeps[dep].append(i)
+  package_ids = [intern(a) for a in sorted(packages)]
+
+  string_offsets = [0]
+  encoded = [a.encode("utf-8") if type(a) == unicode else a for a in strings]
+  for a in encoded:
+    string_offsets.append(string_offsets[-1] + len(a))
+  contents = [(_toBytes(string_offsets) + "".join(encoded), len(strings)),
+              (_toBytes(label_ids), len(labels)),
+              (_toBytes(kinds), len(labels)),
+              (_toBytes(_csr(deps)), len(labels)),
+              (_toBytes(_csr(rdeps)), len(labels)),
+              (_toBytes(_csr(srcs)), len(labels)),
+              (_toBytes(package_ids), len(package_ids))]
+
+  fields = []
+  offset = _header.size
+  for data, count in contents:
+    fields.extend([offset, count])
+    # sections start at multiples of 4
+    offset = offset + (len(data) + 3) / 4 * 4
+
+  tmp_file = "%s.tmp%d" % (path, os.getpid())
+  p = file(tmp_file, "wb")
+  p.write(_header.pack(magic, db_version, *fields))
+  for data, count in contents:
+    p.write(data)
+    p.write("\0" * ((4 - len(data) % 4) % 4))
+  p.close()
+  os.rename(tmp_file, path)
+
+def isDepDB(path):
+  """ if path starts with the magic of deps.db, of any version """
+  p = file(path, "rb")
+  try:
+    return p.read(len(magic)) == magic
+  finally:
+    p.close()
+
+def lastPackages(path):
+  """
+   labels of the BUILD files given to the last gen_makefile, from deps.db or
+   from a legacy all_deps
+  """
+  if isDepDB(path):
+    return DepDB(path).packages()
+  # python literals of packages, deps_graph and rule_types
+  scope = {}
+  exec file(path).read() in scope
+  return sorted(scope["packages"].keys())
+
+class DepDB(object):
+  def __init__(self, path=db_file):
+    p = file(path, "rb")
+    try:
+      size = os.fstat(p.fileno()).st_size
+      if size < _header.size:
+        raise ValueError("%s is broken, please run gen_makefile.sh again" % path)
+      self.data = mmap.mmap(p.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      p.close()
+    header = _header.unpack_from(self.data, 0)
+    if header[0] != magic or header[1] != db_version:
+      raise ValueError("%s is of another version, please run gen_makefile.sh again" % path)
+    self.sections = {}
+    for i, name in enumerate(sections):
+      self.sections[name] = (header[2 + 2 * i], header[3 + 2 * i])
+    self.arrays = {}
+    self.strings = {}
+
+  def array(self, name, length):
+    # length uint32 of a section, copied on first use
+    if name not in self.arrays:
+      offset = self.sections[name][0]
+      res = _uint32Array()
+      res.fromstring(self.data[offset:offset + 4 * length])
+      if sys.byteorder != "little":
+        res.byteswap()
+      self.arrays[name] = res
+    return self.arrays[name]
+
+  def csrLength(self, name):
+    # offsets and items
+    count = self.sections[name][1]
+    offset = self.sections[name][0]
+    items = struct.unpack_from("<I", self.data, offset + 4 * count)[0]
+    return count + 1 + items
+
+  def string(self, i):
+    if i not in self.strings:
+      offsets = self.array("strings", self.sections["strings"][1] + 1)
+      blob = self.sections["strings"][0] + 4 * len(offsets)
+      self.strings[i] = self.data[blob + offsets[i]:blob + offsets[i + 1]]
+    return self.strings[i]
+
+  def ruleCount(self):
+    return self.sections["labels"][1]
+
+  def label(self, i):
+    return self.string(self.array("labels", self.ruleCount())[i])
+
+  def kind(self, i):
+    return self.string(self.array("kinds", self.ruleCount())[i])
+
+  def items(self, name, i):
+    a = self.array(name, self.csrLength(name))
+    count = self.sections[name][1]
+    return a[count + 1 + a[i]:count + 1 + a[i + 1]]
+
+  def deps(self, i):
+    return self.items("deps", i)
+
+  def rdeps(self, i):
+    return self.items("rdeps", i)
+
+  def srcs(self, i):
+    return [self.string(a) for a in self.items("srcs", i)]
+
+  def packages(self):
+    return [self.string(a) for a in self.array("packages", self.sections["packages"][1])]
+
+  def lowerBound(self, label):
+    # the first rule whose label isn't less than label, the labels are sorted
+    lo, hi = 0, self.ruleCount()
+    while lo < hi:
+      mid = (lo + hi) / 2
+      if self.label(mid) < label:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def find(self, label):
+    """ id of a label, or None """
+    i = self.lowerBound(label)
+    if i < self.ruleCount() and self.label(i) == label:
+      return i
+    return None
+
+  def packageRules(self, build_file):
+    """ ids of the rules of //path/BUILD """
+    prefix = build_file + ":"
+    res = []
+    i = self.lowerBound(prefix)
+    while i < self.ruleCount() and self.label(i).startswith(prefix):
+      res.append(i)
+      i = i + 1
+    return res
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import fnmatch
+import glob as glob_module
+import os
+
+import profiler
+
+"""
+Directory listings shared by globs, side files and lint
+
+Every directory is read once per run, the listing keeps the names in the
+order of os.listdir() and which of them are directories, so that walk() and
+glob() give exactly the results of os.walk() and glob.glob():
+
+  dir_index.walk("base")          # as os.walk("base")
+  dir_index.findFiles("base", "*.h")
+  dir_index.glob("base/*.cc")     # as glob.glob("base/*.cc")
+
+The generator doesn't create files in the source tree while it runs, so the
+listings never have to be invalidated.
+"""
+
+try:
+  # the backport of os.scandir(), it knows the file types without stat
+  from scandir import scandir
+except ImportError:
+  scandir = None
+
+class _Listing(object):
+  def __init__(self, names, dirs, links):
+    self.names = names    # all names, in the order of os.listdir()
+    self.dirs = dirs      # names of directories, symlinks to dirs included
+    self.links = links    # names of symlinks
+
+# path => _Listing, or None if it can't be read
+_listings = {}
+
+def _readDir(path):
+  if scandir is not None:
+    profiler.count("directory reads")
+    names, dirs, links = [], set(), set()
+    for entry in scandir(path):
+      names.append(entry.name)
+      if entry.is_dir():
+        dirs.add(entry.name)
+      if entry.is_symlink():
+        links.add(entry.name)
+    return _Listing(names, dirs, links)
+  names = os.listdir(path)
+  dirs, links = set(), set()
+  for name in names:
+    full_path = os.path.join(path, name)
+    if os.path.isdir(full_path):
+      dirs.add(name)
+      if os.path.islink(full_path):
+        links.add(name)
+  return _Listing(names, dirs, links)
+
+def listing(path):
+  if path not in _listings:
+    try:
+      _listings[path] = _readDir(path if path != "" else os.curdir)
+    except OSError:
+      _listings[path] = None
+  return _listings[path]
+
+def walk(top):
+  """ the same as os.walk(top), top-down and not following symlinks """
+  res = []
+  stack = [top]
+  while len(stack) > 0:
+    path = stack.pop()
+    entry = listing(path)
+    if entry is None:
+      continue
+    dirnames = [a for a in entry.names if a in entry.dirs]
+    filenames = [a for a in entry.names if a not in entry.dirs]
+    res.append((path, dirnames, filenames))
+    stack.extend(reversed([os.path.join(path, a) for a in dirnames
+                           if a not in entry.links]))
+  return res
+
+def findFiles(root_dir, file_pattern):
+  matches = []
+  for root, dirnames, filenames in walk(root_dir):
+    for filename in fnmatch.filter(filenames, file_pattern):
+      matches.append(os.path.join(root, filename))
+  return matches
+
+def _lexists(path):
+  dir_name, base_name = os.path.split(path)
+  entry = listing(dir_name)
+  if entry is None:
+    return os.path.lexists(path)
+  return base_name in entry.names
+
+def _isdir(path):
+  if path == "":
+    return True
+  dir_name, base_name = os.path.split(path)
+  entry = listing(dir_name)
+  if entry is None or base_name == "":
+    return os.path.isdir(path)
+  return base_name in entry.dirs
+
+def _glob1(dir_name, pattern):
+  entry = listing(dir_name)
+  if entry is None:
+    return []
+  names = entry.names
+  if pattern[0] != '.':
+    names = [a for a in names if a[0] != '.']
+  return fnmatch.filter(names, pattern)
+
+def _glob0(dir_name, base_name):
+  if base_name == '':
+    if _isdir(dir_name):
+      return [base_name]
+  elif _lexists(os.path.join(dir_name, base_name)):
+    return [base_name]
+  return []
+
+def glob(pattern):
+  """ the same as glob.glob(pattern), with the listings read once """
+  has_magic = glob_module.has_magic
+  dir_name, base_name = os.path.split(pattern)
+  if not has_magic(pattern):
+    if base_name:
+      return [pattern] if _lexists(pattern) else []
+    return [pattern] if _isdir(dir_name) else []
+  if not dir_name:
+    return _glob1(dir_name, base_name)
+  if dir_name != pattern and has_magic(dir_name):
+    dirs = glob(dir_name)
+  else:
+    dirs = [dir_name]
+  glob_in_dir = _glob1 if has_magic(base_name) else _glob0
+  res = []
+  for a in dirs:
+    res.extend([os.path.join(a, name) for name in glob_in_dir(a, base_name)])
+  return res
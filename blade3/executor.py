@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import cPickle
+import hashlib
+import heapq
+import multiprocessing
+import optparse
+import os
+import Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import build_cache
+import ninja
+import pconfig
+import cc
+import action_cache
+import compile_cache
+from dirs import build_dir
+from dirs import makefile_header
+
+"""
+Build executor, runs the rules of BUILD files without make
+
+It collects the same build edges as build.ninja from the expanded rules, and
+runs them with a separate concurrency limit and memory estimate for each
+kind of action, so that links of big binaries don't run out of memory while
+compiles keep the cores busy:
+
+  $ python build_tools/blade3/executor.py -t debug_test xxx/BUILD yyy/BUILD
+  $ python build_tools/blade3/executor.py -j 32 --link_jobs 2 --memory_budget 16000 ALL
+
+Actions on the longest remaining path start first; the path length is
+estimated from the durations of the last runs. Like ninja, an action is run
+if an output is missing, its command is changed, an input (or a header
+found in its depfile) is newer than the outputs, or an action it depends
+on has run. Commands, header deps and durations are kept in .build/.exec_log.
+A failed action is retried after its outputs are removed.
+"""
+
+log_file = os.path.join(build_dir, ".exec_log")
+
+# bump it when the layout of log entries changes
+log_version = 1
+
+# ninja rule => kind of the action
+kinds = {
+  "cc": "compile",
+  "pch": "compile",
+  "ar": "archive",
+  "protoc": "protoc",
+  "link": "link",
+  "symlink": "other",
+  "gen_rule": "other",
+  "run": "console",
+}
+
+# kind => default memory estimate in MB, and duration in seconds without log
+default_memory = {"compile": 512, "archive": 64, "protoc": 128, "link": 2048,
+                  "other": 16, "console": 0}
+default_seconds = {"compile": 1.0, "archive": 0.2, "protoc": 0.5, "link": 2.0,
+                   "other": 0.1, "console": 1.0}
+
+_var_regex = re.compile(r"\$(\$|\{([A-Za-z0-9_.-]+)\}|([A-Za-z0-9_-]+))")
+
+def evaluate(template, scopes):
+  """ expand $name, ${name} and $$ as ninja does, scopes are dicts """
+  def variable(matcher):
+    if matcher.group(1) == "$":
+      return "$"
+    name = matcher.group(2) or matcher.group(3)
+    for scope in scopes:
+      if name in scope:
+        return scope[name]
+    return ""
+  return _var_regex.sub(variable, template)
+
+def availableMemory():
+  # MB of available memory, or 0 if it's unknown
+  try:
+    for line in file("/proc/meminfo"):
+      fields = line.split()
+      if fields[0] == "MemAvailable:":
+        return int(fields[1]) / 1024
+  except (IOError, IndexError, ValueError):
+    pass
+  return 0
+
+def mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+def readDepfile(path):
+  """ prerequisites in a depfile written by gcc -MMD """
+  try:
+    content = file(path).read().replace("\\\n", " ")
+  except IOError:
+    return []
+  pos = content.find(": ")
+  if pos < 0:
+    return []
+  return content[pos + 1:].split()
+
+class Action(object):
+  def __init__(self, outputs, rule, inputs, implicit, order_only):
+    self.outputs = outputs
+    self.rule = rule
+    self.inputs = inputs
+    self.implicit = implicit
+    self.order_only = order_only
+    self.kind = kinds.get(rule, "other")
+    self.command = None
+    self.description = None
+    self.depfile = None
+    self.producers = []
+    self.consumers = []
+    self.pending = 0
+    self.priority = 0.0
+    self.tries = 0
+    self.ran = False
+
+  def allInputs(self):
+    return self.inputs + self.implicit + self.order_only
+
+class ActionGraph(object):
+  """ collects the build edges written by ninja.emitEdges() """
+  def __init__(self, variables):
+    self.actions = []
+    self.producer = {}  # output => action
+    self.rules = dict((name, dict(bindings)) for name, bindings in ninja.rules)
+    self.variables = {}
+    for name, value in variables:
+      self.variables[name] = evaluate(value, [self.variables])
+
+  def write(self, text):
+    # text between edges isn't needed
+    pass
+
+  def addEdge(self, outputs, rule, inputs, implicit, order_only, variables):
+    action = Action(outputs, rule, inputs, implicit, order_only)
+    if rule in self.rules:
+      edge = {"in": " ".join(inputs), "out": " ".join(outputs)}
+      for name, value in variables:
+        edge[name] = evaluate(value, [self.variables])
+      bindings = self.rules[rule]
+      scopes = [edge, bindings, self.variables]
+      action.command = evaluate(bindings["command"], scopes)
+      action.description = evaluate(bindings.get("description", "$out"), scopes)
+      if "depfile" in bindings:
+        action.depfile = evaluate(bindings["depfile"], scopes)
+    self.actions.append(action)
+    for output in outputs:
+      self.producer[output] = action
+
+  def neededActions(self, targets):
+    """ actions needed to build targets, deps first """
+    res = []
+    visited = set()
+    stack = []
+    for target in reversed(targets):
+      if target not in self.producer:
+        if mtime(target) is None:
+          print >>sys.stderr, "unknown target: %s" % target
+          sys.exit(1)
+        continue
+      stack.append((self.producer[target], False))
+    while stack:
+      action, deps_done = stack.pop()
+      if deps_done:
+        res.append(action)
+        continue
+      if action in visited:
+        continue
+      visited.add(action)
+      stack.append((action, True))
+      for path in reversed(action.allInputs()):
+        if path in self.producer and self.producer[path] not in visited:
+          stack.append((self.producer[path], False))
+    return res
+
+class Log(object):
+  """ output => {"hash", "deps", "seconds"} of actions run before """
+  def __init__(self):
+    self.entries = {}
+    self.dirty = False
+    try:
+      p = file(log_file, "rb")
+      try:
+        version, entries = cPickle.load(p)
+      finally:
+        p.close()
+      if version == log_version:
+        self.entries = entries
+    except Exception:
+      pass
+
+  def get(self, action):
+    return self.entries.get(action.outputs[0])
+
+  def put(self, action, deps, seconds):
+    self.entries[action.outputs[0]] = {"hash": commandHash(action),
+                                       "deps": deps,
+                                       "seconds": seconds}
+    self.dirty = True
+
+  def save(self):
+    if not self.dirty:
+      return
+    if not os.path.exists(build_dir):
+      os.makedirs(build_dir)
+    tmp_file = log_file + ".tmp"
+    p = file(tmp_file, "wb")
+    cPickle.dump((log_version, self.entries), p, cPickle.HIGHEST_PROTOCOL)
+    p.close()
+    os.rename(tmp_file, log_file)
+    self.dirty = False
+
+def commandHash(action):
+  return hashlib.sha1(action.command).hexdigest()
+
+def isDirty(action, log):
+  if action.rule == "run":
+    return True
+  for producer in action.producers:
+    if producer.ran and producer.rule != "run":
+      return True
+  entry = log.get(action)
+  if entry is None or entry["hash"] != commandHash(action):
+    return True
+  oldest = None
+  for output in action.outputs:
+    t = mtime(output)
+    if t is None:
+      return True
+    if oldest is None or t < oldest:
+      oldest = t
+  for path in action.inputs + action.implicit + entry["deps"]:
+    t = mtime(path)
+    if t is None or t > oldest:
+      return True
+  return False
+
+def removeOutputs(action):
+  for output in action.outputs:
+    if os.path.islink(output) or os.path.isfile(output):
+      os.remove(output)
+
+class Executor(object):
+  def __init__(self, actions, options):
+    self.actions = actions
+    self.options = options
+    self.log = Log()
+    self.limits = {
+      "compile": options.compile_jobs or options.jobs,
+      "archive": options.archive_jobs or options.jobs,
+      "protoc": options.protoc_jobs or options.jobs,
+      "link": options.link_jobs or min(options.jobs, ninja.link_pool_depth),
+      "other": options.jobs,
+      "console": 1,
+    }
+    self.memory = dict(default_memory)
+    self.memory["compile"] = options.compile_memory
+    self.memory["link"] = options.link_memory
+    self.memory_budget = options.memory_budget
+    if self.memory_budget is None:
+      self.memory_budget = availableMemory() * 8 / 10
+
+    self.running = {}   # kind => number of running actions
+    self.memory_used = 0
+    self.processes = {} # action => Popen
+    self.results = Queue.Queue()
+    self.ready = []
+    self.seq = 0
+    self.done = 0
+    self.ran = 0        # actions run, retries aren't counted
+    self.skipped = 0    # actions found up to date, they aren't run or printed
+    self.failed = []
+    self.stopping = False
+
+  def estimate(self, action):
+    entry = self.log.get(action)
+    if entry is not None:
+      return entry["seconds"]
+    if action.command is None:
+      return 0.0
+    return default_seconds[action.kind]
+
+  def prepare(self):
+    # the needed actions are in topological order, deps first
+    needed = set(self.actions)
+    for action in self.actions:
+      action.producers = []
+      action.consumers = []
+    producer = {}
+    for action in self.actions:
+      for output in action.outputs:
+        producer[output] = action
+    for action in self.actions:
+      deps = set()
+      for path in action.allInputs():
+        if path in producer and producer[path] in needed:
+          deps.add(producer[path])
+      action.producers = list(deps)
+      action.pending = len(deps)
+      for dep in deps:
+        dep.consumers.append(action)
+    # length of the longest path from an action to the end of the build
+    for action in reversed(self.actions):
+      rest = 0.0
+      for consumer in action.consumers:
+        rest = max(rest, consumer.priority)
+      action.priority = self.estimate(action) + rest
+    for action in self.actions:
+      if action.pending == 0:
+        self.push(action)
+
+  def push(self, action):
+    self.seq = self.seq + 1
+    heapq.heappush(self.ready, (-action.priority, self.seq, action))
+
+  def canStart(self, action):
+    total = sum(self.running.values())
+    if total >= self.options.jobs:
+      return False
+    if self.running.get(action.kind, 0) >= self.limits[action.kind]:
+      return False
+    memory = self.memory[action.kind]
+    if self.memory_budget > 0 and self.memory_used > 0 \
+        and self.memory_used + memory > self.memory_budget:
+      return False
+    return True
+
+  def finish(self, action):
+    self.done = self.done + 1
+    for consumer in action.consumers:
+      consumer.pending = consumer.pending - 1
+      if consumer.pending == 0:
+        self.push(consumer)
+
+  def startReady(self):
+    deferred = []
+    while self.ready and not self.stopping:
+      item = heapq.heappop(self.ready)
+      action = item[2]
+      if action.command is None or not isDirty(action, self.log):
+        self.skipped = self.skipped + 1
+        self.finish(action)
+        continue
+      if not self.canStart(action):
+        deferred.append(item)
+        continue
+      self.start(action)
+    for item in deferred:
+      heapq.heappush(self.ready, item)
+
+  def start(self, action):
+    action.tries = action.tries + 1
+    action.ran = True
+    for output in action.outputs:
+      dir_name = os.path.dirname(output)
+      if dir_name != "" and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    if self.options.dry_run:
+      self.results.put((action, 0, "", 0.0))
+    else:
+      thread = threading.Thread(target=self.run, args=(action,))
+      thread.daemon = True
+      thread.start()
+    self.running[action.kind] = self.running.get(action.kind, 0) + 1
+    self.memory_used = self.memory_used + self.memory[action.kind]
+
+  def run(self, action):
+    # in a thread, the output of console actions isn't captured
+    start = time.time()
+    try:
+      if action.kind == "console":
+        process = subprocess.Popen(action.command, shell=True)
+      else:
+        process = subprocess.Popen(action.command, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+      self.processes[action] = process
+      output = process.communicate()[0] or ""
+      status = process.returncode
+    except OSError, e:
+      output, status = "%s\n" % e, -1
+    self.results.put((action, status, output, time.time() - start))
+
+  def complete(self, action, status, output, seconds):
+    self.processes.pop(action, None)
+    self.running[action.kind] = self.running[action.kind] - 1
+    self.memory_used = self.memory_used - self.memory[action.kind]
+
+    # as ninja, the total shrinks as actions are found up to date, whether an
+    # action is dirty is only known when its inputs are done
+    if action.tries == 1:
+      self.ran = self.ran + 1
+    print "[%d/%d] %s" % (self.ran, len(self.actions) - self.skipped, action.description)
+    if self.options.verbose or self.options.dry_run:
+      print action.command
+    sys.stdout.write(output)
+
+    if status == 0:
+      deps = []
+      if action.depfile is not None and not self.options.dry_run:
+        deps = readDepfile(action.depfile)
+      if not self.options.dry_run:
+        self.log.put(action, deps, seconds)
+      self.finish(action)
+      return
+
+    # outputs of a failed action are never up to date
+    removeOutputs(action)
+    if action.tries <= self.options.retries:
+      print "FAILED (%d), retrying: %s" % (status, action.description)
+      self.push(action)
+      return
+    print "FAILED (%d): %s" % (status, " ".join(action.outputs))
+    if action.kind != "console":
+      print action.command
+    self.failed.append(action)
+    if not self.options.keep_going:
+      self.stopping = True
+
+  def execute(self):
+    """ return True if all actions succeed """
+    self.prepare()
+    try:
+      while True:
+        self.startReady()
+        if sum(self.running.values()) == 0:
+          break
+        # get() with timeout, so that it can be interrupted by Ctrl-C
+        action, status, output, seconds = self.results.get(True, 86400)
+        self.complete(action, status, output, seconds)
+    except KeyboardInterrupt:
+      for action, process in self.processes.items():
+        try:
+          process.kill()
+        except OSError:
+          pass
+        removeOutputs(action)
+      print >>sys.stderr, "interrupted"
+      self.failed.append(None)
+    finally:
+      self.log.save()
+    if len(self.failed) > 0 or self.done < len(self.actions):
+      print >>sys.stderr, "build failed, %d of %d actions are done" \
+          % (self.done, len(self.actions))
+      return False
+    return True
+
+def parseOptions(argv):
+  parser = optparse.OptionParser(usage="%prog [options] PATH_TO_BUILD_FILE ...")
+  parser.add_option("-t", "--target", action="append", default=[],
+                    help="debug, release, debug_test, release_test, ss_test, all, test, "
+                    "all_test, or a file to build, can be repeated, debug by default")
+  jobs = multiprocessing.cpu_count()
+  parser.add_option("-j", "--jobs", type="int", default=jobs,
+                    help="number of actions running at the same time, %d by default" % jobs)
+  parser.add_option("--compile_jobs", type="int", help="limit of compiles, --jobs by default")
+  parser.add_option("--archive_jobs", type="int", help="limit of archives, --jobs by default")
+  parser.add_option("--protoc_jobs", type="int", help="limit of protoc runs, --jobs by default")
+  parser.add_option("--link_jobs", type="int",
+                    help="limit of links, %d by default" % ninja.link_pool_depth)
+  parser.add_option("--memory_budget", type="int",
+                    help="MB of memory for running actions, 80%% of the available memory "
+                    "by default, 0 for no limit")
+  parser.add_option("--compile_memory", type="int", default=default_memory["compile"],
+                    help="estimated MB of memory of a compile")
+  parser.add_option("--link_memory", type="int", default=default_memory["link"],
+                    help="estimated MB of memory of a link")
+  parser.add_option("--retries", type="int", default=1,
+                    help="times to retry a failed action")
+  parser.add_option("-k", "--keep_going", action="store_true", default=False,
+                    help="keep going when actions fail")
+  parser.add_option("-n", "--dry_run", action="store_true", default=False,
+                    help="print the commands without running them")
+  parser.add_option("-v", "--verbose", action="store_true", default=False,
+                    help="print the command of each action")
+  parser.add_option("--compile_cache", action="store_true", default=False,
+                    help="look up objects in the compile cache before compiling, "
+                    "see compile_cache.py")
+  parser.add_option("--action_cache", action="store_true", default=False,
+                    help="look up outputs of archives, links and protoc in the action "
+                    "cache before running them, see action_cache.py")
+  parser.add_option("--unity", type="int", default=0,
+                    help="compile .cc sources in bundles of this number, "
+                    "unless the rule sets its own unity")
+  parser.add_option("--shared_debug", action="store_true", default=False,
+                    help="build libraries of the debug setting as shared libraries, "
+                    "so that changing one doesn't relink the tests")
+  parser.add_option("--bundle_tests", action="store_true", default=False,
+                    help="link the cc_test rules of each package into one test runner, "
+                    "except the ones with bundle = False")
+  return parser.parse_args(argv[1:])
+
+def main(argv):
+  options, build_files = parseOptions(argv)
+  if len(build_files) == 0:
+    print >>sys.stderr, "Please specify a BUILD file"
+    sys.exit(-1)
+  options.jobs = max(options.jobs, 1)
+  cc.compile_cache = options.compile_cache
+  cc.action_cache = options.action_cache
+  cc.unity_size = options.unity
+  cc.shared_debug = options.shared_debug
+  cc.bundle_tests = options.bundle_tests
+
+  packages = pconfig.loadPackages(build_files, os.getcwd())
+  pconfig.computeClosures()
+  build_cache.save()
+
+  graph = ActionGraph(ninja.makefileVariables(makefile_header))
+  ninja.emitEdges(packages, graph)
+  actions = graph.neededActions(options.target or ["debug"])
+  ok = Executor(actions, options).execute()
+  if options.compile_cache and not options.dry_run:
+    compile_cache.report()
+  if options.action_cache and not options.dry_run:
+    action_cache.report()
+  if not ok:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv)
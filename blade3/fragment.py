@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import glob
+import hashlib
+import os
+
+import cc
+import package
+import profiler
+
+"""
+Incremental Makefile generation
+
+Rules of each package are written to their own fragment, .blade/mk/<package>.mk,
+and the top-level Makefile includes the fragments. A fragment is only
+re-emitted if its signature changes, the signature covers:
+  - the sources of the generator itself
+  - BUILD content and glob results of the package
+  - the same for every package in the dependency closure of its rules
+  - which rules of the package are expanded (used by the build)
+  - options of pconfig.py changing the rules, i.e. --link_group,
+    --compile_cache, --action_cache, --unity, --shared_debug and
+    --bundle_tests
+"""
+
+fragment_dir = ".blade/mk"
+signature_file = os.path.join(fragment_dir, "signatures")
+
+_generator_fingerprint = None
+
+def generatorFingerprint():
+  global _generator_fingerprint
+  if _generator_fingerprint is None:
+    h = hashlib.sha1()
+    current_file_dir = os.path.dirname(os.path.realpath(__file__))
+    for src in sorted(glob.glob(os.path.join(current_file_dir, "*.py"))):
+      h.update(file(src).read())
+    _generator_fingerprint = h.hexdigest()
+  return _generator_fingerprint
+
+def fragmentPath(pkg):
+  return os.path.join(fragment_dir, pkg.packageName + ".mk")
+
+def packageFingerprint(pkg):
+  # own BUILD content and glob results of the package
+  if pkg.fingerprint is None:
+    h = hashlib.sha1()
+    h.update("%s\n%s\n" % (pkg.packageName, pkg.buildHash))
+    for pattern in sorted(pkg.Glob):
+      h.update("%s: %s\n" % (pattern, " ".join(pkg.Glob[pattern])))
+    pkg.fingerprint = h.hexdigest()
+  return pkg.fingerprint
+
+def buildRuleSignature(r):
+  # signatures of all deps must have been built
+  h = hashlib.sha1()
+  h.update("%s\n%s\n" % (r.fullRuleName(), packageFingerprint(r.package)))
+  for dep in r.depRulesList:
+    h.update("%s\n" % dep.signature)
+  r.signature = h.hexdigest()
+
+def packageSignature(pkg, rules):
+  h = hashlib.sha1()
+  h.update("%s\n%s\n" % (generatorFingerprint(), packageFingerprint(pkg)))
+  # options changing the emitted rules
+  h.update("link_group: %s\n" % cc.link_group)
+  h.update("compile_cache: %s\n" % cc.compile_cache)
+  h.update("action_cache: %s\n" % cc.action_cache)
+  h.update("unity: %d\n" % cc.unity_size)
+  h.update("shared_debug: %s\n" % cc.shared_debug)
+  h.update("bundle_tests: %s\n" % cc.bundle_tests)
+  for r in rules:
+    h.update("%s\n" % r.signature)
+  return h.hexdigest()
+
+def expandedRules(pkg):
+  # only rules used by the build are expanded and can be emitted
+  return [r for r in pkg.ruleList if r.expanded]
+
+def readSignatures():
+  res = {}
+  try:
+    for line in file(signature_file):
+      fields = line.split()
+      if len(fields) == 2:
+        res[fields[1]] = fields[0]
+  except IOError:
+    pass
+  return res
+
+def writeSignatures(signatures):
+  if not os.path.exists(fragment_dir):
+    os.makedirs(fragment_dir)
+  tmp_file = signature_file + ".tmp"
+  p = file(tmp_file, "w")
+  for name in sorted(signatures):
+    print >>p, "%s %s" % (signatures[name], name)
+  p.close()
+  os.rename(tmp_file, signature_file)
+
+def emitPackageFragment(pkg, rules):
+  path = fragmentPath(pkg)
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  profiler.output(path)
+  tmp_file = path + ".tmp"
+  f = file(tmp_file, "w")
+  print >>f, "# Do NOT modify this file. It's auto-generated by gen_makefile."
+  print >>f, "# rules of //%s/BUILD" % pkg.packageName
+  print >>f
+  for r in rules:
+    r.emitMake(f)
+  for r in rules:
+    r.emitStaticCheck(f)
+  f.close()
+  os.rename(tmp_file, path)
+
+def emitFragments(f):
+  """
+   write fragments of all loaded packages, and include them in Makefile f.
+   return the number of re-emitted fragments.
+  """
+  all_rules = []
+  for name in sorted(package.globalPackages):
+    all_rules.extend(expandedRules(package.globalPackages[name]))
+  cc.visitDepsFirst(all_rules,
+                    lambda r: r.signature is not None,
+                    buildRuleSignature)
+
+  old_signatures = readSignatures()
+  signatures = {}
+  emitted = 0
+
+  # each rule is emitted to the fragment of its own package only
+  cc.emit_deps_make = False
+  try:
+    for name in sorted(package.globalPackages):
+      pkg = package.globalPackages[name]
+      rules = expandedRules(pkg)
+      if len(rules) == 0:
+        continue
+      signatures[name] = packageSignature(pkg, rules)
+      if old_signatures.get(name) != signatures[name] \
+          or not os.path.exists(fragmentPath(pkg)):
+        emitPackageFragment(pkg, rules)
+        emitted = emitted + 1
+      print >>f, "include %s" % fragmentPath(pkg)
+  finally:
+    cc.emit_deps_make = True
+  print >>f
+
+  writeSignatures(signatures)
+  return emitted
@@ -7,6 +7,8 @@ __author__ = 'liuyong@agora.io(Yong Liu)'
 import package
 import rule
 import cc
+import ninja
+import recipe
 import os, sys
 from dirs import build_dir
 from dirs import settings_list
@@ -45,6 +47,11 @@ class GenRule(rule.Rule):
 
     self.emited = True
 
+  def emitNinja(self, f):
+    ninja.build(f, ["%s.%s" % (self.package.packageName, self.ruleName)], "gen_rule",
+                ["%s/BUILD" % self.package.packageName],
+                variables=[("cmd", " && ".join(self.cmdsList))])
+
 class ProtoLibrary(cc.CCLibrary):
   """
     proto_library(name = "",
@@ -63,6 +70,18 @@ class ProtoLibrary(cc.CCLibrary):
   def genHeaderPath(self, fileName):
     return "%s/pb/c++/%s.pb.h" % (build_dir, self.srcPath(fileName)[:-6])
 
+  def genPyPath(self, fileName):
+    return "%s/pb/py/%s_pb2.py" % (build_dir, self.srcPath(fileName)[:-6])
+
+  def protocOutputs(self, fileName):
+    return [self.genSrcPath(fileName), self.genHeaderPath(fileName), self.genPyPath(fileName)]
+
+  def protocCommand(self, fileName):
+    # imported protos are hashed by their generated headers
+    return "%s${PROTOC} --python_out=%s/pb/py --cpp_out=%s/pb/c++ -I./ %s" \
+        % (cc.actionCache(self.protocOutputs(fileName), sorted(self.depPBHeaderPathSet())),
+           build_dir, build_dir, self.srcPath(fileName))
+
   def genHeaderPathSet(self):
    result = set()
    for src in self.srcsList:
@@ -95,12 +114,11 @@ class ProtoLibrary(cc.CCLibrary):
                                 self.protoTarget(),
                                 self.srcPath(src),
                                 )
-      print >>f, '\t@${PRINT} "_____protoc %s"' % self.srcPath(src)
-      print >>f, "\tif [ ! -x %s/pb/c++ ]; then mkdir -p %s/pb/c++; fi" % (build_dir, build_dir)
-      print >>f, "\tif [ ! -x %s/pb/py ]; then mkdir -p %s/pb/py; fi" % (build_dir, build_dir)
-      print >>f, "\t${PROTOC} --python_out=%s/pb/py --cpp_out=%s/pb/c++ -I./ %s" \
-          % (build_dir, build_dir, self.srcPath(src))
+      recipe.action(f, "_____protoc %s" % self.srcPath(src))
+      print >>f, "\t%s" % self.protocCommand(src)
       print >>f, "\n"
+      recipe.outputDirs(f, [self.genSrcPath(src), self.genHeaderPath(src)],
+                        [build_dir + "/pb/c++", build_dir + "/pb/py"])
     
     temp_settings = list(settings_list)
     temp_settings.append("struct_check_dbg")
@@ -114,15 +132,15 @@ class ProtoLibrary(cc.CCLibrary):
         obj_dir = os.path.dirname(self.objectPath(obj, settings_name))
         print >>f, "%s: %s %s %s" % (self.objectPath(obj, settings_name),
                                   self.genSrcPath(src),
-                                  " ".join(self.depPBHeaderPathSet()),
+                                  self.depPBHeaderPaths(),
                                   " ".join(sorted(set(self.depLibPathList(settings_name))))
                                   )
-        print >>f, '\t@${PRINT} "_____compile %s %s"' % (settings_name, self.srcPath(src))
-        print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (obj_dir, obj_dir)
+        recipe.action(f, "_____compile %s %s" % (settings_name, self.srcPath(src)))
         print >>f, "\t%s -o %s -c %s" % (self.compileTool(src, settings_name),
                                          self.objectPath(obj, settings_name),
                                          self.genSrcPath(src))
         print >>f, "\n"
+        recipe.outputDirs(f, [self.objectPath(obj, settings_name)], [obj_dir])
         print >>f, "-include %s" % (self.objectPath(depfile, settings_name))
         print >>f, "\n"
     
@@ -130,19 +148,13 @@ class ProtoLibrary(cc.CCLibrary):
       # Linking to lib
       print >>f, "%s: %s" % (self.makeTargetName(settings_name),
                                 self.objectPathList(settings_name))
-      print >>f, '\t@${PRINT} "_____link [%s]"' % self.makeTargetName(settings_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (self.targetDir(settings_name),
-                                                             self.targetDir(settings_name))
-      print >>f, "\t${AR} %s %s" % (self.makeTargetName(settings_name), self.objectPathList(settings_name))
-      print >>f, "\n"
+      self.emitArchiveMake(f, settings_name)
 
     # merge the cpps' layouts to the binary layout file. 
     for setting in ["struct_check_dbg", "struct_check_opt"]:
       base_name = self.makeTargetName(setting)
       print >>f, "%s: %s" % (base_name, self.objectPathList(setting))
-      print >>f, '\t@${PRINT} "_____merging the layouts [%s]"' %(base_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" \
-          % (self.targetDir(setting), self.targetDir(setting))
+      recipe.action(f, "_____merging the layouts [%s]" % base_name)
       fmt_str = "\t@if ${STRUCT_CHECK_TOOL} --out_file %s --dot_file %s %s; " + \
         "then echo \"layout checking succeeded\"; else dot -Tpng -o %s %s;" + \
         "echo \"layout check Failed, please see the dependant graph \033[31m%s\033[m of classes " + \
@@ -154,6 +166,7 @@ class ProtoLibrary(cc.CCLibrary):
           base_name + ".png",
           base_name + ".dot",
           base_name + ".png")
+      recipe.outputDirs(f, [base_name], [self.targetDir(setting)])
  
   def emitPubMake(self, f):
     for src in self.srcsList:
@@ -162,11 +175,11 @@ class ProtoLibrary(cc.CCLibrary):
                                 self.protoTarget(),
                                 self.srcPath(src),
                                 )
-      print >>f, "\t@${PRINT} _____protoc %s" % self.srcPath(src)
-      print >>f, "\tif [ ! -x %s/pb/c++ ]; then mkdir -p %s/pb/c++; fi" % (build_dir, build_dir)
-      print >>f, "\tif [ ! -x %s/pb/py ]; then mkdir -p %s/pb/py; fi" % (build_dir, build_dir)
-      print >>f, "\t${PROTOC} --python_out=%s/pb/py --cpp_out=%s/pb/c++ -I./ %s" % \
-          (build_dir, build_dir, self.srcPath(src))
+      recipe.action(f, "_____protoc %s" % self.srcPath(src))
+      print >>f, "\t%s" % self.protocCommand(src)
+      print >>f
+      recipe.outputDirs(f, [self.genSrcPath(src), self.genHeaderPath(src)],
+                        [build_dir + "/pb/c++", build_dir + "/pb/py"])
     print >>f, "\n"
 
     packageDir = self.package.packageName
@@ -175,10 +188,10 @@ class ProtoLibrary(cc.CCLibrary):
       pubDir = "pub/src/" + packageDir
       parentDir = os.path.abspath(os.path.dirname(packageDir))
       print >>f, "%s: %s" % (packageDir, pubDir)
-      print >>f, '\t@${PRINT} "_____symbolic link [%s]"' % packageDir
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (parentDir, parentDir)
+      recipe.action(f, "_____symbolic link [%s]" % packageDir)
       print >>f, "\tln -f -s -t %s %s" % (parentDir, os.path.relpath(pubDir, parentDir))
       print >>f, "\n"
+      recipe.outputDirs(f, [packageDir], [parentDir])
     
     temp_settings = list(settings_list)
     temp_settings.append("struct_check_dbg")
@@ -187,14 +200,35 @@ class ProtoLibrary(cc.CCLibrary):
     for settings_name in temp_settings:
       print >>f, "%s: %s %s" % (self.makeTargetName(settings_name), packageDir,
                                 self.pubMakeTargetName(settings_name))
-      print >>f, '\t@${PRINT} "_____symbolic link [%s]"' % self.makeTargetName(settings_name)
-      print >>f, "\tif [ ! -x %s ]; then mkdir -p %s; fi" % (self.targetDir(settings_name),
-                                                             self.targetDir(settings_name))
+      recipe.action(f, "_____symbolic link [%s]" % self.makeTargetName(settings_name))
       print >>f, "\tln -f -s -t %s %s" % (self.targetDir(settings_name),
                                           os.path.relpath(self.pubMakeTargetName(settings_name),
                                                           self.targetDir(settings_name)))
       print >>f, "\n"
+      recipe.outputDirs(f, [self.makeTargetName(settings_name)], [self.targetDir(settings_name)])
   
+  def emitProtocNinja(self, f):
+    for src in self.srcsList:
+      ninja.build(f, [self.genSrcPath(src), self.genHeaderPath(src)], "protoc",
+                  [self.srcPath(src)], order_only=sorted(self.depPBHeaderPathSet()),
+                  variables=cc.actionCacheVariables(self.protocOutputs(src),
+                                                    sorted(self.depPBHeaderPathSet())))
+
+  def emitSelfNinja(self, f):
+    self.emitProtocNinja(f)
+    order_only = self.ninjaOrderOnly()
+    for settings_name in settings_list:
+      for src in self.srcsList:
+        obj = "%s.pb.o" % src[:-6]
+        ninja.build(f, [self.objectPath(obj, settings_name)], "cc", [self.genSrcPath(src)],
+                    implicit=[self.genHeaderPath(src)], order_only=order_only,
+                    variables=[("cmd", self.compileTool(src, settings_name))])
+      self.emitArchiveNinja(f, settings_name)
+
+  def emitPubNinja(self, f):
+    self.emitProtocNinja(f)
+    cc.CCLibrary.emitPubNinja(self, f)
+
 class SetPackageAttr:
   """
     set_package_attr()
@@ -0,0 +1,10 @@
+// Version of the codebase, generated by `git describe --tags --always` while
+// running gen_makefile.sh, and linked into every cc_binary and cc_test.
+#ifndef BUILD_TOOLS_BLADE3_GIT_DESC_H_
+#define BUILD_TOOLS_BLADE3_GIT_DESC_H_
+
+extern "C" const char kGitDesc[];
+
+#define GIT_DESC kGitDesc
+
+#endif  // BUILD_TOOLS_BLADE3_GIT_DESC_H_
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import os
+import pipes
+import re
+import sys
+
+import package
+import cc
+import profiler
+import stamp
+from dirs import makefile_header
+from dirs import settings_list
+
+"""
+build.ninja emitter, enabled by pconfig.py --ninja
+
+It's written next to the Makefile from the same rules, each rule class has
+an emitNinja(f) for its build edges, as emitMake(f) for its make rules.
+Compile edges use "deps = gcc", so ninja keeps the header dependencies in
+its own log instead of reading .d files, and link edges run in a pool of
+their own. The variables (compilers and flags) are read from
+Makefile.header, so both files build with the same commands.
+
+  $ ninja              # the same as 'make debug'
+  $ ninja release_test
+"""
+
+ninja_file = "build.ninja"
+
+# links are memory hungry, don't run too many of them at the same time
+link_pool_depth = 4
+
+_assignment_regex = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)$")
+
+# package dirs linked to pub/src, emitted once per package
+_emitted_pub_dirs = set()
+
+# name, bindings of the ninja rules, they are also run by executor.py.
+# $launcher runs a command through the action cache, see cc.actionCache()
+rules = [
+  ("cc", [("command", "$cmd -MF $out.d -o $out -c $in"),
+          ("depfile", "$out.d"),
+          ("deps", "gcc"),
+          ("description", "_____compile $in")]),
+  # $in is the stub of the header, see CCLibrary.pchStub()
+  ("pch", [("command", "$cmd -MF $out.d -o $out -c $in"),
+           ("depfile", "$out.d"),
+           ("deps", "gcc"),
+           ("description", "_____precompile $header")]),
+  ("ar", [("command", "$launcher${AR} $out $in"),
+          ("description", "_____link [$out]")]),
+  ("link", [("command", "$cmd"),
+            ("pool", "link_pool"),
+            ("description", "_____link [$out]")]),
+  # PROTOC isn't in Makefile.header, it comes from the environment as in make
+  ("protoc", [("command", "mkdir -p .build/pb/c++ .build/pb/py && "
+               "$launcher$${PROTOC} --python_out=.build/pb/py --cpp_out=.build/pb/c++ -I./ $in"),
+              ("description", "_____protoc $in")]),
+  ("symlink", [("command", "mkdir -p $dir && ln -f -s -t $dir $target"),
+               ("description", "_____symbolic link [$out]")]),
+  ("gen_rule", [("command", "$cmd"),
+                ("description", "_____gen_rule $out")]),
+  # outputs of the rules below are never written, so they always run
+  ("run", [("command", "$cmd"),
+           ("pool", "console")]),
+  ("regen", [("command", "python build_tools/blade3/pconfig.py $args"),
+             ("generator", "1"),
+             ("description", "BUILD file updated, regenerating $out")]),
+]
+
+def escapePath(path):
+  return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+def makefileVariables(path):
+  """ (name, value) of variable assignments in Makefile.header, in order """
+  res = []
+  line = ""
+  for a in file(path):
+    a = a.rstrip("\n")
+    if a.endswith("\\"):
+      line += a[:-1]
+      continue
+    line += a
+    matcher = _assignment_regex.match(line)
+    if matcher is not None:
+      res.append((matcher.group(1), " ".join(matcher.group(2).split())))
+    line = ""
+  return res
+
+def build(f, outputs, rule, inputs, implicit=[], order_only=[], variables=[]):
+  if hasattr(f, "addEdge"):
+    # the executor collects edges instead of writing them, see executor.py
+    f.addEdge(outputs, rule, inputs, implicit, order_only, variables)
+    return
+  res = "build %s: %s" % (" ".join([escapePath(a) for a in outputs]), rule)
+  if len(inputs) > 0:
+    res += " " + " ".join([escapePath(a) for a in inputs])
+  if len(implicit) > 0:
+    res += " | " + " ".join([escapePath(a) for a in implicit])
+  if len(order_only) > 0:
+    res += " || " + " ".join([escapePath(a) for a in order_only])
+  print >>f, res
+  for name, value in variables:
+    print >>f, "  %s = %s" % (name, value)
+
+def emitPubPackageDir(f, packageName):
+  # the package dir is a symbolic link to pub/src
+  if packageName in _emitted_pub_dirs:
+    return
+  _emitted_pub_dirs.add(packageName)
+  parentDir = os.path.abspath(os.path.dirname(packageName))
+  pubDir = "pub/src/" + packageName
+  build(f, [packageName], "symlink", [pubDir],
+        variables=[("dir", parentDir), ("target", os.path.relpath(pubDir, parentDir))])
+
+def emitRules(f):
+  print >>f, "ninja_required_version = 1.5"
+  print >>f, "builddir = .build"
+  print >>f
+  try:
+    for name, value in makefileVariables(makefile_header):
+      print >>f, "%s = %s" % (name, value)
+  except IOError, e:
+    print >>sys.stderr, e
+    sys.exit(-1)
+  print >>f
+
+  print >>f, "pool link_pool"
+  print >>f, "  depth = %d" % link_pool_depth
+  print >>f
+  for name, bindings in rules:
+    print >>f, "rule %s" % name
+    for key, value in bindings:
+      print >>f, "  %s = %s" % (key, value)
+    print >>f
+
+def emitEntryPoints(f, packages):
+  """ the same entry points as the Makefile """
+  rules_to_build = package.rulesToBuild(packages)
+
+  # runners of bundled tests, see package.emitMake()
+  test_bundles = []
+  bundled = set()
+  if cc.bundle_tests:
+    test_bundles = cc.bundleTests(rules_to_build)
+    for bundle in test_bundles:
+      bundle.emitNinja(f)
+      bundled.update(bundle.tests)
+    if len(test_bundles) > 0:
+      print >>f
+
+  # cc_pyext has no link edge, as it has no link rule in the Makefile
+  for settings_name in settings_list:
+    targets_list = [rule.makeTargetName(settings_name) for rule in rules_to_build
+                    if (rule.is_binary == 1 or rule.is_library == 1) and rule not in bundled]
+    targets_list.extend([a.makeTargetName(settings_name) for a in test_bundles])
+    build(f, [settings_name], "phony", targets_list)
+  print >>f
+
+  for settings_name in settings_list:
+    test_targets = [rule.makeTargetName(settings_name) for rule in rules_to_build
+                    if rule.is_unittest == 1 and rule not in bundled]
+    commands = [(a.makeTargetName(settings_name), a.runCommand(settings_name))
+                for a in test_bundles]
+    cmd = package.testRunnerCommand("%s_test" % settings_name, test_targets, commands,
+                                    "$${UNIT_TEST_OPTIONS}")
+    if len(test_targets) + len(commands) == 0:
+      cmd = "echo 'No test defined in your BUILD files'"
+    build(f, ["%s_test" % settings_name], "run", [],
+          implicit=[settings_name] + test_targets + [a[0] for a in commands],
+          variables=[("cmd", cmd)])
+  print >>f
+
+  script_files = []
+  for rule in rules_to_build:
+    if rule.is_script_test == 1:
+      script_files.extend(rule.scriptsPathList())
+  cmd = package.testRunnerCommand("ss_test", script_files)
+  if len(script_files) == 0:
+    cmd = "echo 'No shell script test defined in your BUILD files'"
+  build(f, ["ss_test"], "run", [], implicit=list(settings_list) + script_files,
+        variables=[("cmd", cmd)])
+  print >>f
+
+  build(f, ["all"], "phony", list(settings_list))
+  build(f, ["test"], "phony", ["%s_test" % settings_list[0]])
+  build(f, ["all_test"], "phony", ["%s_test" % a for a in settings_list])
+  print >>f, "default %s" % settings_list[0]
+  print >>f
+
+def emitRegen(f, packages, args):
+  # ninja regenerates build.ninja and restarts when a BUILD file is changed
+  build_files = [globalPackage.packageName + "/BUILD"
+                 for globalPackage in package.globalPackages.values()]
+  build(f, [ninja_file], "regen", sorted(build_files),
+        variables=[("args", " ".join([pipes.quote(a) for a in args]))])
+
+def emitEdges(packages, f):
+  """ build edges of all expanded rules, and the entry points """
+  stamp.emitNinja(f)
+  print >>f
+  for name in sorted(package.globalPackages):
+    for rule in package.globalPackages[name].ruleList:
+      if rule.expanded:
+        rule.emitNinja(f)
+  print >>f
+  emitEntryPoints(f, packages)
+
+def emitNinja(packages, f, args):
+  """
+   write build edges of all expanded rules to f. args are the arguments
+   of pconfig.py to regenerate it.
+  """
+  emitRules(f)
+  emitEdges(packages, f)
+  emitRegen(f, packages, args)
+  profiler.output(ninja_file)
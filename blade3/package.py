@@ -3,10 +3,18 @@
 __author__ = 'liuyong@agora.io(Yong Liu)'
 
 import os
-import fnmatch
+import copy
+import pipes
 import sys
 import rule as rule_package
 import rule_generator
+import build_cache
+import cc
+import depdb
+import dir_index
+import fragment
+import profiler
+import stamp
 from dirs import build_dir
 from dirs import makefile_header
 from dirs import settings_list
@@ -28,110 +36,35 @@ packageName : package
 globalPackages = {}
 currentPackage = None
 
-def findFiles(root_dir, file_pattern):
-  matches = []
-  for root, dirnames, filenames in os.walk(root_dir):
-    for filename in fnmatch.filter(filenames, file_pattern):
-      matches.append(os.path.join(root, filename))
-  return matches
-
-def emitMake(packages, f):
-  """
-   1. emit BUILDFLAGS for debug and relase building
-   2. create default rule depend on CTARGET argument
-   3. for each rule, emit it rule and depending rule to makefile
-  """
-  try:
-    print >>f, "%s" % file(makefile_header).read()
-    print >>f
-  except Exception, e:
-    print >>sys.stderr, e
-    sys.exit(-1)
+# 0: quiet, 1: print loaded packages and expanded rules, 2: also dump rules
+verbosity = 0
 
-  rules_to_build = []
-  for package in packages:
-    if package.isPubOnly:
-      for rule in package.ruleList:
-        if rule.is_unittest:
-          rules_to_build.append(rule)
-    else:
-      for rule in package.ruleList:
-         rules_to_build.append(rule)
+"""
+packageName : (exit status, stdout, stderr) of BUILD files
+failed in workers, see parallel.py
+"""
+preloadErrors = {}
 
-  for rule in rules_to_build:
-    rule.emitMake(f)
+def findFiles(root_dir, file_pattern):
+  with profiler.timer("find files"):
+    return dir_index.findFiles(root_dir, file_pattern)
 
-  for rule in rules_to_build:
-    rule.emitStaticCheck(f)
+def ruleDepLabels(packageName, r):
+  # deps of a rule as full labels
+  return [(i if not i.startswith(":") else "//" + packageName + "/BUILD" + i)
+          for i in r.depsList]
 
+def emitSideFiles(packages):
   """
-   debug is the default debug binary rule,
-   release is the default release rule
+   emit files under .blade for other tools:
+   all_deps, deps.db, src_files, files_to_pub, exe_files
   """
-  for settings_name in settings_list:
-    targets_list = [rule.makeTargetName(settings_name) for rule in rules_to_build
-                    if rule.is_binary == 1 or rule.is_library == 1 or rule.is_pyext == 1]
-    print >>f, "%s: pre %s" % (settings_name, " ".join(targets_list))
-  print >>f
-
-  # emit rule to run all unit tests for current packages
-  all_test_target_num = 0
-  for settings_name in settings_list:
-    test_targets = [rule.makeTargetName(settings_name) for rule in rules_to_build
-                    if rule.is_unittest == 1]
-    all_test_target_num = all_test_target_num + len(test_targets)
-
-    print >>f, "%s_test: %s %s" % (settings_name, settings_name, " ".join(test_targets))
-    for test in test_targets:
-      print >>f, "\t@${PRINT}"
-      print >>f, "\t@${PRINT_WARNING} $$ %s ${UNIT_TEST_OPTIONS}" % test
-      print >>f, "\t@%s ${UNIT_TEST_OPTIONS}" % test
-
-    if len(test_targets) == 0:
-      print >>f, "\t@${PRINT_WARNING} 'No test defined in your BUILD files'"
-    print >>f
-
-    if len(test_targets) == 0:
-      print >>f, "%s_test_until_die: internal_no_test_defined" % settings_name
-      print >>f
-    else:
-      print >>f, "%s_test_until_die: internal_%s_test_until_die" % (settings_name, settings_name)
-      print >>f
-
-  # emit rule to run all script tests for current packages
-  script_files = []
-  for rule in rules_to_build:
-    if rule.is_script_test == 1:
-      script_files.extend(rule.scriptsPathList())
-  all_test_target_num = all_test_target_num + len(script_files)
-
-  print >>f, "ss_test: %s %s" % (" ".join(settings_list), " ".join(script_files))
-  for ss_test in script_files:
-    print >>f, "\t@${PRINT}"
-    print >>f, "\tbash -x %s" % ss_test
-  if len(script_files) == 0:
-    print >>f, "\t@${PRINT_WARNING} 'No shell script test defined in your BUILD files'"
-  print >>f
-
-  if all_test_target_num == 0:
-    print >>f, "test_until_die: internal_no_test_defined"
-    print >>f
-  else:
-    print >>f, "test_until_die: internal_test_until_die"
-    print >>f
-
-  # emit rule to update Makefile
-  print >>f, "Makefile: %s" % " ".join([globalPackages[a].packageName + "/BUILD" for a in globalPackages])
-  print >>f, "\t@${PRINT_ERROR} BUILD file updated: $?"
-  print >>f, "\t@${PRINT_ERROR} Please run ./gen_makefile.sh to update the Makefile"
-  print >>f, "\t@false"
-  print >>f
-
   if not os.path.exists(".blade"):
     os.mkdir(".blade");
 
   # emit all deps
   p = file(".blade/all_deps", "w")
+  profiler.output(".blade/all_deps")
   print >>p, "packages = {"
   for package in packages:
     print >>p, "'//%s/BUILD': %s," % (package.packageName,
@@ -141,18 +74,25 @@ def emitMake(packages, f):
   print >>p, "deps_graph = {"
   for name in globalPackages:
     for r in globalPackages[name].ruleList:
-      print >>p, "'//%s/BUILD:%s': %s," % (name, r.ruleName,
-                                         set([(i if not i.startswith(":") else "//" + name + "/BUILD" + i)
-                                              for i in r.depsList]))
+      print >>p, "'//%s/BUILD:%s': %s," % (name, r.ruleName, set(ruleDepLabels(name, r)))
   print >>p, "}"
   print >>p, "rule_types = {"
   for name in globalPackages:
     for r in globalPackages[name].ruleList:
       print >>p, "'//%s/BUILD:%s': '%s'," % (name, r.ruleName, r.buildName)
   print >>p, "}"
+  p.close()
+
+  # the same graph, and sources of rules, for query.py and affected.py
+  depdb.write(depdb.db_file, ["//%s/BUILD" % a.packageName for a in packages],
+              [("//%s/BUILD:%s" % (name, r.ruleName), r.buildName, ruleDepLabels(name, r),
+                [os.path.join(name, a) for a in getattr(r, "srcsList", [])])
+               for name in globalPackages for r in globalPackages[name].ruleList])
+  profiler.output(depdb.db_file)
 
   # emit src files
   p = file(".blade/src_files", "w")
+  profiler.output(".blade/src_files")
   print >>p, "# Do NOT modify this file. It's auto-generated by gen_makefile."
   for package in packages:
     for src in findFiles(package.packageName, "*.cc"):
@@ -160,6 +100,7 @@ def emitMake(packages, f):
 
   # emit pub files
   p = file(".blade/files_to_pub", "w")
+  profiler.output(".blade/files_to_pub")
   print >>p, "# Do NOT modify this file. It's auto-generated by gen_makefile."
   print >>p
   print >>p
@@ -210,10 +151,10 @@ def emitMake(packages, f):
       print >>p, "%s\t%s" % (src, pub_dir)
     print >>p
 
-  print >>f
 
   # emit executable files
   p = file(".blade/exe_files", "w")
+  profiler.output(".blade/exe_files")
   print >>p, "# Do NOT modify this file. It's auto-generated by gen_makefile."
   print >>p
   print >>p
@@ -225,6 +166,152 @@ def emitMake(packages, f):
           print >>p, "%s/%s/targets/%s/%s" % (build_dir, settings_name, package.packageName, r.ruleName)
     print >>p
 
+def rulesToBuild(packages):
+  # only unit tests are built in pub-only packages
+  rules_to_build = []
+  for package in packages:
+    if package.isPubOnly:
+      for rule in package.ruleList:
+        if rule.is_unittest:
+          rules_to_build.append(rule)
+    else:
+      for rule in package.ruleList:
+         rules_to_build.append(rule)
+  return rules_to_build
+
+def testRunnerCommand(name, tests, commands=[], options=""):
+  """
+   the command running tests by ${TEST_RUNNER}, see test_runner.py.
+   commands are (name, shell command) run as tests, options are appended
+   to the tests and commands.
+  """
+  res = "${TEST_RUNNER} --name %s" % name
+  for command_name, command in commands:
+    res += " --command %s %s" % (command_name, pipes.quote(command))
+  if len(tests) > 0:
+    res += " " + " ".join(tests)
+  if len(options) > 0:
+    res += " -- " + options
+  return res
+
+def emitMake(packages, f, incremental=False, args=[]):
+  """
+   1. emit BUILDFLAGS for debug and relase building
+   2. create default rule depend on CTARGET argument
+   3. for each rule, emit it rule and depending rule to makefile,
+      or to per-package fragments included by makefile if incremental
+   args are the arguments of pconfig.py, to update the Makefile
+  """
+  try:
+    print >>f, "%s" % file(makefile_header).read()
+    print >>f
+  except Exception, e:
+    print >>sys.stderr, e
+    sys.exit(-1)
+
+  rules_to_build = rulesToBuild(packages)
+
+  if incremental:
+    emitted = fragment.emitFragments(f)
+    print "%d of %d Makefile fragments are re-emitted" % (emitted, len(globalPackages))
+  else:
+    for rule in rules_to_build:
+      rule.emitMake(f)
+
+    for rule in rules_to_build:
+      rule.emitStaticCheck(f)
+
+  # version stamp linked into binaries
+  stamp.emitMake(f)
+
+  # runners of bundled tests, built and run instead of the tests they bundle
+  test_bundles = []
+  bundled = set()
+  if cc.bundle_tests:
+    test_bundles = cc.bundleTests(rules_to_build)
+    for bundle in test_bundles:
+      bundle.emitMake(f)
+      bundled.update(bundle.tests)
+
+  """
+   debug is the default debug binary rule,
+   release is the default release rule
+  """
+  for settings_name in settings_list:
+    targets_list = [rule.makeTargetName(settings_name) for rule in rules_to_build
+                    if (rule.is_binary == 1 or rule.is_library == 1 or rule.is_pyext == 1)
+                    and rule not in bundled]
+    targets_list.extend([a.makeTargetName(settings_name) for a in test_bundles])
+    print >>f, "%s: pre %s" % (settings_name, " ".join(targets_list))
+    if cc.compile_cache:
+      print >>f, "\t@${COMPILE_CACHE} --stats"
+    if cc.action_cache:
+      print >>f, "\t@${ACTION_CACHE} --stats"
+  print >>f
+
+  # emit rule to run all unit tests for current packages
+  all_test_target_num = 0
+  for settings_name in settings_list:
+    test_targets = [rule.makeTargetName(settings_name) for rule in rules_to_build
+                    if rule.is_unittest == 1 and rule not in bundled]
+    bundle_targets = [a.makeTargetName(settings_name) for a in test_bundles]
+    all_test_target_num = all_test_target_num + len(test_targets) + len(bundle_targets)
+
+    print >>f, "%s_test: %s %s" % (settings_name, settings_name,
+                                   " ".join(test_targets + bundle_targets))
+    if len(test_targets) + len(bundle_targets) == 0:
+      print >>f, "\t@${PRINT_WARNING} 'No test defined in your BUILD files'"
+    else:
+      commands = [(a.makeTargetName(settings_name), a.runCommand(settings_name))
+                  for a in test_bundles]
+      print >>f, "\t@%s" % testRunnerCommand("%s_test" % settings_name, test_targets,
+                                             commands, "${UNIT_TEST_OPTIONS}")
+    print >>f
+
+    if len(test_targets) + len(bundle_targets) == 0:
+      print >>f, "%s_test_until_die: internal_no_test_defined" % settings_name
+      print >>f
+    else:
+      print >>f, "%s_test_until_die: internal_%s_test_until_die" % (settings_name, settings_name)
+      print >>f
+
+  # emit rule to run all script tests for current packages
+  script_files = []
+  for rule in rules_to_build:
+    if rule.is_script_test == 1:
+      script_files.extend(rule.scriptsPathList())
+  all_test_target_num = all_test_target_num + len(script_files)
+
+  print >>f, "ss_test: %s %s" % (" ".join(settings_list), " ".join(script_files))
+  if len(script_files) == 0:
+    print >>f, "\t@${PRINT_WARNING} 'No shell script test defined in your BUILD files'"
+  else:
+    print >>f, "\t@%s" % testRunnerCommand("ss_test", script_files)
+  print >>f
+
+  if all_test_target_num == 0:
+    print >>f, "test_until_die: internal_no_test_defined"
+    print >>f
+  else:
+    print >>f, "test_until_die: internal_test_until_die"
+    print >>f
+
+  # emit rule to update Makefile
+  print >>f, "Makefile: %s" % " ".join([globalPackages[a].packageName + "/BUILD" for a in globalPackages])
+  if incremental:
+    # make re-reads the Makefile and fragments after updating them
+    print >>f, "\t@${PRINT_WARNING} BUILD file updated: $?"
+    print >>f, "\t@python build_tools/blade3/pconfig.py %s" \
+        % " ".join([pipes.quote(a) for a in args])
+  else:
+    print >>f, "\t@${PRINT_ERROR} BUILD file updated: $?"
+    print >>f, "\t@${PRINT_ERROR} Please run ./gen_makefile.sh to update the Makefile"
+    print >>f, "\t@false"
+  print >>f
+
+  with profiler.timer("side files"):
+    emitSideFiles(packages)
+  print >>f
   print >>f
 
   # emit rule to lint
@@ -239,8 +326,9 @@ def emitMake(packages, f):
   for package in packages:
     if package.is_third_party: continue
     cc_files = []
-    for a in os.walk(package.packageName):
-      cc_files = cc_files + [ "/".join([a[0], b]) for b in a[2] if b.endswith(".h") or b.endswith(".cc") ]
+    with profiler.timer("lint file listing"):
+      for a in dir_index.walk(package.packageName):
+        cc_files = cc_files + [ "/".join([a[0], b]) for b in a[2] if b.endswith(".h") or b.endswith(".cc") ]
 
     # 过滤掉一些不该 lint 的源码
     cc_files = [sf for sf in cc_files
@@ -265,6 +353,20 @@ def emitMake(packages, f):
       last_ending = ending;
   print >>f
 
+def copyArguments(kwargs):
+  # rule arguments are strings, bools or lists of strings,
+  # only the lists need to be copied
+  res = {}
+  for key in kwargs:
+    value = kwargs[key]
+    if type(value) == type([]):
+      res[key] = list(value)
+    elif type(value) in (str, unicode, bool, int, type(None)):
+      res[key] = value
+    else:
+      res[key] = copy.deepcopy(value)
+  return res
+
 class Package(object):
   def __init__(self, name, dirPrefix):
     '''
@@ -285,14 +387,22 @@ class Package(object):
       name = name[:-1]
 
     self.packageName = name
-    print "load package: //%s/BUILD" % name
+    if verbosity >= 1:
+      print "load package: //%s/BUILD" % name
 
     self.is_third_party = False
 
     self.dirPrefix = dirPrefix
     self.ruleList = []
     self.ruleMap = {}
+    # glob pattern => matched files, for srcs and excludes of rules
     self.Glob = {}
+    # (build name, arguments) of rules created by the BUILD file
+    self.ruleCalls = []
+    # sha1 of the BUILD file content
+    self.buildHash = None
+    # sha1 of BUILD content and glob results, see fragment.py
+    self.fingerprint = None
     self.isPubOnly = False
 
     # no files should be copid to //pub, if the package is private
@@ -341,6 +451,27 @@ class Package(object):
       return None
     return self.ruleMap[ruleName]
 
+  def glob(self, pattern):
+    if pattern not in self.Glob:
+      profiler.count("globs")
+      self.Glob[pattern] = dir_index.glob(pattern)
+    return self.Glob[pattern]
+
+  def recordRuleCall(self, buildName, kwargs):
+    # copy it before the rule modifies the lists in arguments
+    try:
+      kwargs = copyArguments(kwargs)
+    except Exception:
+      kwargs = None
+    self.ruleCalls.append((buildName, kwargs))
+
+  def replay(self, entry):
+    """ re-create rules from a build cache entry, instead of executing BUILD """
+    self.Glob = dict(entry["globs"])
+    for buildName, kwargs in entry["calls"]:
+      self.ruleCalls.append((buildName, kwargs))
+      rule_generator.replayRuleCall(buildName, copyArguments(kwargs))
+
   @staticmethod
   def createPackage(packageName, dirPrefix):
     pkg = Package(packageName, dirPrefix)
@@ -353,6 +484,15 @@ class Package(object):
      execute the build file, it will create rules in the build file
      or in dependent build files, and add them to the rulelist and rulemap
     """
+    with profiler.timer("parse BUILD"):
+      self.loadBuildFile()
+
+  def loadBuildFile(self):
+    if self.packageName in preloadErrors:
+      status, out, err = preloadErrors[self.packageName]
+      sys.stdout.write(out)
+      sys.stderr.write(err)
+      sys.exit(status)
 
     buildFilePath = "/".join([self.packageName, self.buildFileName])
     if not os.path.exists(buildFilePath):
@@ -383,14 +523,25 @@ class Package(object):
     global currentPackage
 
     currentPackage = self
-    self.execute(buildFilePath, buildFileContent, globals(), locals())
+    self.buildHash = build_cache.contentHash(buildFileContent)
+    code, entry = build_cache.lookup(self.packageName, self.buildHash)
+    if entry is not None:
+      self.replay(entry)
+    else:
+      if code is None:
+        code = buildFileContent
+      code = self.execute(buildFilePath, code, globals(), locals())
+      build_cache.store(self, code)
 
     if len(self.ruleList) == 0:
       print >>sys.stderr, "Rules not found in BUILD file:", buildFilePath
       sys.exit(-1)
 
   def execute(self, filename, build, context, local):
+    """ execute BUILD content or its code object, return the code object """
     try:
+      if isinstance(build, basestring):
+        build = compile(build, filename, "exec")
       exec build in context, local
     except Exception, e:
       print >>sys.stderr, "failed to parse %s" % filename
@@ -401,6 +552,7 @@ class Package(object):
         error_type = error_type[:-2]
       print >>sys.stderr, "%s:\n%s" % (error_type, e)
       sys.exit(-1)
+    return build
 
   def expandRules(self):
     """ expand rule and it's depending rules"""
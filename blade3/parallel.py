@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import multiprocessing
+import Queue
+import sys
+import StringIO
+
+import build_cache
+import package
+import rule
+
+"""
+Parallel evaluation of BUILD files
+
+Worker processes evaluate BUILD files, and send back the build cache entry
+of each package, i.e. the rule calls, glob results and compiled code. Packages
+referenced by deps are submitted as soon as they are found, until all of them
+are evaluated.
+
+The entries are put into the build cache of the parent process, which then
+loads and expands packages in the usual order by replaying them. So the result
+doesn't depend on the order in which workers finish. If a BUILD file fails to
+evaluate, the output of the worker is kept, and printed when the parent reads
+that package, just as it would have been printed without workers.
+"""
+
+def depPackageNames(entry):
+  res = set()
+  for buildName, kwargs in entry["calls"]:
+    deps = kwargs.get("deps", [])
+    if type(deps) != type([]):
+      continue
+    for dep in deps:
+      if type(dep) != type("") or not dep.startswith("//"):
+        continue
+      # only deps of other packages are needed
+      label = rule.parseLabel(dep)
+      if label is None:
+        continue
+      packageName = label[0]
+      if packageName.endswith("/BUILD"):
+        res.add(packageName[:-6])
+  return res
+
+def evaluatePackage(packageName, dirPrefix):
+  """
+   run in worker process, return (packageName, entry, error):
+     entry is the build cache entry of the package, or None if it failed
+     error is (exit status, stdout, stderr) of the failure
+  """
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+  try:
+    try:
+      pkg = package.Package(packageName, dirPrefix)
+      # the parent prints the same as Package(), keep only output of readPackage()
+      sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+      pkg.readPackage()
+      return (pkg.packageName, build_cache.entry(pkg.packageName), None)
+    except SystemExit, e:
+      status = e.code
+    except Exception, e:
+      print >>sys.stderr, "failed to load //%s/BUILD" % packageName
+      print >>sys.stderr, "%s: %s" % (type(e).__name__, e)
+      status = -1
+    return (packageName, None, (status, sys.stdout.getvalue(), sys.stderr.getvalue()))
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+    # rules created in worker are not needed any more
+    package.globalPackages.clear()
+
+def _evaluatePackage(args):
+  return evaluatePackage(*args)
+
+def preloadPackages(packageNames, dirPrefix, jobs):
+  """
+   evaluate packageNames and all packages they depend on, with jobs workers.
+   return the number of evaluated packages.
+  """
+  # workers share the build cache loaded before forking
+  build_cache.load()
+  pool = multiprocessing.Pool(jobs)
+  results = Queue.Queue()
+  submitted = set()
+
+  def submit(name):
+    submitted.add(name)
+    pool.apply_async(_evaluatePackage, [(name, dirPrefix)], callback=results.put)
+
+  try:
+    for name in packageNames:
+      if name not in submitted:
+        submit(name)
+
+    done = 0
+    while done < len(submitted):
+      # get() with timeout, so that it can be interrupted by Ctrl-C
+      name, entry, error = results.get(True, 86400)
+      done = done + 1
+      if error is not None:
+        package.preloadErrors[name] = error
+        continue
+      build_cache.put(name, entry)
+      if entry["calls"] is None:
+        continue
+      for dep in sorted(depPackageNames(entry)):
+        if dep not in submitted:
+          submit(dep)
+  finally:
+    pool.terminate()
+    pool.join()
+  return len(submitted)
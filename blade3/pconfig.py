@@ -3,12 +3,96 @@ __author__ = 'liuyong@agora.io(Yong Liu)'
 
 import package as p
 import rule
+import cc
+import build_cache
+import ninja
+import parallel
+import profiler
+import regen
 import sys
 import os
+import optparse
+
+def parseOptions(argv):
+  parser = optparse.OptionParser(usage="%prog [options] PATH_TO_BUILD_FILE ...")
+  parser.add_option("--incremental", action="store_true", default=False,
+                    help="emit rules of each package to .blade/mk/<package>.mk, "
+                    "and only re-emit the changed ones")
+  parser.add_option("--ninja", action="store_true", default=False,
+                    help="also write %s, with the same targets as the Makefile" % ninja.ninja_file)
+  parser.add_option("-j", "--jobs", type="int", default=1,
+                    help="number of worker processes to evaluate BUILD files")
+  parser.add_option("--link_group", action="store_true", default=False,
+                    help="link libraries of binaries inside --start-group/--end-group, "
+                    "instead of ordering them")
+  parser.add_option("--compile_cache", action="store_true", default=False,
+                    help="look up objects in the compile cache before compiling, "
+                    "see compile_cache.py")
+  parser.add_option("--action_cache", action="store_true", default=False,
+                    help="look up outputs of archives, links and protoc in the action "
+                    "cache before running them, see action_cache.py")
+  parser.add_option("--unity", type="int", default=0,
+                    help="compile .cc sources in bundles of this number, "
+                    "unless the rule sets its own unity")
+  parser.add_option("--shared_debug", action="store_true", default=False,
+                    help="build libraries of the debug setting as shared libraries, "
+                    "so that changing one doesn't relink the tests")
+  parser.add_option("--bundle_tests", action="store_true", default=False,
+                    help="link the cc_test rules of each package into one test runner, "
+                    "except the ones with bundle = False")
+  parser.add_option("--profile", action="store_true", default=False,
+                    help="print time of each phase and counters, "
+                    "and write them to %s" % profiler.report_file)
+  parser.add_option("-v", "--verbose", action="count", default=0,
+                    help="-v prints loaded packages and expanded rules, -vv also dumps rules")
+  return parser.parse_args(argv[1:])
+
+def loadPackages(build_files, dirPrefix):
+  """ read BUILD files and expand their rules, return the packages """
+  packages = []
+  for packageName in build_files:
+    packageName = packageName.strip()
+    if packageName.startswith("./"): packageName = packageName[2:]
+    if not packageName.endswith("/BUILD"):
+      print >> sys.stderr, "not a BUILD file: ", packageName
+      print >> sys.stderr, "please specify a path to a BUILD file"
+      sys.exit(-1)
+
+    packageName = packageName[:-6]
+    package = p.Package(packageName, dirPrefix)
+
+    print "_____gen_makefile %s" % package.packageName
+
+    package.readPackage()
+    with profiler.timer("expand rules"):
+      package.expandRules()
+    packages.append(package)
+  return packages
+
+def computeClosures():
+  """
+   proto header closures of all expanded rules, computed once in
+   topological order. libraries are ordered when binaries are emitted.
+  """
+  with profiler.timer("closures"):
+    all_rules = [r for pkg in p.globalPackages.values() for r in pkg.ruleList
+                 if isinstance(r, cc.CCLibrary)]
+    cc.computePBHeaderClosures(all_rules)
 
 def main(argv):
+  options, build_files = parseOptions(argv)
+  p.verbosity = options.verbose
+  cc.link_group = options.link_group
+  cc.compile_cache = options.compile_cache
+  cc.action_cache = options.action_cache
+  cc.unity_size = options.unity
+  cc.shared_debug = options.shared_debug
+  cc.bundle_tests = options.bundle_tests
+  if options.profile:
+    profiler.enable()
+
   package_set = set()
-  for packageName in argv[1:]:
+  for packageName in build_files:
     packageName = packageName.strip()
     if packageName.startswith("/") or packageName.startswith("../"):
       print >> sys.stderr, "Invalid BUILD file, not a relative path: ", \
@@ -28,30 +112,45 @@ def main(argv):
     package_set.add(packageName)
 
   dirPrefix = os.getcwd()
-  packages = []
 
-  for packageName in argv[1:]:
-    packageName = packageName.strip()
-    if packageName.startswith("./"): packageName = packageName[2:]
-    if not packageName.endswith("/BUILD"):
-      print >> sys.stderr, "not a BUILD file: ", packageName
-      print >> sys.stderr, "please specify a path to a BUILD file"
-      sys.exit(-1)
+  if options.jobs > 1:
+    # package_set holds normalized paths of BUILD files
+    names = [name[:-6] for name in sorted(package_set)]
+    with profiler.timer("parallel BUILD evaluation"):
+      count = parallel.preloadPackages(names, dirPrefix, options.jobs)
+    print "%d BUILD files are evaluated by %d workers" % (count, options.jobs)
 
-    packageName = packageName[:-6]
-    package = p.Package(packageName, dirPrefix)
+  packages = loadPackages(build_files, dirPrefix)
+  computeClosures()
 
-    print "_____gen_makefile %s" % package.packageName
+  if p.verbosity >= 2:
+    with profiler.timer("dump"):
+      for package in p.globalPackages.values():
+        package.dump()
 
-    package.readPackage()
-    package.expandRules()
-    packages.append(package)
+  # the same arguments regenerate the Makefile, build.ninja and 'make regen_makefile'
+  regen_args = argv[1:]
+
+  with profiler.timer("emit Makefile"):
+    makeFile = open("Makefile", "w")
+    p.emitMake(packages, makeFile, options.incremental, regen_args)
+    makeFile.close()
+  profiler.output("Makefile")
+
+  if options.ninja:
+    with profiler.timer("emit build.ninja"):
+      ninjaFile = open(ninja.ninja_file, "w")
+      ninja.emitNinja(packages, ninjaFile, regen_args)
+      ninjaFile.close()
 
-  for package in p.globalPackages.values():
-    package.dump()
+  with profiler.timer("save build cache"):
+    build_cache.save()
+  # for 'make regen_makefile', see regen_makefile.py
+  regen.record(regen_args, p.globalPackages)
 
-  makeFile = open("Makefile", "w")
-  p.emitMake(packages, makeFile)
+  profiler.count("packages", len(p.globalPackages))
+  profiler.count("rules", sum([len(a.ruleList) for a in p.globalPackages.values()]))
+  profiler.save()
 
 if __name__ == "__main__":
   if len(sys.argv) == 1:
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import json
+import os
+import time
+
+"""
+Phase timing and counters of gen_makefile, enabled by pconfig.py --profile
+
+  with profiler.timer("parse BUILD"):
+    ...
+  profiler.count("globs")
+
+Timers can be nested, the time of a phase doesn't include the phases nested
+in it, so phases sum up to the total time. Files registered by output() are
+counted in "bytes written" when the report is made.
+"""
+
+report_file = ".blade/profile.json"
+
+enabled = False
+
+_phases = {}      # name => [seconds, calls]
+_phase_order = []
+_counters = {}
+_outputs = set()
+_stack = []       # [name, start, nested seconds]
+_start = None
+
+class _Timer(object):
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    if enabled:
+      _stack.append([self.name, time.time(), 0.0])
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if not enabled:
+      return False
+    name, start, nested = _stack.pop()
+    elapsed = time.time() - start
+    if len(_stack) > 0:
+      _stack[-1][2] += elapsed
+    if name not in _phases:
+      _phases[name] = [0.0, 0]
+      _phase_order.append(name)
+    _phases[name][0] += elapsed - nested
+    _phases[name][1] += 1
+    return False
+
+def timer(name):
+  return _Timer(name)
+
+def count(name, n=1):
+  if enabled:
+    _counters[name] = _counters.get(name, 0) + n
+
+def output(path):
+  if enabled:
+    _outputs.add(path)
+
+def _counting(name, func):
+  def wrapper(*args, **kwargs):
+    _counters[name] = _counters.get(name, 0) + 1
+    return func(*args, **kwargs)
+  return wrapper
+
+def enable():
+  """ start profiling, count the file system calls from now on """
+  global enabled, _start
+  enabled = True
+  _start = time.time()
+  os.stat = _counting("stat calls", os.stat)
+  os.lstat = _counting("stat calls", os.lstat)
+  os.listdir = _counting("directory reads", os.listdir)
+
+def report():
+  """ return the profile as a dict """
+  total = time.time() - _start
+  bytes_written = 0
+  for path in _outputs:
+    try:
+      bytes_written += os.path.getsize(path)
+    except OSError:
+      pass
+  counters = dict(_counters)
+  counters["bytes written"] = bytes_written
+  phases = [{"phase": name, "seconds": _phases[name][0], "calls": _phases[name][1]}
+            for name in _phase_order]
+  return {"total_seconds": total, "phases": phases, "counters": counters}
+
+def printReport(res):
+  print
+  print "%-24s %10s %8s %8s" % ("phase", "seconds", "%", "calls")
+  for phase in res["phases"]:
+    print "%-24s %10.3f %7.1f%% %8d" % (phase["phase"], phase["seconds"],
+                                         100.0 * phase["seconds"] / max(res["total_seconds"], 1e-9),
+                                         phase["calls"])
+  print "%-24s %10.3f" % ("total", res["total_seconds"])
+  print
+  print "%-24s %10s" % ("counter", "value")
+  for name in sorted(res["counters"]):
+    print "%-24s %10d" % (name, res["counters"][name])
+  print
+
+def save():
+  """ print the summary table, and write it as json to report_file """
+  if not enabled:
+    return
+  res = report()
+  printReport(res)
+  if not os.path.exists(os.path.dirname(report_file)):
+    os.mkdir(os.path.dirname(report_file))
+  p = file(report_file, "w")
+  json.dump(res, p, indent=2, sort_keys=True)
+  p.close()
+  print "profile is written to %s" % report_file
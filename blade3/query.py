@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import optparse
+import re
+import sys
+
+import depdb
+
+"""
+Queries of the dependency graph, by 'build_tools/blade query'
+
+gen_makefile writes the graph of all loaded rules to .blade/deps.db, with
+the deps and the reverse deps of each rule precomputed, so a query only
+maps the database and walks it, see depdb.py:
+
+  $ build_tools/blade query deps //app/BUILD:app
+  $ build_tools/blade query rdeps //base/BUILD:base --kind cc_test
+  $ build_tools/blade query somepath //app/BUILD:app //base/BUILD:base
+  $ build_tools/blade query allpaths //app/BUILD:app //base/BUILD:base
+
+deps and rdeps take one or more targets, and --depth to stop the walk.
+A target is a label, or //path/BUILD for all rules of the package.
+--kind keeps the rules whose type matches a regex, i.e. cc_test or 'cc_.*'.
+deps, rdeps and allpaths print the rules sorted, somepath prints a shortest
+path, from the first target to the second one.
+"""
+
+def walk(edges, starts, depth=None):
+  """ ids reachable from starts by edges(id), within depth steps """
+  res = set(starts)
+  frontier = list(starts)
+  level = 0
+  while frontier and (depth is None or level < depth):
+    level = level + 1
+    next_frontier = []
+    for i in frontier:
+      for j in edges(i):
+        if j not in res:
+          res.add(j)
+          next_frontier.append(j)
+    frontier = next_frontier
+  return res
+
+def somePath(edges, starts, ends):
+  """ a shortest path from one of starts to one of ends, or None """
+  ends = set(ends)
+  parents = dict([(i, None) for i in starts])
+  frontier = list(starts)
+  while frontier:
+    next_frontier = []
+    for i in frontier:
+      if i in ends:
+        path = []
+        while i is not None:
+          path.append(i)
+          i = parents[i]
+        path.reverse()
+        return path
+      for j in edges(i):
+        if j not in parents:
+          parents[j] = i
+          next_frontier.append(j)
+    frontier = next_frontier
+  return None
+
+def findTargets(db, target):
+  """ ids of a label, or of all rules of //path/BUILD """
+  i = db.find(target)
+  if i is not None:
+    return [i]
+  if target.endswith("/BUILD"):
+    return db.packageRules(target)
+  return []
+
+def parseOptions(argv):
+  parser = optparse.OptionParser(
+      usage="%prog [options] deps|rdeps TARGET ... | somepath|allpaths FROM TO")
+  parser.add_option("--kind", default=None,
+                    help="print only rules whose type matches this regex")
+  parser.add_option("--depth", type="int", default=None,
+                    help="depth of deps and rdeps, unlimited by default")
+  parser.add_option("--db", default=depdb.db_file,
+                    help="database written by gen_makefile, %s by default" % depdb.db_file)
+  return parser, parser.parse_args(argv[1:])
+
+def main(argv):
+  parser, (options, args) = parseOptions(argv)
+  if len(args) < 2 or args[0] not in ("deps", "rdeps", "somepath", "allpaths") \
+      or (args[0] in ("somepath", "allpaths") and len(args) != 3):
+    parser.print_usage(sys.stderr)
+    return -1
+  try:
+    db = depdb.DepDB(options.db)
+  except (IOError, ValueError), e:
+    print >>sys.stderr, e
+    return -1
+
+  targets = []
+  for target in args[1:]:
+    ids = findTargets(db, target)
+    if len(ids) == 0:
+      print >>sys.stderr, "%s is not found in %s" % (target, options.db)
+      return -1
+    targets.append(ids)
+
+  command = args[0]
+  if command == "somepath":
+    path = somePath(db.deps, targets[0], targets[1])
+    if path is None:
+      print >>sys.stderr, "%s doesn't depend on %s" % (args[1], args[2])
+      return 1
+    res = path
+  else:
+    if command == "deps":
+      res = walk(db.deps, sum(targets, []), options.depth)
+    elif command == "rdeps":
+      res = walk(db.rdeps, sum(targets, []), options.depth)
+    else:
+      # rules on a path from the first to the second
+      res = walk(db.deps, targets[0]) & walk(db.rdeps, targets[1])
+    # ids are in the order of labels
+    res = sorted(res)
+
+  if options.kind is not None:
+    kind_regex = re.compile("^(%s)$" % options.kind)
+    res = [i for i in res if kind_regex.match(db.kind(i))]
+  for i in res:
+    print db.label(i)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
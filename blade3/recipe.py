@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import os
+
+"""
+Parts of Makefile recipes shared by the rules
+
+An action is printed by make itself with $(info), colored by ${ACTION_COLOR}
+of Makefile.header, instead of running color_print.py for every compile,
+link or protoc. Output directories are order-only prerequisites, made by
+the %/ rule of Makefile.header once per directory, instead of a shell
+testing them in every recipe.
+"""
+
+def action(f, message):
+  # a line expanding to nothing, so make doesn't run it
+  print >>f, "\t@$(info ${ACTION_COLOR}%s${NO_COLOR})" % message
+
+def outputDirs(f, targets, dirs):
+  """ make dirs order-only prerequisites of targets, in a rule of its own """
+  print >>f, "%s: | %s" % (" ".join(targets), " ".join([os.path.join(a, "") for a in dirs]))
+  print >>f
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import cPickle
+import glob
+import hashlib
+import os
+
+import build_cache
+from dirs import makefile_header
+
+"""
+State of the last gen_makefile run, stored in .blade/regen_state
+
+pconfig.py records:
+  - its arguments, i.e. options and BUILD files
+  - a fingerprint of the generator, its sources and Makefile.header
+  - for every loaded package, the sha1 of its BUILD file and the mtimes of
+    the directories read by its globs, as the build cache does
+'make regen_makefile' compares them with the workspace to find the changed
+packages, see regen_makefile.py.
+"""
+
+state_file = ".blade/regen_state"
+
+# bump it when the layout of the state changes
+state_version = 1
+
+def generatorFingerprint():
+  h = hashlib.sha1()
+  current_file_dir = os.path.dirname(os.path.realpath(__file__))
+  for src in sorted(glob.glob(os.path.join(current_file_dir, "*.py"))) + [makefile_header]:
+    h.update(file(src).read())
+  return h.hexdigest()
+
+def buildHash(packageName):
+  """ sha1 of the BUILD file as package.Package reads it, or None if it's gone """
+  try:
+    content = file(os.path.join(packageName, "BUILD")).read()
+  except IOError:
+    return None
+  if not content.endswith("\n"):
+    content += "\n"
+  return build_cache.contentHash(content)
+
+def record(args, packages):
+  """ args of pconfig.py, packages are all loaded packages by name """
+  state = {
+    "args": list(args),
+    "generator": generatorFingerprint(),
+    "packages": dict([(name, (pkg.buildHash, build_cache.globFingerprint(pkg.Glob.keys())))
+                      for name, pkg in packages.items()]),
+  }
+  if not os.path.exists(os.path.dirname(state_file)):
+    os.mkdir(os.path.dirname(state_file))
+  tmp_file = state_file + ".tmp"
+  p = file(tmp_file, "wb")
+  cPickle.dump((state_version, state), p, cPickle.HIGHEST_PROTOCOL)
+  p.close()
+  os.rename(tmp_file, state_file)
+
+def load():
+  """ the recorded state, or None if there isn't one of this version """
+  try:
+    p = file(state_file, "rb")
+    try:
+      version, state = cPickle.load(p)
+    finally:
+      p.close()
+  except Exception:
+    return None
+  if version != state_version:
+    return None
+  return state
+
+def changedPackages(state):
+  """ names of the recorded packages whose BUILD file or glob results may have changed """
+  res = []
+  for name in sorted(state["packages"]):
+    build_hash, dirs = state["packages"][name]
+    if buildHash(name) != build_hash or not build_cache.fingerprintValid(dirs):
+      res.append(name)
+  return res
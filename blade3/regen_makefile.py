@@ -6,10 +6,88 @@ __author__ = 'liuyong@agora.io(Yong Liu)'
 
 import os, sys, subprocess
 from color_print import ColorPrint
+import depdb
+import regen
 
-# get packages, deps_graph, rule_types
-exec file(sys.argv[1]).read()
+"""
+'make regen_makefile', regenerates the Makefile in this process
 
-cmd = ["bash", "./build_tools/blade3/gen_makefile.sh"] + [(os.path.dirname(p)[2:] + "/BUILD") for p in packages]
-ret = subprocess.call(" ".join(cmd), shell=True)
-sys.exit(ret)
+The state recorded by the last gen_makefile (see regen.py) is compared with
+the workspace. If no BUILD file, glob result or generator source changed,
+the Makefile is up to date and all packages are skipped. Otherwise pconfig
+runs with the same arguments: the BUILD files of the changed packages are
+run again, the other packages are replayed from the build cache without
+running or globbing their BUILD files. Rules of all packages are expanded
+again, as the Makefile lists all targets; with --incremental only the
+fragments whose signatures changed are re-emitted.
+
+A workspace generated by an older gen_makefile has no state, the BUILD files
+listed in deps.db, or in the legacy all_deps, are all evaluated then.
+"""
+
+def outputsExist(args):
+  if not os.path.exists("Makefile"):
+    return False
+  # build.ninja is also written with --ninja
+  return "--ninja" not in args or os.path.exists("build.ninja")
+
+def regenerate(args):
+  # as gen_makefile.sh does before pconfig.py
+  if os.path.exists("list_pub_libs.sh"):
+    if subprocess.call("bash ./list_pub_libs.sh > /dev/null", shell=True) != 0:
+      ColorPrint("red", "Failed to run ./list_pub_libs.sh")
+      return 1
+  if not os.path.isdir(".build/pb/c++"):
+    os.makedirs(".build/pb/c++")
+
+  import pconfig
+  pconfig.main(["pconfig.py"] + args)
+  print
+  print "The Makefile is generated succesfully."
+  return 0
+
+def lastBuildFiles(list_file):
+  """ BUILD files given to the last gen_makefile, or None if no list file is readable """
+  # a Makefile of an older gen_makefile passes .blade/all_deps
+  errors = []
+  for path in [list_file] + [a for a in [depdb.db_file, depdb.legacy_file] if a != list_file]:
+    try:
+      return [(os.path.dirname(p)[2:] + "/BUILD") for p in depdb.lastPackages(path)]
+    except Exception, e:
+      # missing, of another version, or a broken legacy file
+      errors.append("failed to read %s: %s" % (path, e))
+  for error in errors:
+    print >>sys.stderr, error
+  return None
+
+def main(argv):
+  state = regen.load()
+  if state is None:
+    # written by an older gen_makefile, regenerate the BUILD files given to it
+    build_files = lastBuildFiles(argv[1])
+    if build_files is None:
+      ColorPrint("red", "Please run gen_makefile.sh again")
+      return 1
+    print "No state of the last gen_makefile, all packages are evaluated"
+    return regenerate(build_files)
+
+  args = state["args"]
+  total = len(state["packages"])
+  if state["generator"] != regen.generatorFingerprint():
+    print "build_tools changed, all %d packages are evaluated" % total
+    return regenerate(args)
+
+  changed = regen.changedPackages(state)
+  if len(changed) == 0 and outputsExist(args):
+    print "Makefile is up to date, %d of %d packages are skipped" % (total, total)
+    return 0
+
+  for name in changed:
+    print "changed: //%s/BUILD" % name
+  print "%d of %d packages changed and are evaluated again, " \
+      "the other %d are replayed from the build cache" \
+      % (len(changed), total, total - len(changed))
+  return regenerate(args)
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -28,17 +28,34 @@ cc_binary(name = "binary",
 This defines a cpp binary rules. it will generate binary which contains binary.o
 """
 
+# deps rule format is: //packageName/BUILD:ruleName or :ruleName, second is the rule in same package
+_label_regex = re.compile(r'''/?/?(.*?):(.+)''', re.IGNORECASE)
+
+# dep => (package part, rule name), or None if it doesn't match
+_labels = {}
+
+def parseLabel(dep):
+  if dep not in _labels:
+    matcher = _label_regex.match(dep)
+    if matcher == None:
+      _labels[dep] = None
+    else:
+      _labels[dep] = (matcher.group(1).strip(), matcher.group(2).strip())
+  return _labels[dep]
+
 class Rule:
 
+  # full names of the rules being expanded, outermost first
   ruleExpandStack = []
+  ruleExpandSet = set()
 
   def __init__(self, name, pkg):
-     # deps rule format is: //packageName/BUILD:ruleName or :ruleName, second is the rule in same package
-     self.ruleRegex = re.compile(r'''/?/?(.*?):(.+)''', re.IGNORECASE)
      self.ruleName = name
      self.srcList = []
      self.package = pkg
      self.expanded = False
+     # signature of the rule and its deps, for incremental Makefile generation
+     self.signature = None
 
      self.is_binary = 0
      self.is_unittest = 0  # for a unit test executable, both is_unittest and is_binary should be 1
@@ -56,11 +73,34 @@ class Rule:
   def expandRule(self):
     """
      1. for each depending rule, create its package if not exist, and create each rule, add to depRulesList
-     2. check for circly depending
-        birth first way to expand the rule graph
-     3. for echo depending rule, expand it
+     2. check for circly depending, by the set of rules being expanded
+     3. for echo depending rule not expanded yet, expand it, depth first.
+        it's iterative, so long dependency chains don't hit the recursion limit
     """
-    print "parse module: //%s/BUILD:%s" % (self.package.packageName, self.ruleName)
+    # [rule, index of the next dep to expand]
+    frames = [[self, 0]]
+    self.beginExpand()
+    while len(frames) > 0:
+      frame = frames[-1]
+      r, i = frame
+      if i == len(r.depRulesList):
+        # all deps expanded, pop out from expand stack
+        frames.pop()
+        r.popStack()
+        r.expanded = True
+        continue
+      frame[1] = i + 1
+      rule = r.depRulesList[i]
+      if rule.fullRuleName() in Rule.ruleExpandSet:
+        r.reportCycle(rule)
+      if not rule.expanded:
+        frames.append([rule, 0])
+        rule.beginExpand()
+
+  def beginExpand(self):
+    """ push the rule to expand stack, and resolve its deps """
+    if package.verbosity >= 1:
+      print "parse module: //%s/BUILD:%s" % (self.package.packageName, self.ruleName)
 
     self.pushStack()
     for dep in self.depsList:
@@ -95,38 +135,33 @@ class Rule:
         sys.exit(1)
       self.depRulesList.append(rule)
 
-    # Expand dep rules
-    for rule in self.depRulesList:
-      if rule.fullRuleName() in Rule.ruleExpandStack:
-        print "%s -> %s -> %s,  circly dependency error" % (self.fullRuleName(), rule.fullRuleName(), self.fullRuleName())
-        self.popStack()
-        sys.exit(1)
-      if not rule.expanded:
-        rule.expandRule()
-
-    # Pop out from expend stack
-    self.popStack()
-    self.expanded = True
+  def reportCycle(self, rule):
+    # rule is on the expand stack, the cycle goes from it to self and back
+    cycle = Rule.ruleExpandStack[Rule.ruleExpandStack.index(rule.fullRuleName()):]
+    cycle.append(rule.fullRuleName())
+    print "%s,  circly dependency error" % " -> ".join(cycle)
+    sys.exit(1)
 
   def fullRuleName(self):
     return "%s:%s" % (self.package.packageName, self.ruleName)
 
   def pushStack(self):
-    Rule.ruleExpandStack.append(self.fullRuleName())
+    name = self.fullRuleName()
+    Rule.ruleExpandStack.append(name)
+    Rule.ruleExpandSet.add(name)
 
   def popStack(self):
-    Rule.ruleExpandStack.pop()
+    Rule.ruleExpandSet.discard(Rule.ruleExpandStack.pop())
 
   def parseRule(self, dep):
     if not dep.startswith("//") and not dep.startswith(":"):
       print 'invalid deps: "%s"' % dep
       print 'must be started with "//" (means in the codebase root dir) or ":" (means in the current package)'
       sys.exit(-1)
-    ruleMatcher = self.ruleRegex.match(dep)
-    if ruleMatcher == None:
+    label = parseLabel(dep)
+    if label == None:
       return [None, None]
-    packageName = ruleMatcher.group(1).strip()
-    ruleName = ruleMatcher.group(2).strip()
+    packageName, ruleName = label
 
     if len(packageName) > 0:
       if not packageName.endswith("/BUILD"):
@@ -139,3 +174,6 @@ class Rule:
 
   def emitMake(self, f):
     pass
+
+  def emitNinja(self, f):
+    pass
@@ -3,6 +3,7 @@
 
 __author__ = 'liuyong@agora.io(Yong Liu)'
 
+import package
 import java
 import cc
 import data
@@ -24,6 +25,21 @@ rules = [
          genrule.SetPackageAttr,
         ]
 
+rule_classes = dict((r.buildName, r) for r in rules)
+
+def recordingRule(rule):
+  """
+   create the rule, and record the call in current package,
+   so that it can be replayed from the build cache
+  """
+  def create(**kwargs):
+    package.currentPackage.recordRuleCall(rule.buildName, kwargs)
+    return rule(**kwargs)
+  return create
+
 def insertIntoContext(context):
   for rule in rules:
-    context[rule.buildName] = rule
+    context[rule.buildName] = recordingRule(rule)
+
+def replayRuleCall(buildName, kwargs):
+  return rule_classes[buildName](**kwargs)
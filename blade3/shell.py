@@ -17,20 +17,14 @@ class ShellScript(cc.CCLibrary):
   """
   buildName = "shell_script"
 
+  # neither the files nor the deps are linked
+  exports_dep_libs = False
+
   def __init__(self, **kwargs):
     cc.CCLibrary.__init__(self, **kwargs)
     self.is_library = 0 
     self.is_shell_script = 1 
 
-  def exportLibPathList(self, settings_name):
-    return []
-
-  def exportLibDirList(self, settings_name):
-    return []
-
-  def exportLibNameList(self):
-    return []
-
   def dump(self):
     print "\tshell_script: ", self.ruleName
     for f in self.srcsList:
@@ -39,6 +33,9 @@ class ShellScript(cc.CCLibrary):
   def emitMake(self, f):
     pass
 
+  def emitNinja(self, f):
+    pass
+
 # shell script test case
 # 脚本编写的测试文件，只有在所有版本的二进制 (dbg/opt/diag_dbg/diag_opt) 编译成功后，才会运行
 class SSTest(cc.CCLibrary):
@@ -49,6 +46,9 @@ class SSTest(cc.CCLibrary):
   """
   buildName = "ss_test"
 
+  # neither the files nor the deps are linked
+  exports_dep_libs = False
+
   def __init__(self, **kwargs):
     cc.CCLibrary.__init__(self, **kwargs)
     self.is_library = 0 
@@ -60,15 +60,6 @@ class SSTest(cc.CCLibrary):
         print >> sys.stderr, "file name of shell script test must ended with '_test.sh': %s" % src
         sys.exit(-1)
 
-  def exportLibPathList(self, settings_name):
-    return []
-
-  def exportLibDirList(self, settings_name):
-    return []
-
-  def exportLibNameList(self):
-    return []
-
   def scriptsPathList(self):
     return [("%s/%s" % (self.package.packageName, filename)) for filename in self.srcsList]
 
@@ -80,3 +71,6 @@ class SSTest(cc.CCLibrary):
   def emitMake(self, f):
     pass
 
+  def emitNinja(self, f):
+    pass
+
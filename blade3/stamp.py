@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import os
+import subprocess
+import sys
+
+import ninja
+import profiler
+import recipe
+from dirs import build_dir
+from dirs import settings_list
+
+"""
+Version stamping of binaries.
+
+`git describe` runs only once per gen_makefile run, the result is written to
+a generated source file, which is compiled once per setting and linked into
+binaries only. Libraries and other objects never see the version, so a new
+commit doesn't change their compile commands.
+
+C++ code gets the version by:
+  #include "build_tools/blade3/git_desc.h"
+  printf("%s\n", GIT_DESC);
+"""
+
+# git describe runs under this dir if it exists, otherwise under the codebase root
+git_dir = "media_server_balancer"
+
+# kept out of build_dir, so that it survives 'make clean'
+stamp_dir = ".blade"
+stamp_src = os.path.join(stamp_dir, "git_desc.cc")
+
+_git_desc = None
+
+def gitDescribe():
+  global _git_desc
+  if _git_desc is not None:
+    return _git_desc
+
+  cwd = git_dir if os.path.isdir(git_dir) else "."
+  profiler.count("subprocesses")
+  with profiler.timer("subprocess"):
+    # git's own errors, e.g. outside of a repository, are reported below
+    try:
+      git = subprocess.Popen(["git", "describe", "--tags", "--always"],
+                             cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      out, err = git.communicate()
+      if git.returncode != 0:
+        raise OSError(err.strip() or "exit status %d" % git.returncode)
+      _git_desc = out.strip()
+    except OSError, e:
+      print >>sys.stderr, "failed to run git describe: %s" % e
+      _git_desc = ""
+  if _git_desc == "":
+    _git_desc = "unknown"
+  return _git_desc
+
+def stampContent():
+  desc = gitDescribe().replace("\\", "\\\\").replace('"', '\\"')
+  return ("// Do NOT modify this file. It's auto-generated by gen_makefile.\n"
+          "extern \"C\" const char kGitDesc[] = \"%s\";\n" % desc)
+
+def writeStampSource():
+  """
+   write the stamp source, keep it untouched if the version isn't changed,
+   so that binaries are not relinked
+  """
+  content = stampContent()
+  profiler.output(stamp_src)
+  try:
+    if file(stamp_src).read() == content:
+      return
+  except IOError:
+    pass
+
+  if not os.path.exists(stamp_dir):
+    os.makedirs(stamp_dir)
+  p = file(stamp_src, "w")
+  p.write(content)
+  p.close()
+
+def stampObjectPath(settings_name):
+  # such as ".build/debug/objs/stamp/git_desc.o"
+  return os.path.join(build_dir, settings_name, "objs", "stamp", "git_desc.o")
+
+def emitMake(f):
+  writeStampSource()
+
+  for settings_name in settings_list:
+    obj = stampObjectPath(settings_name)
+    obj_dir = os.path.dirname(obj)
+    print >>f, "%s: %s" % (obj, stamp_src)
+    recipe.action(f, "_____compile %s %s" % (settings_name, stamp_src))
+    print >>f, "\t${%s_CXX} ${%s_CPPFLAGS} ${%s_CXXFLAGS} -o %s -c %s" \
+        % (settings_name.upper(), settings_name.upper(), settings_name.upper(),
+           obj, stamp_src)
+    print >>f, "\n"
+    recipe.outputDirs(f, [obj], [obj_dir])
+
+def emitNinja(f):
+  writeStampSource()
+
+  for settings_name in settings_list:
+    ninja.build(f, [stampObjectPath(settings_name)], "cc", [stamp_src],
+                variables=[("cmd", "${%s_CXX} ${%s_CPPFLAGS} ${%s_CXXFLAGS}"
+                            % (settings_name.upper(), settings_name.upper(),
+                               settings_name.upper()))])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ElementTree
+
+"""
+Runner of bundled tests, enabled by pconfig.py --bundle_tests
+
+The bundled cc_test rules of a package are linked into one runner per
+setting, see cc.TestBundle. 'make debug_test' runs it by ${TEST_BUNDLE},
+with the sources of each rule and the options of the tests:
+
+  $ python build_tools/blade3/test_bundle.py .build/debug/bundled_tests/base/runner \
+      //base/BUILD:a_test=base/a_test.cc //base/BUILD:b_test=base/b_test.cc -- ${UNIT_TEST_OPTIONS}
+
+The output of the runner is shown as it runs. Its cases are then read from
+the gtest xml report (runner.xml next to it), and mapped to rules by the
+file they are defined in, so the results are still reported per rule:
+
+  PASSED //base/BUILD:a_test: 12 tests, 0.031s
+  FAILED //base/BUILD:b_test: 1 of 3 tests failed, 0.002s
+
+The exit code is the runner's, so a failed test still fails the build.
+"""
+
+def parseArgs(args):
+  """ runner, {source: rule}, rules in order and the options of the runner, or None """
+  if len(args) < 1 or args[0].startswith("-"):
+    return None
+  runner = args[0]
+  sources = {}
+  rules = []
+  i = 1
+  while i < len(args) and args[i] != "--":
+    if "=" not in args[i]:
+      return None
+    rule, srcs = args[i].split("=", 1)
+    rules.append(rule)
+    for src in srcs.split(","):
+      sources[os.path.normpath(src)] = rule
+    i = i + 1
+  return runner, sources, rules, args[i + 1:]
+
+def readReport(path, sources):
+  """ {rule: [tests, failures, seconds]} of the cases in the xml report """
+  res = {}
+  for case in ElementTree.parse(path).getroot().iter("testcase"):
+    if case.get("status") == "notrun" or case.get("result") == "skipped":
+      continue
+    # gtest older than 1.10 doesn't write the file of a case
+    src = case.get("file")
+    rule = None
+    if src is not None:
+      rule = sources.get(os.path.normpath(src))
+    if rule not in res:
+      res[rule] = [0, 0, 0.0]
+    res[rule][0] = res[rule][0] + 1
+    if case.find("failure") is not None:
+      res[rule][1] = res[rule][1] + 1
+    res[rule][2] = res[rule][2] + float(case.get("time", "0"))
+  return res
+
+def printResult(name, result):
+  tests, failures, seconds = result
+  if failures > 0:
+    print "FAILED %s: %d of %d tests failed, %.3fs" % (name, failures, tests, seconds)
+  else:
+    print "PASSED %s: %d tests, %.3fs" % (name, tests, seconds)
+
+def runBundle(args):
+  parsed = parseArgs(args)
+  if parsed is None:
+    print >>sys.stderr, "usage: %s RUNNER RULE=SRC[,SRC...] ... -- [OPTIONS]" % sys.argv[0]
+    return -1
+  runner, sources, rules, options = parsed
+  report = runner + ".xml"
+  if os.path.exists(report):
+    os.remove(report)
+  res = subprocess.call([runner] + options + ["--gtest_output=xml:%s" % report])
+
+  print
+  try:
+    results = readReport(report, sources)
+  except (IOError, ElementTree.ParseError):
+    # crashed before writing the report
+    print "FAILED %s: exit code %d, no results of %s" % (runner, res, " ".join(rules))
+    return res if res != 0 else -1
+  for rule in rules:
+    if rule in results:
+      printResult(rule, results[rule])
+    else:
+      print "NO TEST %s" % rule
+  if None in results:
+    printResult("cases out of the sources of the rules", results[None])
+  return res
+
+if __name__ == "__main__":
+  sys.exit(runBundle(sys.argv[1:]))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'liuyong@agora.io(Yong Liu)'
+
+import cPickle
+import multiprocessing
+import optparse
+import os
+import pipes
+import Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+"""
+Test runner of 'make <setting>_test' and 'make ss_test'
+
+The tests are run in a pool of workers, $BLADE_TEST_JOBS of them (the
+number of cpus by default). Tests which took longest in the last runs start
+first, and new tests before all of them, so that a long test doesn't start
+last and hold up the whole run:
+
+  $ python build_tools/blade3/test_runner.py --name debug_test \
+      .build/debug/targets/base/a_test .build/debug/targets/base/b_test -- ${UNIT_TEST_OPTIONS}
+  $ python build_tools/blade3/test_runner.py --name ss_test base/c_test.sh
+
+The options after -- are appended to every test, except *_test.sh scripts,
+which are run by 'bash -x' as before. --command NAME COMMAND runs a shell
+command as a test, i.e. the runner of bundled tests, see test_bundle.py.
+
+The output of each test is captured to .blade/test_logs/<name>/, and
+printed as a whole when the test finishes, so outputs of tests running at
+the same time aren't mixed. All tests run even if one fails; the exit code
+is the one of the first failed test. A JUnit report is written to
+.blade/test_reports/<name>.xml, and durations to .blade/test_times.
+"""
+
+times_file = ".blade/test_times"
+log_dir = ".blade/test_logs"
+report_dir = ".blade/test_reports"
+
+# bump it when the layout of the timing database changes
+times_version = 1
+
+# weight of the last run in the duration of a test, the rest is its history
+last_run_weight = 0.5
+
+# output of a failed test kept in the report, the whole output is in its log
+report_output_limit = 64 * 1024
+
+_log_name_regex = re.compile(r"[^A-Za-z0-9_.-]")
+
+# characters not allowed in xml, i.e. colors of gtest
+_xml_invalid_regex = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+class Test(object):
+  def __init__(self, name, command, index):
+    self.name = name
+    self.command = command
+    # position on the command line, the first failure in it gives the exit code
+    self.index = index
+    self.log = None
+    self.status = None
+    self.seconds = 0.0
+
+class Times(object):
+  """ name of a test => seconds it takes, averaged over the runs """
+  def __init__(self):
+    self.entries = {}
+    try:
+      p = file(times_file, "rb")
+      try:
+        version, entries = cPickle.load(p)
+      finally:
+        p.close()
+      if version == times_version:
+        self.entries = entries
+    except Exception:
+      pass
+
+  def get(self, test):
+    return self.entries.get(test.name)
+
+  def put(self, test):
+    last = self.entries.get(test.name)
+    if last is None:
+      self.entries[test.name] = test.seconds
+    else:
+      self.entries[test.name] = last_run_weight * test.seconds + (1 - last_run_weight) * last
+
+  def save(self):
+    if not os.path.isdir(os.path.dirname(times_file)):
+      os.makedirs(os.path.dirname(times_file))
+    # several runs may save at the same time, each one to its own file
+    tmp_file = "%s.tmp%d" % (times_file, os.getpid())
+    p = file(tmp_file, "wb")
+    cPickle.dump((times_version, self.entries), p, cPickle.HIGHEST_PROTOCOL)
+    p.close()
+    os.rename(tmp_file, times_file)
+
+def parseArgs(argv):
+  """ options, and tests in the order of the command line """
+  # options of the tests are after "--", optparse would mix them with the tests
+  test_options = []
+  if "--" in argv:
+    test_options = argv[argv.index("--") + 1:]
+    argv = argv[:argv.index("--")]
+  parser = optparse.OptionParser(
+      usage="%prog [options] TEST ... [-- OPTIONS OF THE TESTS]")
+  parser.add_option("--name", default="test",
+                    help="name of the run, of its logs and report")
+  parser.add_option("-j", "--jobs", type="int",
+                    default=int(os.environ.get("BLADE_TEST_JOBS", "0")),
+                    help="number of tests run at the same time, "
+                    "the number of cpus by default")
+  parser.add_option("--command", nargs=2, action="append", default=[],
+                    metavar="NAME COMMAND", help="run a shell command as a test")
+  options, args = parser.parse_args(argv)
+  if options.jobs <= 0:
+    options.jobs = multiprocessing.cpu_count()
+
+  suffix = ""
+  if len(test_options) > 0:
+    suffix = " " + " ".join([pipes.quote(a) for a in test_options])
+  tests = []
+  for path in args:
+    if path.endswith(".sh"):
+      tests.append(Test(path, "bash -x %s" % pipes.quote(path), len(tests)))
+    else:
+      tests.append(Test(path, pipes.quote(path) + suffix, len(tests)))
+  for name, command in options.command:
+    tests.append(Test(name, command + suffix, len(tests)))
+  return options, tests
+
+class TestRunner(object):
+  def __init__(self, name, tests, jobs):
+    self.name = name
+    self.tests = tests
+    self.jobs = jobs
+    self.times = Times()
+    self.pending = []
+    self.running = 0
+    self.results = Queue.Queue()
+    self.processes = {} # test => Popen
+    self.done = 0
+
+  def prepare(self):
+    # longest first, tests without history first of all
+    def key(test):
+      seconds = self.times.get(test)
+      if seconds is None:
+        return (0, 0, test.index)
+      return (1, -seconds, test.index)
+    self.pending = sorted(self.tests, key=key)
+    run_log_dir = os.path.join(log_dir, self.name)
+    if not os.path.isdir(run_log_dir):
+      os.makedirs(run_log_dir)
+    for test in self.tests:
+      test.log = os.path.join(run_log_dir, _log_name_regex.sub("_", test.name).lstrip("._") + ".log")
+
+  def startReady(self):
+    while self.running < self.jobs and len(self.pending) > 0:
+      test = self.pending.pop(0)
+      thread = threading.Thread(target=self.run, args=(test,))
+      thread.daemon = True
+      thread.start()
+      self.running = self.running + 1
+
+  def run(self, test):
+    # in a thread, stdout and stderr go to the log of the test
+    start = time.time()
+    log = open(test.log, "w")
+    try:
+      try:
+        process = subprocess.Popen(test.command, shell=True, stdin=open(os.devnull),
+                                   stdout=log, stderr=subprocess.STDOUT)
+        self.processes[test] = process
+        status = process.wait()
+      except OSError, e:
+        log.write("%s\n" % e)
+        status = -1
+    finally:
+      log.close()
+    self.results.put((test, status, time.time() - start))
+
+  def complete(self, test, status, seconds):
+    self.processes.pop(test, None)
+    self.running = self.running - 1
+    self.done = self.done + 1
+    test.status = status
+    test.seconds = seconds
+
+    print
+    print "[%d/%d] $ %s" % (self.done, len(self.tests), test.command)
+    sys.stdout.write(readLog(test.log))
+    if status == 0:
+      print "PASSED %s (%.3fs)" % (test.name, seconds)
+      self.times.put(test)
+    else:
+      print "FAILED %s (%s, %.3fs), output in %s" % (test.name, exitReason(status), seconds,
+                                                     test.log)
+    sys.stdout.flush()
+
+  def execute(self):
+    """ exit code of the first failed test, 0 if all tests pass """
+    self.prepare()
+    try:
+      while True:
+        self.startReady()
+        if self.running == 0:
+          break
+        # get() with timeout, so that it can be interrupted by Ctrl-C
+        test, status, seconds = self.results.get(True, 86400)
+        self.complete(test, status, seconds)
+    except KeyboardInterrupt:
+      for test, process in self.processes.items():
+        try:
+          process.kill()
+        except OSError:
+          pass
+      print >>sys.stderr, "interrupted"
+      return -1
+    finally:
+      self.times.save()
+      writeReport(self.name, self.tests)
+
+    failed = [a for a in self.tests if a.status != 0]
+    print
+    print "%s: %d tests, %d passed, %d failed" % (self.name, len(self.tests),
+                                                   len(self.tests) - len(failed), len(failed))
+    for test in failed:
+      print "FAILED %s (%s)" % (test.name, exitReason(test.status))
+    if len(failed) == 0:
+      return 0
+    return exitCode(min(failed, key=lambda a: a.index).status)
+
+def exitReason(status):
+  if status < 0:
+    return "killed by signal %d" % -status
+  return "exit code %d" % status
+
+def exitCode(status):
+  # as a shell reports a test killed by a signal
+  if status < 0:
+    return 128 - status
+  return status
+
+def readLog(path):
+  try:
+    return file(path).read()
+  except IOError:
+    return ""
+
+def writeReport(name, tests):
+  """ JUnit report of the tests which have run """
+  ran = [a for a in tests if a.status is not None]
+  failed = [a for a in ran if a.status != 0]
+  if not os.path.isdir(report_dir):
+    os.makedirs(report_dir)
+  path = os.path.join(report_dir, name + ".xml")
+  p = file(path + ".tmp", "w")
+  print >>p, '<?xml version="1.0" encoding="UTF-8"?>'
+  print >>p, '<testsuites tests="%d" failures="%d" time="%.3f">' \
+      % (len(ran), len(failed), sum([a.seconds for a in ran]))
+  print >>p, '  <testsuite name=%s tests="%d" failures="%d" time="%.3f">' \
+      % (quoteattr(name), len(ran), len(failed), sum([a.seconds for a in ran]))
+  for test in ran:
+    print >>p, '    <testcase name=%s classname=%s time="%.3f">' \
+        % (quoteattr(test.name), quoteattr(name), test.seconds)
+    if test.status != 0:
+      output = readLog(test.log)[-report_output_limit:].decode("utf-8", "replace")
+      output = _xml_invalid_regex.sub("", output)
+      print >>p, '      <failure message=%s>%s</failure>' \
+          % (quoteattr(exitReason(test.status)), escape(output).encode("utf-8"))
+    print >>p, '    </testcase>'
+  print >>p, '  </testsuite>'
+  print >>p, '</testsuites>'
+  p.close()
+  os.rename(path + ".tmp", path)
+
+if __name__ == "__main__":
+  options, tests = parseArgs(sys.argv[1:])
+  sys.exit(TestRunner(options.name, tests, options.jobs).execute())
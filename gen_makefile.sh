@@ -220,6 +220,151 @@
 #     shell_script()     生成 shell 脚本
 #     ss_test()          生成 shell 脚本，可由 make ss_test 自动执行
 #
+# NOTE 10:
+#
+#   加上参数 --incremental，每个包的规则单独生成到 .blade/mk/<包路径>.mk，
+#   Makefile 只 include 这些文件；再次生成时，只重新生成 BUILD 文件或依赖有变化的包。
+#   此时 BUILD 文件更新后，运行 make 会自动增量地重新生成 Makefile：
+#   $ bash gen_makefile.sh --incremental xxx/BUILD yyy/BUILD
+#
+# NOTE 11:
+#
+#   BUILD 文件很多时，可以加上参数 --jobs=n，用 n 个进程并行解析 BUILD 文件，
+#   生成的 Makefile 与不加该参数时完全相同：
+#   $ bash gen_makefile.sh --jobs=8 ALL
+#
+# NOTE 12:
+#
+#   加上参数 --profile，打印各阶段 (解析 BUILD、展开依赖、生成 Makefile 等) 的耗时和计数，
+#   并写入 .blade/profile.json；加上 --verbose 打印加载的包和展开的规则，
+#   --verbose --verbose 还会打印所有规则的详细信息。
+#
+# NOTE 13:
+#
+#   可执行文件链接时，库默认按依赖顺序排列 (被依赖的库在后)。加上参数 --link_group，
+#   库不再排序，而是放在 -Wl,--start-group 和 -Wl,--end-group 之间链接，
+#   适用于依赖图很大、排序代价高的情况，但链接会稍慢：
+#   $ bash gen_makefile.sh --link_group xxx/BUILD
+#
+# NOTE 14:
+#
+#   加上参数 --ninja，同时生成 build.ninja，可以用 ninja 代替 make 编译，目标相同
+#   (debug、release、debug_test、release_test、ss_test 等)，编译命令取自 Makefile.header。
+#   ninja 自己记录头文件依赖，不必读 .d 文件，没有改动时几乎立即返回；BUILD 文件更新后，
+#   ninja 会自动重新生成 build.ninja。PROTOC 等变量和 make 一样从环境变量读取：
+#   $ bash gen_makefile.sh --ninja xxx/BUILD
+#   $ ninja release_test
+#
+# NOTE 15:
+#
+#   也可以不用 make，直接用 executor.py 编译，它执行的命令和 build.ninja 相同，但编译、
+#   打包、protoc、链接各有并发上限，并按内存预算 (默认为可用内存的 80%) 控制同时运行的
+#   任务，关键路径上的任务优先执行，失败的任务会删除输出后重试 (--retries，默认 1 次)：
+#   $ python build_tools/blade3/executor.py -t debug_test -j 32 --link_jobs 2 xxx/BUILD
+#
+# NOTE 16:
+#
+#   加上参数 --compile_cache，编译命令通过 compile_cache.py 执行：以预处理后的源文件、
+#   完整的编译参数和编译器 (路径、大小、修改时间) 为键缓存 .o 和 .d 文件，make clean、
+#   切换分支或重新 checkout 后，编译过的文件直接从缓存复制。缓存目录和大小上限 (MB) 由
+#   环境变量 BLADE_COMPILE_CACHE_DIR (默认 ~/.blade_cache/compile) 和
+#   BLADE_COMPILE_CACHE_SIZE (默认 5120) 设置，超出时先删除最久未用的文件。
+#   make debug/release 结束时打印命中率：
+#   $ bash gen_makefile.sh --compile_cache xxx/BUILD
+#
+# NOTE 17:
+#
+#   加上参数 --action_cache，打包 (ar)、链接和 protoc 通过 action_cache.py 执行：以命令行、
+#   工具和所有输入文件的内容为键缓存输出，键相同时直接恢复输出。缓存的每个文件都有 sha1，
+#   恢复前校验，损坏的缓存会被删除后重新执行。缓存目录可以多人共享 (如 NFS 上的目录)，
+#   由环境变量 BLADE_ACTION_CACHE_DIR (默认 ~/.blade_cache/actions) 和
+#   BLADE_ACTION_CACHE_SIZE (MB，默认 10240) 设置：
+#   $ BLADE_ACTION_CACHE_DIR=/nfs/blade_cache/actions bash gen_makefile.sh --action_cache xxx/BUILD
+#
+# NOTE 18:
+#
+#   cc_library、cc_binary 等规则可以设置 unity = N，把 .cc 源文件按 N 个一组合并编译 (每组生成
+#   一个 #include 这些源文件的 .blade/unity/<package>/<rule>_unity_<i>.cc)，减少重复解析头文件的
+#   时间；有同名 static 函数或宏冲突的源文件放到 unity_excludes 里单独编译。合并文件只在成员
+#   变化时重写，不会引起多余的重新编译。参数 --unity N 为没有设置 unity 的规则打开合并编译：
+#   $ bash gen_makefile.sh --unity 8 xxx/BUILD
+#
+# NOTE 19:
+#
+#   cc_library、cc_binary、cc_test 可以设置 pch = "foo_pch.h"，每种设置 (debug、release) 用和源文件
+#   完全相同的编译参数把它预编译为 .build/<setting>/pch/<package>/<rule>/foo_pch.h.gch，规则中的
+#   C++ 源文件以 -include 方式使用它，并依赖它；修改它包含的头文件时，先重新预编译，再重新编译
+#   各源文件。.c 源文件不使用预编译头文件。
+#
+# NOTE 20:
+#
+#   加上参数 --shared_debug，debug 设置下的每个库编译为动态库
+#   .build/debug/shared_libs/lib<package>_<rule>.so，可执行文件和单元测试链接这些动态库，
+#   rpath 为 $ORIGIN 的相对路径；修改一个库只需重新链接这个库，不必重新链接所有单元测试。
+#   release 设置不受影响，仍然全部静态链接：
+#   $ bash gen_makefile.sh --shared_debug xxx/BUILD
+#   $ make debug_test
+#
+# NOTE 21:
+#
+#   加上参数 --bundle_tests，每个包中的 cc_test 规则（不少于两个时）在每个设置下链接为一个运行器
+#   .build/<setting>/bundled_tests/<package>/runner，main() 来自 gtest_main，依赖的库只链接一次；
+#   make debug_test 通过 test_bundle.py 运行它，仍然按规则报告结果。有自己的 main() 或者静态状态
+#   与其他测试冲突的测试，在 BUILD 文件中加上 bundle = False，单独链接和运行：
+#   $ bash gen_makefile.sh --bundle_tests xxx/BUILD
+#   $ make debug_test
+#
+# NOTE 22:
+#
+#   make debug_test、release_test 和 ss_test 通过 test_runner.py 并行运行测试，默认并发数为 cpu 数，
+#   可以用环境变量 BLADE_TEST_JOBS 指定；上次耗时最长的测试最先开始。每个测试的输出单独记录在
+#   .blade/test_logs/ 下，测试结束时整体打印；一个测试失败时其余测试仍然运行，退出码为第一个失败
+#   测试的退出码。JUnit 报告写到 .blade/test_reports/<name>.xml，耗时记录在 .blade/test_times：
+#   $ BLADE_TEST_JOBS=8 make debug_test UNIT_TEST_OPTIONS=--gtest_repeat=2
+#
+# NOTE 23:
+#
+#   只构建和运行受修改影响的测试：affected.py 读取修改的文件（参数或标准输入），根据
+#   .blade/deps.db 中规则的源文件、.build 下的 .d 文件（头文件）和 BUILD 文件找到所属的规则，
+#   再沿反向依赖找到受影响的 cc_test 和 ss_test。加上 --make 时生成 .blade/affected_test.mk，
+#   make affected_test 只构建和运行这些测试。不属于任何包的文件（如 build_tools 下的文件）使所有
+#   测试受影响，除非加上 --ignore_unowned：
+#   $ git diff --name-only origin/master | python build_tools/blade3/affected.py --make
+#   $ make affected_test
+#
+# NOTE 24:
+#
+#   生成 Makefile 时，依赖图同时写到 .blade/deps.db（见 NOTE 25），其中预先计算了每个规则的依赖和反向依赖。
+#   build_tools/blade query 读取它，查询 deps、rdeps（--depth 限制层数）、somepath 和 allpaths，
+#   --kind 按规则类型（正则表达式）过滤；目标可以是规则，也可以是 //path/BUILD 表示包中所有规则：
+#   $ build_tools/blade query rdeps //base/BUILD:base --kind cc_test
+#   $ build_tools/blade query somepath //app/BUILD:app //base/BUILD:base
+#
+# NOTE 25:
+#
+#   .blade/deps.db 是带版本号的二进制依赖库：规则按 label 排序编号，label、类型和源文件放在共享的
+#   字符串表中，依赖、反向依赖和源文件是 CSR 数组。读取时 mmap 文件，各部分用到时才加载，
+#   不再 exec Python 代码，见 depdb.py。query、affected.py 和 make regen_makefile 都读取它；
+#   .blade/all_deps 仍按原格式写出，供其它脚本使用。旧版生成的 Makefile 执行 make regen_makefile 时
+#   仍传入 all_deps，regen_makefile.py 按文件头的 magic 识别，两种格式都能读取。query.py、affected.py
+#   需要 deps.db，升级后需重新运行 gen_makefile.sh 生成。
+#
+# NOTE 26:
+#
+#   make regen_makefile 在当前进程中重新生成 Makefile，不再调用 gen_makefile.sh。gen_makefile 时
+#   .blade/regen_state 记录 pconfig.py 的参数、生成器的指纹，以及每个包的 BUILD 文件哈希和 glob
+#   目录的修改时间；regen_makefile 据此找出修改过的包。没有修改时直接跳过，否则用同样的参数重新生成：
+#   只重新执行修改过的 BUILD 文件，其余包从构建缓存回放。Makefile 自身的更新规则和 build.ninja
+#   的 regen 也使用这同一份参数：
+#   $ make regen_makefile
+#   1 of 4 packages changed and are evaluated again, the other 3 are replayed from the build cache
+#
+# NOTE 27:
+#
+#   Makefile 中编译、链接和 protoc 的提示由 make 用 $(info) 直接输出（标准输出是终端时为绿色），不再为每个
+#   动作启动 color_print.py；输出目录是规则的 order-only 依赖，由 Makefile.header 中的 %/ 规则
+#   创建一次，不再在每个动作中启动 shell 检查目录。400 个源文件的全新构建从约 20 秒缩短到约 12 秒。
+#
 
 set -u
 
@@ -234,8 +379,41 @@ if [ $# -eq 0 ]; then
   exit
 fi
 
-for b in $*; do
-  if echo "$b" | grep "/BUILD$" > /dev/null; then
+# 以 - 开头的是 pconfig.py 的选项, 如 --incremental；--unity 和 -j/--jobs 后面跟着它的值
+options=""
+build_files=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+    --unity|--jobs|-j)
+      if [ $# -lt 2 ]; then
+        echo "option $1 requires a value"
+        exit -1
+      fi
+      options="$options $1 $2"
+      shift 2
+      ;;
+    -*)
+      options="$options $1"
+      shift
+      ;;
+    *)
+      build_files="$build_files $1"
+      shift
+      ;;
+  esac
+done
+
+if [ -z "$build_files" ]; then
+  echo "Please specify a BUILD file"
+  echo "Usage: bash $0 [ OPTIONS ] [ PATH_TO_BUILD_FILE |...]"
+  exit -1
+fi
+
+for b in $build_files; do
+  # ALL 表示所有 BUILD 文件，只能单独使用
+  if [ "$b" = "ALL" ] && [ "$build_files" = " ALL" ]; then
+    true
+  elif echo "$b" | grep "/BUILD$" > /dev/null; then
     true
   else
     echo "not a BUILD file: '$b'"
@@ -246,11 +424,11 @@ done
 
 rm -f Makefile
 
-if [ $# -eq 1 ] && [ $1 = "ALL" ]; then
+if [ "$build_files" = " ALL" ]; then
   # 为所有 BUILD 文件，生成 Makefile (刨除 ./pub 和 ./sandbox 目录下的 BUILD 文件)
   all_build=`find . -name BUILD | grep -v "\./pub/" | grep -v "\./sandbox/"`
 
-  python build_tools/blade3/pconfig.py $all_build && \
+  python build_tools/blade3/pconfig.py $options $all_build && \
   echo "" && \
   echo "The Makefile is generated succesfully." && \
   echo "" && \
@@ -258,7 +436,7 @@ if [ $# -eq 1 ] && [ $1 = "ALL" ]; then
   echo $all_build
 else
   # 生成新的 Makefile
-  python build_tools/blade3/pconfig.py $* && \
+  python build_tools/blade3/pconfig.py $options $build_files && \
   echo "" && \
   echo "The Makefile is generated succesfully."
 fi